@@ -25,7 +25,8 @@ from bluepass.passwords import PasswordGenerator
 from bluepass.locator import Locator, ZeroconfLocationSource
 from bluepass.messagebus import MessageBusServer
 from bluepass.socketapi import SocketAPIHandler
-from bluepass.syncapi import SyncAPIApplication, SyncAPIServer, SyncAPIPublisher
+from bluepass.syncapi import SyncAPIApplication, SyncAPIServer, SyncAPIPublisher, \
+        SyncAPIClientPool
 from bluepass.syncer import Syncer
 from bluepass.util import misc as util
 
@@ -59,6 +60,12 @@ class Backend(object):
                             help='Do not quit after last connection exited')
         parser.add_argument('--trace', action='store_true',
                             help='Trace JSON-RPC messages [in backend.trace]')
+        parser.add_argument('--sync-pool-size', type=int,
+                            help='Number of sync API request handlers')
+        parser.add_argument('--sync-max-node-requests', type=int,
+                            help='Maximum concurrent sync API requests per node')
+        parser.add_argument('--sync-max-entity-size', type=int,
+                            help='Maximum size of a sync API request body')
 
     def run(self):
         """Initialize the backend and run its main loop."""
@@ -85,9 +92,13 @@ class Backend(object):
         self.logger.debug('initializing sync API')
         listener = util.create_listener(('0.0.0.0', 0))
         listener.setblocking(False)
-        app = singleton(SyncAPIApplication)
-        syncapi = singleton(SyncAPIServer, listener, app)
+        app = singleton(SyncAPIApplication,
+                    max_node_requests=self.options.get('sync_max_node_requests'),
+                    max_entity_size=self.options.get('sync_max_entity_size'))
+        syncapi = singleton(SyncAPIServer, listener, app,
+                            pool_size=self.options.get('sync_pool_size'))
         syncapi.start()
+        singleton(SyncAPIClientPool)
 
         self.logger.debug('initializing sync API publisher')
         publisher = singleton(SyncAPIPublisher, syncapi)
@@ -196,7 +207,9 @@ class BackendController(object):
         the backend."""
         executable = sys.executable
         args = ['python', '-mbluepass.backend']
-        for key in ('data_dir', 'debug', 'log_stdout', 'listen', 'trace'):
+        for key in ('data_dir', 'debug', 'log_stdout', 'listen', 'trace',
+                    'sync_pool_size', 'sync_max_node_requests',
+                    'sync_max_entity_size'):
             value = self.options.get(key)
             if value is None:
                 continue
@@ -205,7 +218,7 @@ class BackendController(object):
                 if value:
                     args.append(optname)
             else:
-                args += [optname, value]
+                args += [optname, str(value)]
         env = os.environ.copy()
         if 'auth_token' in self.options:
             env['BLUEPASS_AUTH_TOKEN'] = self.options['auth_token']
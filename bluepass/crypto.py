@@ -15,6 +15,7 @@ import logging
 import base64
 
 from bluepass.ext import openssl
+from bluepass.ext.secmem import SecureBuffer
 
 CryptoError = openssl.Error
 
@@ -76,9 +77,17 @@ class CryptoProvider(object):
         """
         return self.engine.rsa_encrypt(s, pubkey, padding)
 
-    def rsa_decrypt(self, s, privkey, padding='oaep'):
-        """RSA Decrypt a string `s' using the private key `privkey'."""
-        return self.engine.rsa_decrypt(s, privkey, padding)
+    def rsa_decrypt(self, s, privkey, padding='oaep', secure=False):
+        """RSA Decrypt a string `s' using the private key `privkey'.
+
+        If `secure` is True, the plaintext is written directly into a
+        SecureBuffer, which is returned.
+        """
+        if not secure:
+            return self.engine.rsa_decrypt(s, privkey, padding)
+        out = SecureBuffer(len(s))
+        out.truncate(self.engine.rsa_decrypt(s, privkey, padding, out))
+        return out
 
     def rsa_sign(self, s, privkey, padding='pss-sha256'):
         """Create a detached RSA signature of `s' using private key
@@ -90,6 +99,30 @@ class CryptoProvider(object):
         `pubkey'."""
         return self.engine.rsa_verify(s, sig, pubkey, padding)
 
+    def ec_genkey(self, curve='prime256v1'):
+        """Generate an elliptic curve key pair on the named curve `curve'.
+        The result is a 2-tuple containing the private and public keys as
+        ASN.1 encoded bitstrings."""
+        return self.engine.ec_genkey(curve)
+
+    def ec_checkkey(self, privkey):
+        """Check that `privkey' is a valid elliptic curve private key."""
+        return self.engine.ec_checkkey(privkey)
+
+    def ec_size(self, pubkey):
+        """Return the size in bits of the curve of public key `pubkey'."""
+        return self.engine.ec_size(pubkey)
+
+    def ec_sign(self, s, privkey, hash='sha256'):
+        """Create a detached ECDSA signature of `s' using private key
+        `privkey'."""
+        return self.engine.ec_sign(s, privkey, hash)
+
+    def ec_verify(self, s, sig, pubkey, hash='sha256'):
+        """Verify a detached ECDSA signature `sig' over `s' using the public
+        key `pubkey'."""
+        return self.engine.ec_verify(s, sig, pubkey, hash)
+
     def dh_genparams(self, bits, generator):
         """Generate Diffie-Hellman parameters. The prime will be `bits'
         bits in size and `generator' will be the generator."""
@@ -118,12 +151,26 @@ class CryptoProvider(object):
         return self.engine.dh_compute(params, privkey, pubkey)
 
     def aes_encrypt(self, s, key, iv, mode='cbc-pkcs7'):
-        """AES encrypt a string `s' with key `key'."""
+        """AES encrypt a string `s' with key `key'.
+
+        The `mode` is either "cbc-pkcs7" (16 byte IV) or "gcm" (12 byte IV).
+        In GCM mode the 16 byte authentication tag is appended to the
+        ciphertext.
+        """
         return self.engine.aes_encrypt(s, key, iv, mode)
 
-    def aes_decrypt(self, s, key, iv, mode='cbc-pkcs7'):
-        """AES decrypt a string `s' with key `key'."""
-        return self.engine.aes_decrypt(s, key, iv, mode)
+    def aes_decrypt(self, s, key, iv, mode='cbc-pkcs7', secure=False):
+        """AES decrypt a string `s' with key `key'.
+
+        In "gcm" mode the authentication tag is verified, and a CryptoError
+        is raised if it does not match. If `secure` is True, the plaintext is
+        written directly into a SecureBuffer, which is returned.
+        """
+        if not secure:
+            return self.engine.aes_decrypt(s, key, iv, mode)
+        out = SecureBuffer(len(s))
+        out.truncate(self.engine.aes_decrypt(s, key, iv, mode, out))
+        return out
 
     def pbkdf2(self, password, salt, count, length, prf='hmac-sha1'):
         """PBKDF2 key derivation function from PKCS#5."""
@@ -176,7 +223,8 @@ class CryptoProvider(object):
         containing all possible single byte values (0 through to 255).
 
         The type of the return value is the same as the elements in the
-        alphabet (string or unicode).
+        alphabet (string or unicode). Elements are chosen uniformly from the
+        alphabet.
         """
         return self.engine.random(count, alphabet, separator)
 
@@ -188,9 +236,7 @@ class CryptoProvider(object):
 
     def randuuid(self):
         """Return a type-4 random UUID."""
-        return '%08x-%04x-4%03x-%04x-%012x' % \
-               (self.randint(32), self.randint(16), self.randint(12),
-                0x8000 + self.randint(14), self.randint(48))
+        return self.engine.randuuid()
 
     def _get_hash(self, name):
         """INTERNAL: return a hash contructor from its name."""
@@ -204,6 +250,19 @@ class CryptoProvider(object):
         md = self._get_hash(hash)
         return hmac.new(key, message, md).digest()
 
+    def compare_digest(self, a, b):
+        """Compare the strings `a' and `b' in constant time. Use this to
+        check a MAC, so that the comparison does not leak how many bytes
+        of it were correct."""
+        if hasattr(hmac, 'compare_digest'):
+            return hmac.compare_digest(a, b)
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
     def hkdf(self, password, salt, info, length, hash='sha256'):
         """HKDF key derivation function."""
         md = self._get_hash(hash)
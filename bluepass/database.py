@@ -164,14 +164,17 @@ class Database(object):
         self._commit(cursor)
         return result
 
-    def findall(self, table, where=None, args=(), sort=None):
-        """Find a set of documents in a collection."""
+    def findall(self, table, where=None, args=(), sort=None, limit=None):
+        """Find a set of documents in a collection. If `limit` is provided,
+        at most this many documents are returned."""
         cursor = self._cursor()
         query = 'SELECT doc FROM %s' % table
         if where is not None:
             query += ' WHERE %s' % where
         if sort is not None:
             query += ' ORDER BY %s' % sort
+        if limit is not None:
+            query += ' LIMIT %d' % limit
         query = self._update_references(query, table)
         result = cursor.execute(query, args)
         result = [ json.loads(row[0]) for row in result ]
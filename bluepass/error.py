@@ -48,6 +48,7 @@ class StructuredError(Error):
         'ConsistencyError': 'Internal data inconsistency error',
         'PlatformError': 'Generic platform or operating system error',
         'RemoteError': 'Communications error with a remote peer',
+        'Busy': 'Remote peer is busy',
         'UncaughtException': 'An uncaught exception occurred',
         'ProgrammingError': 'Programming error'
     }
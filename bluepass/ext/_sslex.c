@@ -34,6 +34,15 @@ static PyObject *sslex_Error = NULL;
 #define CHECK_OPENSSL_ERROR(cond) \
     CHECK_ERROR(cond, ERR_error_string(ERR_get_error(), NULL))
 
+/* The extended master secret extension (RFC 7627) is available in OpenSSL
+ * 1.1.0 and later. Without it, session resumption is not safe to combine
+ * with tls-unique channel bindings (the "triple handshake" attack). */
+#ifdef SSL_CTRL_GET_EXTMS_SUPPORT
+#  define HAVE_EXTMS 1
+#else
+#  define HAVE_EXTMS 0
+#endif
+
 
 #if PY_MAJOR_VERSION >= 3
 #  define MOD_OK(val) (val)
@@ -183,6 +192,136 @@ error:
     return Pret;
 }
 
+static PyObject *
+sslex_get_session(PyObject *self, PyObject *args)
+{
+    int len;
+    unsigned char *p;
+    PyObject *Psession = NULL;
+    PySSLShadowObject *sslob;
+    SSL_SESSION *session;
+
+    if (!PyArg_ParseTuple(args, "O:get_session", &sslob))
+        return NULL;
+    if (strcmp(sslob->ob_type->tp_name, "ssl.SSLContext"))
+        RETURN_ERROR("expecting a SSLContext");
+
+    session = SSL_get_session(sslob->ssl);
+    if (session == NULL) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    len = i2d_SSL_SESSION(session, NULL);
+    CHECK_OPENSSL_ERROR(len <= 0);
+    if ((Psession = PyString_FromStringAndSize(NULL, len)) == NULL)
+        RETURN_ERROR(NULL);
+    p = (unsigned char *) PyString_AS_STRING(Psession);
+    if (i2d_SSL_SESSION(session, &p) != len) {
+        Py_DECREF(Psession); Psession = NULL;
+        RETURN_ERROR("i2d_SSL_SESSION() failed");
+    }
+
+error:
+    return Psession;
+}
+
+static PyObject *
+sslex_set_session(PyObject *self, PyObject *args)
+{
+    unsigned char *data;
+    int datalen, ret;
+    PyObject *Pret = NULL;
+    PySSLShadowObject *sslob;
+    SSL_SESSION *session = NULL;
+
+    if (!PyArg_ParseTuple(args, "Os#:set_session", &sslob, &data, &datalen))
+        return NULL;
+    if (strcmp(sslob->ob_type->tp_name, "ssl.SSLContext"))
+        RETURN_ERROR("expecting a SSLContext");
+
+    session = d2i_SSL_SESSION(NULL, (const unsigned char **) &data, datalen);
+    CHECK_OPENSSL_ERROR(session == NULL);
+    /* This takes its own reference to the session. */
+    ret = SSL_set_session(sslob->ssl, session);
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    Py_INCREF(Py_None);
+    Pret = Py_None;
+
+error:
+    if (session != NULL)
+        SSL_SESSION_free(session);
+    return Pret;
+}
+
+static PyObject *
+sslex_session_reused(PyObject *self, PyObject *args)
+{
+    PyObject *Pret = NULL;
+    PySSLShadowObject *sslob;
+
+    if (!PyArg_ParseTuple(args, "O:session_reused", &sslob))
+        return NULL;
+    if (strcmp(sslob->ob_type->tp_name, "ssl.SSLContext"))
+        RETURN_ERROR("expecting a SSLContext");
+
+    Pret = PyBool_FromLong(SSL_session_reused(sslob->ssl));
+
+error:
+    return Pret;
+}
+
+static PyObject *
+sslex_extms_used(PyObject *self, PyObject *args)
+{
+    long used = 0;
+    PyObject *Pret = NULL;
+    PySSLShadowObject *sslob;
+
+    if (!PyArg_ParseTuple(args, "O:extms_used", &sslob))
+        return NULL;
+    if (strcmp(sslob->ob_type->tp_name, "ssl.SSLContext"))
+        RETURN_ERROR("expecting a SSLContext");
+
+#if HAVE_EXTMS
+    used = SSL_get_extms_support(sslob->ssl) == 1;
+#endif
+    Pret = PyBool_FromLong(used);
+
+error:
+    return Pret;
+}
+
+static PyObject *
+sslex_set_session_tickets(PyObject *self, PyObject *args)
+{
+    unsigned char *keys;
+    int keyslen, timeout;
+    long ret;
+    PyObject *Pret = NULL;
+    PySSLShadowObject *sslob;
+
+    if (!PyArg_ParseTuple(args, "Os#i:set_session_tickets", &sslob, &keys,
+                          &keyslen, &timeout))
+        return NULL;
+    if (strcmp(sslob->ob_type->tp_name, "ssl.SSLContext"))
+        RETURN_ERROR("expecting a SSLContext");
+    CHECK_ERROR(keyslen != 48, "ticket keys must be 48 bytes");
+
+    /* The _ssl module creates a new SSL_CTX for every socket. Setting the
+     * same ticket keys on each of them allows a client to resume a session
+     * that it got from an earlier connection. */
+    ret = SSL_CTX_set_tlsext_ticket_keys(sslob->ctx, keys, keyslen);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    SSL_CTX_set_timeout(sslob->ctx, timeout);
+
+    Py_INCREF(Py_None);
+    Pret = Py_None;
+
+error:
+    return Pret;
+}
+
 #else
 
 /* Py3K: This module is an empty module on Python3. All required
@@ -201,6 +340,16 @@ static PyMethodDef sslex_methods[] =
             (PyCFunction) sslex_set_dh_params, METH_VARARGS },
     { "_set_accept_state",
             (PyCFunction) sslex__set_accept_state, METH_VARARGS },
+    { "get_session",
+            (PyCFunction) sslex_get_session, METH_VARARGS },
+    { "set_session",
+            (PyCFunction) sslex_set_session, METH_VARARGS },
+    { "session_reused",
+            (PyCFunction) sslex_session_reused, METH_VARARGS },
+    { "extms_used",
+            (PyCFunction) sslex_extms_used, METH_VARARGS },
+    { "set_session_tickets",
+            (PyCFunction) sslex_set_session_tickets, METH_VARARGS },
 #endif
     { NULL, NULL }
 };
@@ -225,6 +374,8 @@ MOD_INITFUNC(_sslex)
         return MOD_ERROR;
     if (PyDict_SetItemString(Pdict, "Error", sslex_Error) == -1)
         return MOD_ERROR;
+    if (PyModule_AddIntConstant(Pmodule, "HAVE_EXTMS", HAVE_EXTMS) == -1)
+        return MOD_ERROR;
 
     return MOD_OK(Pmodule);
 }
@@ -11,11 +11,17 @@
 
 #include <stdlib.h>
 #include <string.h>
+#include <limits.h>
+#include <unistd.h>
+#include <pthread.h>
 
 #include <openssl/ssl.h>
 #include <openssl/err.h>
 #include <openssl/rsa.h>
 #include <openssl/dh.h>
+#include <openssl/ec.h>
+#include <openssl/ecdsa.h>
+#include <openssl/objects.h>
 #include <openssl/bn.h>
 #include <openssl/aes.h>
 #include <openssl/evp.h>
@@ -76,6 +82,7 @@ static PyObject *openssl_Error = NULL;
 
 #define RSA_clear_free RSA_free
 #define DH_clear_free DH_free
+#define EC_KEY_clear_free EC_KEY_free
 
 #define PyBytes_ClearFree(s) \
     do { if (s != NULL) { \
@@ -105,6 +112,27 @@ static PyObject *openssl_Error = NULL;
 #endif
 
 
+/*
+ * The functions that produce secrets (rsa_decrypt and aes_decrypt) can
+ * optionally write their output into a writable buffer that is passed in by
+ * the caller, instead of returning a new string. This allows the output to
+ * go directly into a secmem.SecureBuffer. In this case the number of bytes
+ * written is returned. The buffer must be at least `size` bytes.
+ */
+
+static int
+get_output_buffer(PyObject *Pdest, Py_buffer *view, Py_ssize_t size)
+{
+    if (PyObject_GetBuffer(Pdest, view, PyBUF_WRITABLE) < 0)
+        return -1;
+    if (view->len < size) {
+        PyBuffer_Release(view);
+        PyErr_SetString(openssl_Error, "output buffer too small");
+        return -1;
+    }
+    return 0;
+}
+
 static PyObject *
 openssl_rsa_genkey(PyObject *self, PyObject *args)
 {
@@ -243,12 +271,13 @@ openssl_rsa_decrypt(PyObject *self, PyObject *args)
 {
     char *padding;
     unsigned char *in, *key, *out = NULL;
-    int inlen, outlen, keylen, size;
+    int inlen, outlen = 0, keylen, size;
     RSA *rsa = NULL;
-    PyObject *Pout = NULL;
+    Py_buffer dest, *pdest = NULL;
+    PyObject *Pdest = NULL, *Pout = NULL;
 
-    if (!PyArg_ParseTuple(args, "s#s#s:rsa_decrypt", &in, &inlen,
-                          &key, &keylen, &padding))
+    if (!PyArg_ParseTuple(args, "s#s#s|O:rsa_decrypt", &in, &inlen,
+                          &key, &keylen, &padding, &Pdest))
         return NULL;
     if (strcmp(padding, "oaep"))
         RETURN_ERROR("unsupported padding: %s", padding);
@@ -256,15 +285,28 @@ openssl_rsa_decrypt(PyObject *self, PyObject *args)
     rsa = d2i_RSAPrivateKey(NULL, (const unsigned char **) &key, keylen);
     CHECK_OPENSSL_ERROR(rsa == NULL);
     outlen = RSA_size(rsa);
-    MALLOC(out, outlen);
+    if (Pdest != NULL && Pdest != Py_None) {
+        CHECK_PYTHON_ERROR(get_output_buffer(Pdest, &dest, outlen) < 0);
+        pdest = &dest;
+        out = dest.buf;
+    } else
+        MALLOC(out, outlen);
     size = RSA_private_decrypt(inlen, in, out, rsa, RSA_PKCS1_OAEP_PADDING);
     CHECK_OPENSSL_ERROR(size < 0);
-    Pout = PyBytes_FromStringAndSize((char *) out, size);
+    if (pdest != NULL)
+        Pout = PyLong_FromLong(size);
+    else
+        Pout = PyBytes_FromStringAndSize((char *) out, size);
     CHECK_PYTHON_ERROR(Pout == NULL);
 
 error:
     RSA_clear_free(rsa);
-    clear_free(out, outlen);
+    if (pdest != NULL) {
+        if (Pout == NULL)
+            memset(out, 0, outlen);
+        PyBuffer_Release(pdest);
+    } else
+        clear_free(out, outlen);
     return Pout;
 }
 
@@ -365,6 +407,178 @@ error:
     return Presult;
 }
 
+/*
+ * Elliptic curve keys. Private keys are serialized as DER encoded
+ * ECPrivateKey structures, public keys as DER encoded SubjectPublicKeyInfo
+ * structures. Both include the named curve so that a key can be loaded
+ * without knowing its curve beforehand.
+ */
+
+static PyObject *
+openssl_ec_genkey(PyObject *self, PyObject *args)
+{
+    char *curve;
+    unsigned char *privkey = NULL, *pubkey = NULL;
+    int nid, ret, privlen = 0, publen = 0;
+    EC_KEY *ec = NULL;
+    PyObject *Presult = NULL, *Pprivkey = NULL, *Ppubkey = NULL;
+
+    if (!PyArg_ParseTuple(args, "s:ec_genkey", &curve))
+        return NULL;
+
+    if ((nid = OBJ_sn2nid(curve)) == NID_undef)
+        RETURN_ERROR("unknown curve: %s", curve);
+    ec = EC_KEY_new_by_curve_name(nid);
+    CHECK_OPENSSL_ERROR(ec == NULL);
+    EC_KEY_set_asn1_flag(ec, OPENSSL_EC_NAMED_CURVE);
+
+    Py_BEGIN_ALLOW_THREADS
+    ret = EC_KEY_generate_key(ec);
+    Py_END_ALLOW_THREADS
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    privlen = i2d_ECPrivateKey(ec, &privkey);
+    CHECK_OPENSSL_ERROR(privlen <= 0);
+    publen = i2d_EC_PUBKEY(ec, &pubkey);
+    CHECK_OPENSSL_ERROR(publen <= 0);
+
+    Presult = PyTuple_New(2);
+    CHECK_PYTHON_ERROR(Presult == NULL);
+    Pprivkey = PyBytes_FromStringAndSize((char *) privkey, privlen);
+    CHECK_PYTHON_ERROR(Pprivkey == NULL);
+    Ppubkey = PyBytes_FromStringAndSize((char *) pubkey, publen);
+    CHECK_PYTHON_ERROR(Ppubkey == NULL);
+    PyTuple_SET_ITEM(Presult, 0, Pprivkey);
+    PyTuple_SET_ITEM(Presult, 1, Ppubkey);
+    goto cleanup;
+
+error:
+    Py_XDECREF(Presult);
+    PyBytes_ClearFree(Pprivkey);
+    PyBytes_ClearFree(Ppubkey);
+
+cleanup:
+    EC_KEY_clear_free(ec);
+    OPENSSL_clear_free(privkey, privlen);
+    OPENSSL_clear_free(pubkey, publen);
+    return Presult;
+}
+
+static PyObject *
+openssl_ec_checkkey(PyObject *self, PyObject *args)
+{
+    unsigned char *key;
+    int keylen, check;
+    EC_KEY *ec = NULL;
+    PyObject *Presult = NULL;
+
+    if (!PyArg_ParseTuple(args, "s#:ec_checkkey", &key, &keylen))
+        return NULL;
+
+    ec = d2i_ECPrivateKey(NULL, (const unsigned char **) &key, keylen);
+    CHECK_OPENSSL_ERROR(ec == NULL);
+    check = EC_KEY_check_key(ec);
+    Presult = PyBool_FromLong(check == 1);
+    CHECK_PYTHON_ERROR(Presult == NULL);
+
+error:
+    EC_KEY_clear_free(ec);
+    return Presult;
+}
+
+static PyObject *
+openssl_ec_size(PyObject *self, PyObject *args)
+{
+    unsigned char *key;
+    int keylen;
+    EC_KEY *ec = NULL;
+    PyObject *Presult = NULL;
+
+    if (!PyArg_ParseTuple(args, "s#:ec_size", &key, &keylen))
+        return NULL;
+
+    ec = d2i_EC_PUBKEY(NULL, (const unsigned char **) &key, keylen);
+    CHECK_OPENSSL_ERROR(ec == NULL);
+    Presult = PyLong_FromLong(EC_GROUP_get_degree(EC_KEY_get0_group(ec)));
+    CHECK_PYTHON_ERROR(Presult == NULL);
+
+error:
+    EC_KEY_clear_free(ec);
+    return Presult;
+}
+
+static PyObject *
+openssl_ec_sign(PyObject *self, PyObject *args)
+{
+    char *hash;
+    unsigned char *in, *key, *sig = NULL, md[EVP_MAX_MD_SIZE];
+    unsigned int mdlen = 0, siglen = 0;
+    int inlen, keylen, size = 0, ret;
+    EC_KEY *ec = NULL;
+    const EVP_MD *digest;
+    PyObject *Psig = NULL;
+
+    if (!PyArg_ParseTuple(args, "s#s#s:ec_sign", &in, &inlen,
+                          &key, &keylen, &hash))
+        return NULL;
+    if ((digest = EVP_get_digestbyname(hash)) == NULL)
+        RETURN_ERROR("unknown hash function: %s", hash);
+
+    ret = EVP_Digest(in, inlen, md, &mdlen, digest, NULL);
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    ec = d2i_ECPrivateKey(NULL, (const unsigned char **) &key, keylen);
+    CHECK_OPENSSL_ERROR(ec == NULL);
+    size = ECDSA_size(ec);
+    MALLOC(sig, size);
+    Py_BEGIN_ALLOW_THREADS
+    ret = ECDSA_sign(0, md, mdlen, sig, &siglen, ec);
+    Py_END_ALLOW_THREADS
+    CHECK_OPENSSL_ERROR(ret != 1);
+    Psig = PyBytes_FromStringAndSize((char *) sig, siglen);
+    CHECK_PYTHON_ERROR(Psig == NULL);
+
+error:
+    EC_KEY_clear_free(ec);
+    memset(md, 0, sizeof(md));
+    clear_free(sig, size);
+    return Psig;
+}
+
+static PyObject *
+openssl_ec_verify(PyObject *self, PyObject *args)
+{
+    char *hash;
+    unsigned char *in, *sig, *key, md[EVP_MAX_MD_SIZE];
+    unsigned int mdlen = 0;
+    int inlen, siglen, keylen, ret;
+    EC_KEY *ec = NULL;
+    const EVP_MD *digest;
+    PyObject *Presult = NULL;
+
+    if (!PyArg_ParseTuple(args, "s#s#s#s:ec_verify", &in, &inlen,
+                          &sig, &siglen, &key, &keylen, &hash))
+        return NULL;
+    if ((digest = EVP_get_digestbyname(hash)) == NULL)
+        RETURN_ERROR("unknown hash function: %s", hash);
+
+    ret = EVP_Digest(in, inlen, md, &mdlen, digest, NULL);
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    ec = d2i_EC_PUBKEY(NULL, (const unsigned char **) &key, keylen);
+    CHECK_OPENSSL_ERROR(ec == NULL);
+    Py_BEGIN_ALLOW_THREADS
+    ret = ECDSA_verify(0, md, mdlen, sig, siglen, ec);
+    Py_END_ALLOW_THREADS
+    CHECK_OPENSSL_ERROR(ret < 0);
+    Presult = PyBool_FromLong(ret);
+    CHECK_PYTHON_ERROR(Presult == NULL);
+
+error:
+    EC_KEY_clear_free(ec);
+    return Presult;
+}
+
 static PyObject *
 openssl_dh_genparams(PyObject *self, PyObject *args)
 {
@@ -560,6 +774,121 @@ error:
     return Presult;
 }
 
+/*
+ * AES-GCM. The ciphertext is returned with the 128-bit authentication tag
+ * appended to it. On decryption the tag is checked by EVP_DecryptFinal_ex()
+ * before any plaintext is handed back to the caller.
+ */
+
+#define GCM_TAG_SIZE 16
+
+static const EVP_CIPHER *
+aes_gcm_cipher(int ukeylen)
+{
+    switch (ukeylen) {
+    case 16: return EVP_aes_128_gcm();
+    case 24: return EVP_aes_192_gcm();
+    case 32: return EVP_aes_256_gcm();
+    }
+    return NULL;
+}
+
+static PyObject *
+aes_gcm_encrypt(unsigned char *in, int inlen, unsigned char *ukey,
+                int ukeylen, unsigned char *iv, int ivlen)
+{
+    unsigned char *out = NULL;
+    int outlen = 0, len, ret;
+    EVP_CIPHER_CTX *ctx = NULL;
+    PyObject *Pout = NULL;
+
+    if (ivlen != 12)
+        RETURN_ERROR("IV must be 96 bits");
+
+    ctx = EVP_CIPHER_CTX_new();
+    CHECK_OPENSSL_ERROR(ctx == NULL);
+    ret = EVP_EncryptInit_ex(ctx, aes_gcm_cipher(ukeylen), NULL, NULL, NULL);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_GCM_SET_IVLEN, ivlen, NULL);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_EncryptInit_ex(ctx, NULL, NULL, ukey, iv);
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    outlen = inlen + GCM_TAG_SIZE;
+    MALLOC(out, outlen);
+    ret = EVP_EncryptUpdate(ctx, out, &len, in, inlen);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_EncryptFinal_ex(ctx, out + len, &len);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_GCM_GET_TAG, GCM_TAG_SIZE,
+                              out + inlen);
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    Pout = PyBytes_FromStringAndSize((char *) out, outlen);
+    CHECK_PYTHON_ERROR(Pout == NULL);
+
+error:
+    if (ctx != NULL)
+        EVP_CIPHER_CTX_free(ctx);
+    clear_free(out, outlen);
+    return Pout;
+}
+
+static PyObject *
+aes_gcm_decrypt(unsigned char *in, int inlen, unsigned char *ukey,
+                int ukeylen, unsigned char *iv, int ivlen, Py_buffer *pdest)
+{
+    unsigned char *out = NULL;
+    int outlen = 0, len, ret;
+    EVP_CIPHER_CTX *ctx = NULL;
+    PyObject *Pout = NULL;
+
+    if (ivlen != 12)
+        RETURN_ERROR("IV must be 96 bits");
+    if (inlen < GCM_TAG_SIZE)
+        RETURN_ERROR("ciphertext too short");
+
+    ctx = EVP_CIPHER_CTX_new();
+    CHECK_OPENSSL_ERROR(ctx == NULL);
+    ret = EVP_DecryptInit_ex(ctx, aes_gcm_cipher(ukeylen), NULL, NULL, NULL);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_GCM_SET_IVLEN, ivlen, NULL);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_DecryptInit_ex(ctx, NULL, NULL, ukey, iv);
+    CHECK_OPENSSL_ERROR(ret != 1);
+
+    outlen = inlen - GCM_TAG_SIZE;
+    if (pdest != NULL)
+        out = pdest->buf;
+    else
+        MALLOC(out, outlen + 1);
+    ret = EVP_DecryptUpdate(ctx, out, &len, in, outlen);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_GCM_SET_TAG, GCM_TAG_SIZE,
+                              in + outlen);
+    CHECK_OPENSSL_ERROR(ret != 1);
+    ret = EVP_DecryptFinal_ex(ctx, out + len, &len);
+    if (ret != 1) {
+        ERR_clear_error();
+        RETURN_ERROR("authentication tag mismatch");
+    }
+
+    if (pdest != NULL)
+        Pout = PyLong_FromLong(outlen);
+    else
+        Pout = PyBytes_FromStringAndSize((char *) out, outlen);
+    CHECK_PYTHON_ERROR(Pout == NULL);
+
+error:
+    if (ctx != NULL)
+        EVP_CIPHER_CTX_free(ctx);
+    if (pdest == NULL)
+        clear_free(out, outlen);
+    else if (Pout == NULL && out != NULL)
+        memset(out, 0, outlen);
+    return Pout;
+}
+
 static PyObject *
 openssl_aes_encrypt(PyObject *self, PyObject *args)
 {
@@ -574,6 +903,8 @@ openssl_aes_encrypt(PyObject *self, PyObject *args)
         return NULL;
     if ((ukeylen != 16) && (ukeylen != 24) && (ukeylen != 32))
         RETURN_ERROR("key size must be 128, 192 or 256 bits");
+    if (!strcmp(mode, "gcm"))
+        return aes_gcm_encrypt(in, inlen, ukey, ukeylen, iv, ivlen);
     if (ivlen != 16)
         RETURN_ERROR("IV must be 128 bits");
     if (strcmp(mode, "cbc-pkcs7"))
@@ -610,15 +941,24 @@ openssl_aes_decrypt(PyObject *self, PyObject *args)
     unsigned char *in, *out = NULL, *iv, *iv2 = NULL, *ukey;
     int inlen, ukeylen, ivlen, padlen, i, ret;
     AES_KEY key;
-    PyObject *Pout = NULL;
+    Py_buffer dest, *pdest = NULL;
+    PyObject *Pdest = NULL, *Pout = NULL;
 
-    if (!PyArg_ParseTuple(args, "s#s#s#s:aes_decrypt", &in, &inlen,
-                          &ukey, &ukeylen, &iv, &ivlen, &mode))
+    if (!PyArg_ParseTuple(args, "s#s#s#s|O:aes_decrypt", &in, &inlen,
+                          &ukey, &ukeylen, &iv, &ivlen, &mode, &Pdest))
         return NULL;
-    if ((inlen == 0) || (inlen % 16))
-        RETURN_ERROR("invalid padding");
     if ((ukeylen != 16) && (ukeylen != 24) && (ukeylen != 32))
         RETURN_ERROR("key size must be 128, 192 or 256 bits");
+    if (Pdest != NULL && Pdest != Py_None) {
+        CHECK_PYTHON_ERROR(get_output_buffer(Pdest, &dest, inlen) < 0);
+        pdest = &dest;
+    }
+    if (!strcmp(mode, "gcm")) {
+        Pout = aes_gcm_decrypt(in, inlen, ukey, ukeylen, iv, ivlen, pdest);
+        goto error;
+    }
+    if ((inlen == 0) || (inlen % 16))
+        RETURN_ERROR("invalid padding");
     if (ivlen != 16)
         RETURN_ERROR("IV must be 128 bits");
     if (strcmp(mode, "cbc-pkcs7"))
@@ -627,24 +967,37 @@ openssl_aes_decrypt(PyObject *self, PyObject *args)
     ret = AES_set_decrypt_key(ukey, ukeylen*8, &key);
     CHECK_OPENSSL_ERROR(ret != 0);
 
-    MALLOC(out, inlen);
+    if (pdest != NULL)
+        out = pdest->buf;
+    else
+        MALLOC(out, inlen);
     MALLOC(iv2, ivlen);
     memcpy(iv2, iv, ivlen);
 
-    AES_cbc_encrypt(in, out, inlen, &key, iv, 0);
+    AES_cbc_encrypt(in, out, inlen, &key, iv2, 0);
 
     padlen = out[inlen-1];
-    if (padlen > 16)
-        RETURN_ERROR("invalid padding 1: %s", out);
+    if ((padlen == 0) || (padlen > 16))
+        RETURN_ERROR("invalid padding");
     for (i=0; i<padlen; i++)
         if (out[inlen-1-i] != padlen)
-            RETURN_ERROR("invalid padding 2: %s", out);
-    Pout = PyBytes_FromStringAndSize((char *) out, inlen-padlen);
+            RETURN_ERROR("invalid padding");
+    if (pdest != NULL) {
+        memset(out + inlen - padlen, 0, padlen);
+        Pout = PyLong_FromLong(inlen - padlen);
+    } else
+        Pout = PyBytes_FromStringAndSize((char *) out, inlen-padlen);
     CHECK_PYTHON_ERROR(Pout == NULL);
 
 error:
-    clear_free(out, inlen);
+    if (pdest != NULL) {
+        if (Pout == NULL && out != NULL)
+            memset(out, 0, inlen);
+        PyBuffer_Release(pdest);
+    } else
+        clear_free(out, inlen);
     clear_free(iv2, ivlen);
+    memset(&key, 0, sizeof(key));
     return Pout;
 }
 
@@ -699,6 +1052,105 @@ error:
     return Presult;
 }
 
+/*
+ * Random pool.
+ *
+ * Random bytes are taken from a pool that is refilled from RAND_bytes() in
+ * bulk. Creating a single item needs a few UUIDs and some IVs and keys, and
+ * going to RAND_bytes() for each of them individually is expensive. Bytes
+ * are wiped from the pool as soon as they are handed out, so that the pool
+ * only ever contains bytes that have not been used yet. The pool is wiped
+ * when the interpreter exits.
+ *
+ * The pool is wiped in the child after a fork(), by a pthread_atfork()
+ * handler, so that parent and child do not share random bytes. If the handler
+ * cannot be installed, the pool is not used at all. OpenSSL is reseeded after
+ * every RANDOM_POOL_RESEED bytes that were served from the pool. Large
+ * requests bypass the pool.
+ *
+ * Access to the pool is serialized by the GIL.
+ */
+
+#define RANDOM_POOL_SIZE 4096
+#define RANDOM_POOL_RESEED (1024*1024)
+
+static unsigned char *random_pool = NULL;
+static int random_pool_avail = 0;
+static long random_pool_served = 0;
+static int random_pool_enabled = 0;
+
+static void
+random_pool_wipe(void)
+{
+    if (random_pool != NULL)
+        memset(random_pool, 0, RANDOM_POOL_SIZE);
+    random_pool_avail = 0;
+}
+
+static int
+random_pool_refill(void)
+{
+    int ret;
+
+    if (random_pool == NULL) {
+        random_pool = malloc(RANDOM_POOL_SIZE);
+        if (random_pool == NULL)
+            return 0;
+    }
+    if (random_pool_served >= RANDOM_POOL_RESEED) {
+        RAND_poll();
+        random_pool_served = 0;
+    }
+    ret = RAND_bytes(random_pool, RANDOM_POOL_SIZE);
+    if (ret != 1) {
+        random_pool_wipe();
+        return 0;
+    }
+    random_pool_avail = RANDOM_POOL_SIZE;
+    return 1;
+}
+
+/* Return `num` random bytes in `buf`. Return 1 on success, 0 on error. */
+
+static int
+random_bytes(unsigned char *buf, int num)
+{
+    int nbytes;
+    unsigned char *ptr;
+
+    if (!random_pool_enabled || num > RANDOM_POOL_SIZE/4)
+        return RAND_bytes(buf, num);
+    while (num > 0) {
+        if (random_pool_avail == 0 && !random_pool_refill())
+            return 0;
+        nbytes = (num < random_pool_avail) ? num : random_pool_avail;
+        ptr = random_pool + RANDOM_POOL_SIZE - random_pool_avail;
+        memcpy(buf, ptr, nbytes);
+        memset(ptr, 0, nbytes);
+        random_pool_avail -= nbytes;
+        random_pool_served += nbytes;
+        buf += nbytes; num -= nbytes;
+    }
+    return 1;
+}
+
+/* Return a uniformly distributed random integer in [0, n) in `value`. This
+ * uses rejection sampling so that there is no modulo bias. */
+
+static int
+random_index(unsigned int n, unsigned int *value)
+{
+    unsigned int limit, r;
+
+    limit = UINT_MAX - (UINT_MAX % n);
+    do {
+        if (!random_bytes((unsigned char *) &r, sizeof(r)))
+            return 0;
+    } while (r >= limit);
+    *value = r % n;
+    return 1;
+}
+
 /*
  * The openssl_random() funcion could have been implemented much easier in
  * Python using os.urandom() as the random source. We implement it in C below
@@ -709,57 +1161,65 @@ error:
 static PyObject *
 openssl_random(PyObject *self, PyObject *args)
 {
-    int i, count, nitems, size, ret, buflen, buf2len, seplen, offset;
-    char *buf = NULL, *buf2 = NULL, *ptr, *sepptr;
-    PyObject *alphabet = NULL, *separator = NULL, *item, *Presult = NULL;
+    int i, count, nitems, size, ret, buflen = 0, seplen, offset;
+    unsigned int idx;
+    char *buf = NULL, *ptr, *sepptr;
+    PyObject *alphabet = NULL, *separator = NULL, *first = NULL,
+             *item = NULL, *Presult = NULL;
 
     if (!PyArg_ParseTuple(args, "i|OO:random", &count, &alphabet, &separator))
         return NULL;
+    if (count < 0)
+        RETURN_ERROR("count must be >= 0");
+
+    if (alphabet != NULL && alphabet != Py_None && !PyBytes_Check(alphabet)
+            && !PyUnicode_Check(alphabet) && PySequence_Check(alphabet)
+            && PySequence_Size(alphabet) > 0) {
+        first = PySequence_GetItem(alphabet, 0);
+        CHECK_PYTHON_ERROR(first == NULL);
+    }
 
-    if (alphabet == Py_None) {
+    if (alphabet == NULL || alphabet == Py_None) {
         buflen = count;
         MALLOC(buf, buflen);
-        ret = RAND_bytes((unsigned char *) buf, count);
+        ret = random_bytes((unsigned char *) buf, count);
+        CHECK_OPENSSL_ERROR(ret != 1);
         Presult = PyBytes_FromStringAndSize(buf, count);
         CHECK_PYTHON_ERROR(Presult == NULL);
     } else if (PyBytes_Check(alphabet)) {
         buflen = count;
         MALLOC(buf, buflen);
-        buf2len = sizeof(unsigned int);
-        MALLOC(buf2, buf2len);
         ptr = PyBytes_AS_STRING(alphabet);
         nitems = (int) PyBytes_GET_SIZE(alphabet);
+        if (nitems == 0)
+            RETURN_ERROR("alphabet cannot be empty");
         for (i=0; i<count; i++) {
-            ret = RAND_bytes((unsigned char *) buf2, buf2len);
+            ret = random_index(nitems, &idx);
             CHECK_OPENSSL_ERROR(ret != 1);
-            buf[i] = ptr[*((unsigned int *) buf2) % nitems];
+            buf[i] = ptr[idx];
         }
         Presult = PyBytes_FromStringAndSize(buf, buflen);
         CHECK_PYTHON_ERROR(Presult == NULL);
     } else if (PyUnicode_Check(alphabet)) {
         buflen = count * (int) sizeof(Py_UNICODE);
         MALLOC(buf, buflen);
-        buf2len = sizeof (unsigned int);
-        MALLOC(buf2, buf2len);
         ptr = (char *) PyUnicode_AS_UNICODE(alphabet);
         nitems = (int) PyUnicode_GET_SIZE(alphabet);
+        if (nitems == 0)
+            RETURN_ERROR("alphabet cannot be empty");
         for (i=0; i<count; i++) {
-            ret = RAND_bytes((unsigned char *) buf2, buf2len);
+            ret = random_index(nitems, &idx);
             CHECK_OPENSSL_ERROR(ret != 1);
-            ((Py_UNICODE *) buf)[i] =
-                    ((Py_UNICODE *) ptr)[*((unsigned int *) buf2) % nitems];
+            ((Py_UNICODE *) buf)[i] = ((Py_UNICODE *) ptr)[idx];
         }
         Presult = PyUnicode_FromUnicode((Py_UNICODE *) buf, count);
         CHECK_PYTHON_ERROR(Presult == NULL);
-    } else if (PySequence_Check(alphabet) && PySequence_Size(alphabet) > 0 &&
-               PyBytes_Check(PySequence_GetItem(alphabet, 0))) {
+    } else if (first != NULL && PyBytes_Check(first)) {
         if (!(separator == NULL || separator == Py_None) &&
                     !PyBytes_Check(separator))
             RETURN_ERROR("separator must be string");
         buflen = count;
         MALLOC(buf, buflen);
-        buf2len = sizeof (unsigned int);
-        MALLOC(buf2, buf2len);
         nitems = (int) PySequence_Size(alphabet);
         if (separator == NULL || separator == Py_None) {
             seplen = 0;
@@ -769,10 +1229,10 @@ openssl_random(PyObject *self, PyObject *args)
             sepptr = PyBytes_AS_STRING(separator);
         }
         for (i=0,offset=0; i<count; i++) {
-            ret = RAND_bytes((unsigned char *) buf2, buf2len);
+            ret = random_index(nitems, &idx);
             CHECK_OPENSSL_ERROR(ret != 1);
-            item = PySequence_GetItem(alphabet,
-                        *((unsigned int *) buf2) % nitems);
+            item = PySequence_GetItem(alphabet, idx);
+            CHECK_PYTHON_ERROR(item == NULL);
             if (!PyBytes_Check(item))
                 RETURN_ERROR("all items in the alphabet must be strings");
             ptr = PyBytes_AS_STRING(item);
@@ -785,18 +1245,16 @@ openssl_random(PyObject *self, PyObject *args)
                 memcpy(buf+offset, sepptr, seplen);
                 offset += seplen;
             }
+            Py_DECREF(item); item = NULL;
         }
         Presult = PyBytes_FromStringAndSize(buf, offset);
         CHECK_PYTHON_ERROR(Presult == NULL);
-    } else if (PySequence_Check(alphabet) && PySequence_Size(alphabet) > 0 &&
-               PyUnicode_Check(PySequence_GetItem(alphabet, 0))) {
+    } else if (first != NULL && PyUnicode_Check(first)) {
         if (!(separator == NULL || separator == Py_None) &&
                     !PyUnicode_Check(separator))
             RETURN_ERROR("separator must be unicode");
         buflen = count * (int) sizeof (Py_UNICODE);
         MALLOC(buf, buflen);
-        buf2len = sizeof (unsigned int);
-        MALLOC(buf2, buf2len);
         nitems = (int) PySequence_Size(alphabet);
         if (separator == NULL || separator == Py_None) {
             seplen = 0;
@@ -806,9 +1264,10 @@ openssl_random(PyObject *self, PyObject *args)
             sepptr = (char *) PyUnicode_AS_UNICODE(separator);
         }
         for (i=0,offset=0; i<count; i++) {
-            ret = RAND_bytes((unsigned char *) buf2, buf2len);
+            ret = random_index(nitems, &idx);
             CHECK_OPENSSL_ERROR(ret != 1);
-            item = PySequence_GetItem(alphabet, *((unsigned int *) buf2) % nitems);
+            item = PySequence_GetItem(alphabet, idx);
+            CHECK_PYTHON_ERROR(item == NULL);
             if (!PyUnicode_Check(item))
                 RETURN_ERROR("all items in the alphabet must be unicode");
             ptr = (char *) PyUnicode_AS_UNICODE(item);
@@ -821,6 +1280,7 @@ openssl_random(PyObject *self, PyObject *args)
                 memcpy(buf+offset, sepptr, seplen);
                 offset += seplen;
             }
+            Py_DECREF(item); item = NULL;
         }
         Presult = PyUnicode_FromUnicode((Py_UNICODE *) buf,
                                         offset / sizeof (Py_UNICODE));
@@ -830,8 +1290,44 @@ openssl_random(PyObject *self, PyObject *args)
                      "string, sequence of unicode, or None");
 
 error:
+    Py_XDECREF(first);
+    Py_XDECREF(item);
     clear_free(buf, buflen);
-    clear_free(buf2, buf2len);
+    return Presult;
+}
+
+static PyObject *
+openssl_randuuid(PyObject *self, PyObject *args)
+{
+    static const char hexdigits[] = "0123456789abcdef";
+    unsigned char rnd[16];
+    char out[36];
+    int i, j, ret;
+    PyObject *Presult = NULL;
+
+    if (!PyArg_ParseTuple(args, ":randuuid"))
+        return NULL;
+
+    ret = random_bytes(rnd, sizeof(rnd));
+    CHECK_OPENSSL_ERROR(ret != 1);
+    rnd[6] = (rnd[6] & 0x0f) | 0x40;  /* version 4 */
+    rnd[8] = (rnd[8] & 0x3f) | 0x80;  /* RFC 4122 variant */
+    for (i=0,j=0; i<16; i++) {
+        if (i == 4 || i == 6 || i == 8 || i == 10)
+            out[j++] = '-';
+        out[j++] = hexdigits[rnd[i] >> 4];
+        out[j++] = hexdigits[rnd[i] & 0x0f];
+    }
+#if PY_MAJOR_VERSION >= 3
+    Presult = PyUnicode_FromStringAndSize(out, sizeof(out));
+#else
+    Presult = PyString_FromStringAndSize(out, sizeof(out));
+#endif
+    CHECK_PYTHON_ERROR(Presult == NULL);
+
+error:
+    memset(rnd, 0, sizeof(rnd));
+    memset(out, 0, sizeof(out));
     return Presult;
 }
 
@@ -914,6 +1410,11 @@ static PyMethodDef openssl_methods[] =
     { "rsa_decrypt", (PyCFunction) openssl_rsa_decrypt, METH_VARARGS },
     { "rsa_sign", (PyCFunction) openssl_rsa_sign, METH_VARARGS },
     { "rsa_verify", (PyCFunction) openssl_rsa_verify, METH_VARARGS },
+    { "ec_genkey", (PyCFunction) openssl_ec_genkey, METH_VARARGS },
+    { "ec_checkkey", (PyCFunction) openssl_ec_checkkey, METH_VARARGS },
+    { "ec_size", (PyCFunction) openssl_ec_size, METH_VARARGS },
+    { "ec_sign", (PyCFunction) openssl_ec_sign, METH_VARARGS },
+    { "ec_verify", (PyCFunction) openssl_ec_verify, METH_VARARGS },
     { "dh_genparams", (PyCFunction) openssl_dh_genparams, METH_VARARGS },
     { "dh_checkparams", (PyCFunction) openssl_dh_checkparams, METH_VARARGS },
     { "dh_size", (PyCFunction) openssl_dh_size, METH_VARARGS },
@@ -924,6 +1425,7 @@ static PyMethodDef openssl_methods[] =
     { "aes_decrypt", (PyCFunction) openssl_aes_decrypt, METH_VARARGS },
     { "pbkdf2", (PyCFunction) openssl_pbkdf2, METH_VARARGS },
     { "random", (PyCFunction) openssl_random, METH_VARARGS },
+    { "randuuid", (PyCFunction) openssl_randuuid, METH_VARARGS },
 #ifdef TEST_BUILD
     { "_insert_random_bytes",
         (PyCFunction) _openssl_insert_random_bytes, METH_VARARGS },
@@ -951,6 +1453,10 @@ MOD_INITFUNC(openssl)
         return MOD_ERROR;
     if (PyDict_SetItemString(Pdict, "Error", openssl_Error) == -1)
         return MOD_ERROR;
+    /* Not fatal if this fails, there is a limited number of slots. */
+    Py_AtExit(random_pool_wipe);
+    /* Without a fork handler the pool could be shared with a child. */
+    random_pool_enabled = pthread_atfork(NULL, NULL, random_pool_wipe) == 0;
 
     return MOD_OK(Pmodule);
 }
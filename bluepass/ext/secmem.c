@@ -8,6 +8,8 @@
  */
 
 #include <Python.h>
+#include <structmember.h>
+#include <stdlib.h>
 #include <string.h>
 #include <unistd.h>
 
@@ -31,6 +33,9 @@ static PyObject *secmem_Error = NULL;
                 PyModuleDef_HEAD_INIT, name, doc, -1, methods, }; \
             mod = PyModule_Create(&moduledef); \
         } while (0)
+#  define PyInt_Check PyLong_Check
+#  define PyInt_AsSsize_t PyLong_AsSsize_t
+#  define PyString_FromFormat PyUnicode_FromFormat
 #else
 #  define MOD_OK(value)
 #  define MOD_ERROR
@@ -40,10 +45,415 @@ static PyObject *secmem_Error = NULL;
 #endif
 
 
+/*
+ * Secure arena.
+ *
+ * The arena consists of memory regions that are locked into memory once, and
+ * from which small blocks for key material are allocated. This means that we
+ * need just one mlock() call per region instead of one per secret, and that
+ * secrets are not spread out over the Python heap. A new region is added when
+ * the current one is full, up to ARENA_MAX_REGIONS regions.
+ *
+ * Blocks are allocated in power of two size classes from 32 to 4096 bytes.
+ * Each size class has its own free list. Blocks are zeroed when they are
+ * freed. Requests that are larger than the biggest size class, or that do not
+ * fit in the arena anymore, fall back to calloc(). Such blocks are still
+ * zeroed on free, but they are not locked. The first fallback of each kind,
+ * and the first region that could not be locked, are logged to the
+ * "bluepass.secmem" logger. The number of fallbacks is in arena_stats().
+ */
+
+#define ARENA_REGION_SIZE (256*1024)
+#define ARENA_MAX_REGIONS 64
+#define ARENA_MIN_SHIFT 5
+#define ARENA_MAX_SHIFT 12
+#define ARENA_NCLASSES (ARENA_MAX_SHIFT - ARENA_MIN_SHIFT + 1)
+
+typedef struct _arena_block {
+    struct _arena_block *next;
+} arena_block;
+
+static struct {
+    char *regions[ARENA_MAX_REGIONS];
+    int nregions;
+    char *base;
+    size_t top;
+    size_t size;
+    size_t allocated;
+    size_t inuse;
+    size_t fallbacks;
+    int locked;
+    int warned_large;
+    int warned_full;
+    int warned_lock;
+    arena_block *freelist[ARENA_NCLASSES];
+} arena = { { NULL }, 0, NULL, 0, 0, 0, 0, 0, 1 };
+
+/* Log a warning to the "bluepass.secmem" logger. Errors are ignored. */
+
+static void
+arena_warning(const char *message)
+{
+    PyObject *Pmodule, *Plogger, *Pret;
+
+    if ((Pmodule = PyImport_ImportModule("logging")) == NULL)
+        goto error;
+    Plogger = PyObject_CallMethod(Pmodule, "getLogger", "s", "bluepass.secmem");
+    Py_DECREF(Pmodule);
+    if (Plogger == NULL)
+        goto error;
+    Pret = PyObject_CallMethod(Plogger, "warning", "s", message);
+    Py_DECREF(Plogger);
+    Py_XDECREF(Pret);
+
+error:
+    PyErr_Clear();
+}
+
 #if defined(__linux__) || defined(__APPLE__)
 
 #include <sys/mman.h>
 
+static char *
+arena_map_region(int *locked)
+{
+    void *base;
+
+    base = mmap(NULL, ARENA_REGION_SIZE, PROT_READ|PROT_WRITE,
+                MAP_PRIVATE|MAP_ANON, -1, 0);
+    if (base == MAP_FAILED)
+        return NULL;
+    *locked = mlock(base, ARENA_REGION_SIZE) == 0;
+#ifdef MADV_DONTDUMP
+    madvise(base, ARENA_REGION_SIZE, MADV_DONTDUMP);
+#endif
+    return base;
+}
+
+#else
+
+static char *
+arena_map_region(int *locked)
+{
+    *locked = 0;
+    return calloc(1, ARENA_REGION_SIZE);
+}
+
+#endif
+
+/* Add a new region to the arena. Return 0 on success, -1 on failure. */
+
+static int
+arena_grow(void)
+{
+    char *base;
+    int locked;
+
+    if (arena.nregions == ARENA_MAX_REGIONS)
+        return -1;
+    if ((base = arena_map_region(&locked)) == NULL)
+        return -1;
+    if (!locked && !arena.warned_lock) {
+        arena_warning("could not lock secure memory region, secrets may be "
+                      "swapped out (check RLIMIT_MEMLOCK)");
+        arena.warned_lock = 1;
+    }
+    arena.regions[arena.nregions++] = base;
+    arena.base = base;
+    arena.top = 0;
+    arena.size += ARENA_REGION_SIZE;
+    arena.locked = arena.locked && locked;
+    return 0;
+}
+
+/* Return the size class for `size`, or -1 if it is too big. */
+
+static int
+arena_class(size_t size)
+{
+    int cls = 0;
+
+    while (((size_t) 1 << (cls + ARENA_MIN_SHIFT)) < size)
+        cls++;
+    return cls < ARENA_NCLASSES ? cls : -1;
+}
+
+/* Allocate `size` bytes. Return NULL if out of memory. The size class that
+ * was used is stored in `cls`, and -1 if the block came from calloc(). */
+
+static char *
+arena_alloc(size_t size, int *cls)
+{
+    size_t blocksize;
+    arena_block *block;
+
+    *cls = arena_class(size);
+    if (*cls >= 0) {
+        blocksize = (size_t) 1 << (*cls + ARENA_MIN_SHIFT);
+        if ((block = arena.freelist[*cls]) != NULL) {
+            arena.freelist[*cls] = block->next;
+            block->next = NULL;
+            arena.inuse += blocksize;
+            return (char *) block;
+        }
+        if ((arena.base != NULL
+                    && arena.top + blocksize <= ARENA_REGION_SIZE)
+                || arena_grow() == 0) {
+            block = (arena_block *) (arena.base + arena.top);
+            arena.top += blocksize;
+            arena.allocated += blocksize;
+            arena.inuse += blocksize;
+            return (char *) block;
+        }
+    }
+    arena.fallbacks++;
+    if (*cls < 0 && !arena.warned_large) {
+        arena_warning("secret too large for the secure arena, "
+                      "using unlocked memory");
+        arena.warned_large = 1;
+    } else if (*cls >= 0 && !arena.warned_full) {
+        arena_warning("secure arena is full, using unlocked memory");
+        arena.warned_full = 1;
+    }
+    *cls = -1;
+    return calloc(1, size ? size : 1);
+}
+
+/* Zero and free a block of `size` bytes allocated from size class `cls`. */
+
+static void
+arena_free(char *ptr, size_t size, int cls)
+{
+    size_t blocksize;
+    arena_block *block;
+
+    if (ptr == NULL)
+        return;
+    if (cls < 0) {
+        memset(ptr, 0, size);
+        free(ptr);
+        return;
+    }
+    blocksize = (size_t) 1 << (cls + ARENA_MIN_SHIFT);
+    memset(ptr, 0, blocksize);
+    block = (arena_block *) ptr;
+    block->next = arena.freelist[cls];
+    arena.freelist[cls] = block;
+    arena.inuse -= blocksize;
+}
+
+
+/*
+ * SecureBuffer: a fixed size, mutable, bytes-like object that stores its data
+ * in the secure arena. It exports the buffer interface so that it can be
+ * passed without copying to functions that accept strings, such as the ones
+ * in the openssl extension. The data is zeroed when the buffer is deallocated.
+ */
+
+typedef struct {
+    PyObject_HEAD
+    char *data;
+    Py_ssize_t size;
+    Py_ssize_t capacity;
+    int cls;
+} SecureBuffer;
+
+static PyTypeObject SecureBuffer_Type;
+
+static PyObject *
+SecureBuffer_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    Py_ssize_t size;
+    char *init = NULL;
+    int initlen;
+    PyObject *Parg;
+    SecureBuffer *self = NULL;
+
+    if (!PyArg_ParseTuple(args, "O:SecureBuffer", &Parg))
+        return NULL;
+    if (PyLong_Check(Parg) || PyInt_Check(Parg)) {
+        size = PyInt_AsSsize_t(Parg);
+        if (size == -1 && PyErr_Occurred())
+            return NULL;
+        if (size < 0)
+            RETURN_ERROR("size must be >= 0");
+    } else {
+        if (!PyArg_ParseTuple(args, "s#:SecureBuffer", &init, &initlen))
+            return NULL;
+        size = initlen;
+    }
+
+    self = (SecureBuffer *) type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+    self->data = arena_alloc(size, &self->cls);
+    if (self->data == NULL) {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+    self->size = self->capacity = size;
+    if (init != NULL)
+        memcpy(self->data, init, size);
+    return (PyObject *) self;
+
+error:
+    return NULL;
+}
+
+static void
+SecureBuffer_dealloc(SecureBuffer *self)
+{
+    arena_free(self->data, self->capacity, self->cls);
+    self->data = NULL;
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static PyObject *
+SecureBuffer_repr(SecureBuffer *self)
+{
+    return PyString_FromFormat("<SecureBuffer size=%zd>", self->size);
+}
+
+static Py_ssize_t
+SecureBuffer_length(SecureBuffer *self)
+{
+    return self->size;
+}
+
+static PyObject *
+SecureBuffer_wipe(SecureBuffer *self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ":wipe"))
+        return NULL;
+    memset(self->data, 0, self->capacity);
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *
+SecureBuffer_truncate(SecureBuffer *self, PyObject *args)
+{
+    Py_ssize_t size;
+
+    if (!PyArg_ParseTuple(args, "n:truncate", &size))
+        return NULL;
+    if (size < 0 || size > self->size)
+        RETURN_ERROR("illegal size: %zd", size);
+    memset(self->data + size, 0, self->size - size);
+    self->size = size;
+    Py_INCREF(Py_None);
+    return Py_None;
+
+error:
+    return NULL;
+}
+
+#if PY_MAJOR_VERSION < 3
+
+static Py_ssize_t
+SecureBuffer_getreadbuf(SecureBuffer *self, Py_ssize_t segment, void **ptr)
+{
+    if (segment != 0) {
+        PyErr_SetString(PyExc_SystemError, "accessing non-existent segment");
+        return -1;
+    }
+    *ptr = self->data;
+    return self->size;
+}
+
+static Py_ssize_t
+SecureBuffer_getsegcount(SecureBuffer *self, Py_ssize_t *lenp)
+{
+    if (lenp != NULL)
+        *lenp = self->size;
+    return 1;
+}
+
+static Py_ssize_t
+SecureBuffer_getcharbuf(SecureBuffer *self, Py_ssize_t segment, char **ptr)
+{
+    return SecureBuffer_getreadbuf(self, segment, (void **) ptr);
+}
+
+#endif
+
+/* No bf_releasebuffer: Python 2 does not accept objects that have one for
+ * "s#" arguments. The buffer never moves, so there is nothing to release. */
+
+static int
+SecureBuffer_getbuffer(SecureBuffer *self, Py_buffer *view, int flags)
+{
+    return PyBuffer_FillInfo(view, (PyObject *) self, self->data,
+                             self->size, 0, flags);
+}
+
+static PySequenceMethods SecureBuffer_as_sequence = {
+    (lenfunc) SecureBuffer_length,
+};
+
+static PyBufferProcs SecureBuffer_as_buffer = {
+#if PY_MAJOR_VERSION < 3
+    (readbufferproc) SecureBuffer_getreadbuf,
+    (writebufferproc) SecureBuffer_getreadbuf,
+    (segcountproc) SecureBuffer_getsegcount,
+    (charbufferproc) SecureBuffer_getcharbuf,
+#endif
+    (getbufferproc) SecureBuffer_getbuffer,
+    NULL
+};
+
+static PyMethodDef SecureBuffer_methods[] = {
+    { "wipe", (PyCFunction) SecureBuffer_wipe, METH_VARARGS },
+    { "truncate", (PyCFunction) SecureBuffer_truncate, METH_VARARGS },
+    { NULL, NULL }
+};
+
+PyDoc_STRVAR(SecureBuffer_doc,
+"SecureBuffer(size_or_string)\n\n"
+"A fixed size buffer for secrets that lives in locked memory.");
+
+static PyTypeObject SecureBuffer_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "secmem.SecureBuffer",
+    sizeof(SecureBuffer),
+    0,
+    (destructor) SecureBuffer_dealloc,
+    0, 0, 0, 0,
+    (reprfunc) SecureBuffer_repr,
+    0,
+    &SecureBuffer_as_sequence,
+    0, 0, 0, 0, 0, 0,
+    &SecureBuffer_as_buffer,
+#if PY_MAJOR_VERSION < 3
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+#else
+    Py_TPFLAGS_DEFAULT,
+#endif
+    SecureBuffer_doc,
+    0, 0, 0, 0, 0, 0,
+    SecureBuffer_methods,
+    0, 0, 0, 0, 0, 0, 0, 0, 0,
+    SecureBuffer_new,
+};
+
+static PyObject *
+secmem_arena_stats(PyObject *self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ":arena_stats"))
+        return NULL;
+    return Py_BuildValue("{s:n,s:n,s:n,s:n,s:i,s:O}",
+                         "size", (Py_ssize_t) arena.size,
+                         "allocated", (Py_ssize_t) arena.allocated,
+                         "inuse", (Py_ssize_t) arena.inuse,
+                         "fallbacks", (Py_ssize_t) arena.fallbacks,
+                         "regions", arena.nregions,
+                         "locked", arena.nregions && arena.locked
+                                        ? Py_True : Py_False);
+}
+
+
+#if defined(__linux__) || defined(__APPLE__)
+
 static PyObject *
 secmem_lock(PyObject *self, PyObject *args)
 {
@@ -189,6 +599,7 @@ static PyMethodDef secmem_methods[] =
     { "unlock", (PyCFunction) secmem_unlock, METH_VARARGS },
     { "wipe", (PyCFunction) secmem_wipe, METH_VARARGS },
     { "disable_ptrace", (PyCFunction) secmem_disable_ptrace, METH_VARARGS },
+    { "arena_stats", (PyCFunction) secmem_arena_stats, METH_VARARGS },
     { NULL, NULL }
 };
 
@@ -206,6 +617,12 @@ MOD_INITFUNC(secmem)
         return MOD_ERROR;
     if (PyDict_SetItemString(Pdict, "Error", secmem_Error) == -1)
         return MOD_ERROR;
+    if (PyType_Ready(&SecureBuffer_Type) < 0)
+        return MOD_ERROR;
+    Py_INCREF(&SecureBuffer_Type);
+    if (PyDict_SetItemString(Pdict, "SecureBuffer",
+                             (PyObject *) &SecureBuffer_Type) == -1)
+        return MOD_ERROR;
 
     return MOD_OK(Pmodule);
 }
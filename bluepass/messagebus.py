@@ -6,8 +6,10 @@
 # version 3. See the file LICENSE distributed with this file for the exact
 # licensing terms.
 
+import re
 import sys
 import socket
+import collections
 import inspect
 import traceback
 from fnmatch import fnmatch
@@ -23,7 +25,7 @@ from bluepass.util import base64, json, logging
 
 __all__ = ('MessageBusError', 'MessageBusConnectionBase',
            'MessageBusConnection', 'MessageBusHandler', 'MessageBusServer',
-           'method', 'signal_handler')
+           'MessageFramer', 'method', 'signal_handler')
 
 
 class MessageBusError(StructuredError):
@@ -32,35 +34,132 @@ class MessageBusError(StructuredError):
 
 s_preamble, s_object, s_string, s_string_escape = range(4)
 
-def find_message_end(buf):
-    """Find the end of a JSON-RPC message."""
-    state = s_preamble
-    depth = 0
-    for i in range(len(buf)):
-        ch = buf[i]
-        if state == s_preamble:
-            if ch == '{':
-                state = s_object
-                depth = 1
-            elif not ch.isspace():
-                raise ValueError
-        elif state == s_object:
-            if ch == '{':
-                depth += 1
-            elif ch == '}':
-                depth -= 1
-            elif ch == '"':
+_re_whitespace = re.compile(br'\s*')
+_re_length = re.compile(br'(\d{1,10}):')
+_re_object = re.compile(br'[{}"]')
+_re_string = re.compile(br'["\\]')
+
+
+class MessageFramer(object):
+    """Split a stream of bytes into JSON-RPC messages.
+
+    Two framings are supported. A message is either a bare JSON object, in
+    which case its end is found by tracking the nesting of braces and
+    strings, or it is prefixed by its length in bytes as a decimal number
+    followed by a colon. The framing is detected per message.
+
+    The framer keeps its scanning state between calls to feed(), so every
+    byte is looked at only once, regardless of how the messages are split
+    over the reads. Runs of bytes that do not affect the state are skipped
+    with a regular expression, rather than one character at a time.
+    """
+
+    def __init__(self, max_message_size=None):
+        self.max_message_size = max_message_size
+        self.buffer = bytearray()
+        self.start = 0
+        self.pos = 0
+        self.state = s_preamble
+        self.depth = 0
+        self.length = None
+
+    def __len__(self):
+        """Return the size of the current, incomplete message."""
+        return len(self.buffer) - self.start
+
+    def feed(self, data):
+        """Add `data` to the buffer."""
+        self.buffer += data
+
+    def _emit(self, start, end):
+        """Return the message in buffer[start:end] and reset the state."""
+        message = bytes(self.buffer[start:end])
+        self.start = self.pos = end
+        self.state = s_preamble
+        self.length = None
+        return message
+
+    def next_message(self):
+        """Return the next complete message, or None if there is none yet.
+
+        A ValueError is raised if the input is not a valid stream of
+        messages.
+        """
+        buf = self.buffer
+        size = len(buf)
+        pos = self.pos
+        state = self.state
+        depth = self.depth
+        message = None
+        while pos < size and message is None:
+            if state == s_preamble:
+                pos = _re_whitespace.match(buf, pos).end()
+                self.start = pos
+                if pos == size:
+                    break
+                ch = buf[pos]
+                if ch == ord('{'):
+                    state = s_object
+                    depth = 1
+                    pos += 1
+                    continue
+                if not chr(ch).isdigit():
+                    raise ValueError('expecting a message')
+                match = _re_length.match(buf, pos)
+                if match is None:
+                    if size - pos > 11 or not bytes(buf[pos:]).isdigit():
+                        raise ValueError('illegal length prefix')
+                    break
+                length = int(match.group(1))
+                if self.max_message_size and length > self.max_message_size:
+                    raise ValueError('message too large')
+                if match.end() + length > size:
+                    break  # pos stays at the prefix
+                self.pos = pos
+                message = self._emit(match.end(), match.end() + length)
+                pos = self.pos
+            elif state == s_object:
+                match = _re_object.search(buf, pos)
+                if match is None:
+                    pos = size
+                    break
+                pos = match.end()
+                ch = buf[match.start()]
+                if ch == ord('{'):
+                    depth += 1
+                elif ch == ord('}'):
+                    depth -= 1
+                    if depth == 0:
+                        message = self._emit(self.start, pos)
+                else:
+                    state = s_string
+            elif state == s_string:
+                match = _re_string.search(buf, pos)
+                if match is None:
+                    pos = size
+                    break
+                pos = match.end()
+                if buf[match.start()] == ord('"'):
+                    state = s_object
+                else:
+                    state = s_string_escape
+            elif state == s_string_escape:
+                pos += 1
                 state = s_string
-        elif state == s_string:
-            if ch == '"':
-                state = s_object
-            elif ch == '\\':
-                state = s_string_escape
-        elif state == s_string_escape:
-            state = s_string
-        if state == s_object and depth == 0:
-            return i
-    return -1
+        if message is None:
+            self.pos = pos
+            self.state = state
+            self.depth = depth
+        self._compact()
+        return message
+
+    def _compact(self):
+        """Remove consumed bytes from the front of the buffer."""
+        start = self.start
+        if start and (start == len(self.buffer) or start >= 65536):
+            del self.buffer[:start]
+            self.pos -= start
+            self.start = 0
 
 
 class MessageBusConnectionBase(object):
@@ -73,6 +172,16 @@ class MessageBusConnectionBase(object):
     timeout = 30
     max_message_size = 1024000
     max_incoming_messages = 100
+    # The framing of outgoing messages: "json" for bare JSON objects, or
+    # "length" for length prefixed messages. The latter requires a peer
+    # that uses MessageFramer. Incoming messages may use either framing.
+    framing = 'json'
+    # Outgoing messages are serialized without whitespace, unless `indent`
+    # is set, which can be useful for debugging.
+    indent = None
+    # The maximum number of bytes of queued messages that are coalesced
+    # into a single send().
+    write_size = 65536
 
     Loop = None
     Local = type('Object', (object,), {})
@@ -112,8 +221,10 @@ class MessageBusConnectionBase(object):
                                                   self._do_read)
         self._write_event = self.loop.create_watch(socket, self.loop.WRITE,
                                                    self._do_write)
-        self._inbuf = self._outbuf = ''
-        self._incoming = []; self._outgoing = []
+        self._framer = MessageFramer(self.max_message_size)
+        self._outbuf = memoryview(b'')
+        self._incoming = collections.deque()
+        self._outgoing = collections.deque()
         self._reading = self._writing = True
 
     def set_trace(self, tracefile):
@@ -154,16 +265,21 @@ class MessageBusConnectionBase(object):
         """Read messages from the socket and put them into the incoming queue
         until nothing more can be read."""
         logger = self.logger
+        framer = self._framer
         while True:
-            while self._inbuf:
-                pos = find_message_end(self._inbuf)
-                if pos == -1:
-                    break
-                self._incoming.append(self._inbuf[:pos+1])
-                if self.tracefile is not None:
-                    self._do_trace(self._incoming[-1], True)
-                self._inbuf = self._inbuf[pos+1:]
-            if len(self._inbuf) > self.max_message_size:
+            try:
+                while True:
+                    message = framer.next_message()
+                    if message is None:
+                        break
+                    self._incoming.append(message)
+                    if self.tracefile is not None:
+                        self._do_trace(message, True)
+            except ValueError as e:
+                logger.error('illegal incoming data: %s', str(e))
+                self.close()
+                break
+            if len(framer) > self.max_message_size:
                 logger.debug('incoming message too large, closing connection')
                 self.close()
                 break
@@ -184,20 +300,55 @@ class MessageBusConnectionBase(object):
                 logger.error('peer disconnected')
                 self.close()
                 break
-            self._inbuf += buf.decode('ascii')
+            framer.feed(buf)
         if self._incoming:
             self.loop.create_callback(self.dispatch)
 
+    def _next_buffer(self):
+        """Return a memoryview of the next data to send from the outgoing
+        queue.
+
+        Small messages are coalesced into a buffer of up to `write_size`
+        bytes, so that a burst of messages needs only a few send() calls.
+        A message of `write_size` bytes or more is sent directly from the
+        queued string, which may be shared with other connections, so that
+        it is not copied.
+        """
+        outgoing = self._outgoing
+        header, message = outgoing[0]
+        if len(message) >= self.write_size:
+            if header:
+                outgoing[0] = (b'', message)
+                return memoryview(header)
+            outgoing.popleft()
+            if self.tracefile is not None:
+                self._do_trace(message, False)
+            return memoryview(message)
+        chunk = []; size = 0
+        while outgoing and size < self.write_size:
+            header, message = outgoing[0]
+            if len(message) >= self.write_size:
+                break
+            outgoing.popleft()
+            if self.tracefile is not None:
+                self._do_trace(message, False)
+            chunk.append(header)
+            chunk.append(message)
+            size += len(header) + len(message)
+        return memoryview(b''.join(chunk))
+
     def _do_write(self):
         """Drain message from the outgoing queue until we would block or until
-        the queue is empty."""
+        the queue is empty.
+
+        A partial send advances a memoryview rather than copying the rest of
+        the buffer.
+        """
         while True:
             if not self._outbuf:
                 if not self._outgoing:
                     break
-                if self.tracefile is not None:
-                    self._do_trace(self._outgoing[0], False)
-                self._outbuf = self._outgoing.pop(0).encode('ascii')
+                self._outbuf = self._next_buffer()
             try:
                 nbytes = self.socket.send(self._outbuf)
             except socket.error as e:
@@ -243,12 +394,34 @@ class MessageBusConnectionBase(object):
         self.closed = True
         self._run_callbacks('ConnectionClosed', self)
 
-    def push_outgoing(self, message):
-        """Push a message onto the outgoing queue."""
+    def serialize(self, message):
+        """Serialize a message for this connection. The result is a byte
+        string."""
         if not isinstance(message, dict):
             raise TypeError('expecting a dictionary')
-        serialized = json.dumps(message, indent=2)
-        self._outgoing.append(serialized)
+        if self.indent is None:
+            serialized = json.dumps(message, separators=(',', ':'))
+        else:
+            serialized = json.dumps(message, indent=self.indent)
+        if not isinstance(serialized, bytes):
+            serialized = serialized.encode('ascii')
+        return serialized
+
+    def push_outgoing(self, message):
+        """Push a message onto the outgoing queue."""
+        self.push_serialized(self.serialize(message))
+
+    def push_serialized(self, serialized):
+        """Push an already serialized message onto the outgoing queue.
+
+        The serialized message is queued as is and is not copied, so that the
+        same string can be shared between connections. Any framing is kept
+        separately.
+        """
+        header = b''
+        if self.framing == 'length':
+            header = ('%d:' % len(serialized)).encode('ascii')
+        self._outgoing.append((header, serialized))
         if not self.closed and not self._writing:
             self.loop.enable_watch(self._write_event)
             self._writing = True
@@ -258,7 +431,7 @@ class MessageBusConnectionBase(object):
         message is available."""
         if not self._incoming:
             return
-        serialized = self._incoming.pop(0)
+        serialized = self._incoming.popleft()
         message = json.try_loads(serialized, dict)
         if message is None or not self.check_message(message):
             self.logger.error('invalid input message')
@@ -593,6 +766,7 @@ class MessageBusServer(StreamServer):
         self.tracefile = None
         self.callbacks = []
         self.connections = []
+        self.subscriptions = {}
         self.client_count = 0
         self.next_serial = 1
         def handle_connection(socket, address):
@@ -621,6 +795,7 @@ class MessageBusServer(StreamServer):
         """Callback for client events."""
         if event == 'ConnectionClosed':
             self.connections.remove(args[0])
+            self.subscriptions.pop(args[0], None)
         self._run_callbacks(event, *args)
         if len(self.connections) == 0:
             self._run_callbacks('LastConnectionClosed')
@@ -637,12 +812,67 @@ class MessageBusServer(StreamServer):
             if fnmatch(connection.peer_name, name):
                 return connection
 
-    def send_signal(self, client, name, *args):
+    def subscribe(self, connection, signals, vaults=None):
+        """Subscribe `connection` to the signals in `signals`.
+
+        A connection without subscriptions receives all signals. Once it has
+        subscribed, it receives only the signals it subscribed to. Signal
+        names may contain fnmatch() style wildcards. If `vaults` is provided,
+        it must be a sequence of vault UUIDs, and signals that relate to other
+        vaults are not sent.
+        """
+        subscriptions = self.subscriptions.setdefault(connection, {})
+        for name in signals:
+            subscriptions[name] = None if vaults is None else set(vaults)
+
+    def unsubscribe(self, connection, signals=None):
+        """Unsubscribe `connection` from the signals in `signals`, or from all
+        signals if `signals` is not provided."""
+        if signals is None:
+            self.subscriptions[connection] = {}
+            return
+        subscriptions = self.subscriptions.setdefault(connection, {})
+        for name in signals:
+            subscriptions.pop(name, None)
+
+    def is_subscribed(self, connection, name, vault=None):
+        """Return whether `connection` is subscribed to signal `name` for
+        vault `vault`."""
+        subscriptions = self.subscriptions.get(connection)
+        if subscriptions is None:
+            return True
+        for pattern, vaults in subscriptions.items():
+            if not fnmatch(name, pattern):
+                continue
+            if vault is None or vaults is None or vault in vaults:
+                return True
+        return False
+
+    def send_signal(self, client, name, *args, **kwargs):
         """Emit a signal to one or all connected clients. The `client` argument
-        may contain fnmatch() style wildcards."""
+        may contain fnmatch() style wildcards.
+
+        The `vault` keyword argument, if provided, is the UUID of the vault
+        that the signal relates to. It is used to filter the signal against
+        the subscriptions of each client. Filtering happens before the signal
+        is serialized, so clients that are not subscribed cost nothing.
+
+        The signal is serialized only once, and the same string is queued on
+        every matching connection.
+        """
+        vault = kwargs.get('vault')
+        message = { 'jsonrpc': '2.0' }
+        message['method'] = name
+        message['params'] = args
+        serialized = {}
         for connection in self.connections:
-            if client is None or fnmatch(connection.peer_name, client):
-                connection.send_signal(name, *args)
+            if client is not None and not fnmatch(connection.peer_name, client):
+                continue
+            if not self.is_subscribed(connection, name, vault):
+                continue
+            if connection.indent not in serialized:
+                serialized[connection.indent] = connection.serialize(message)
+            connection.push_serialized(serialized[connection.indent])
 
     def call_method(self, client, name, *args, **kwargs):
         """Performs a method call to one or all clients. In case the
@@ -9,11 +9,10 @@
 import time
 import math
 import logging
-import itertools
 import socket
 
 from bluepass.error import StructuredError
-from bluepass.crypto import CryptoProvider, CryptoError
+from bluepass.crypto import CryptoProvider, CryptoError, SecureBuffer
 from bluepass.util import json, base64
 from bluepass.util.uuid import check_uuid4
 from bluepass.util.selfpipe import SelfPipeEvent
@@ -28,6 +27,20 @@ class ModelError(StructuredError):
     """Model error."""
 
 
+# Signature algorithm that is used for each type of sign key. A signature is
+# only accepted if its algorithm matches the type of the key that verifies it.
+signature_algos = { 'rsa': 'rsa-pss-sha256', 'ec': 'ecdsa-sha256' }
+
+# Payload encryption algorithms, mapped to the AES mode and IV size to use.
+payload_algos = { 'aes-cbc-pkcs7': ('cbc-pkcs7', 16), 'aes-gcm': ('gcm', 12) }
+
+# Optional features supported by this node. These are not part of our
+# certificates, as older nodes reject certificates with unknown fields.
+# Instead they are advertised in the syncapi, and the features of each peer
+# are stored in its sync state.
+node_features = ['aes-gcm']
+
+
 class Model(object):
     """This class implements our vault/item model on top of our database."""
 
@@ -39,7 +52,9 @@ class Model(object):
         self.logger = logging.getLogger('bluepass.model')
         self._next_seqnr = {}
         self._private_keys = {}
+        self._auth_keys = {}
         self._trusted_certs = {}
+        self._peer_features = {}
         self._version_cache = {}
         self._linear_history = {}
         self._full_history = {}
@@ -62,6 +77,10 @@ class Model(object):
             db.create_index('items', '$origin$node', 'TEXT', False)
             db.create_index('items', '$origin$seqnr', 'INT', False)
             db.create_index('items', '$payload$_type', 'TEXT', False)
+        if 'peers' not in db.tables:
+            db.create_table('peers')
+            db.create_index('peers', '$vault', 'TEXT', False)
+            db.create_index('peers', '$node', 'TEXT', False)
 
     def check_vault(self, vault):
         """Check a vault for consistency."""
@@ -91,7 +110,7 @@ class Model(object):
             return False, 'Vault name too long (max = 100 characters)'
         if not check_uuid4(u[2]):
             return False, 'Illegal node UUID "%s"' % u[2]
-        if u[3] != 'rsa':
+        if u[3] not in signature_algos:
             return False, 'Unknown key type "%s" for sign key' % u[3]
         if not base64.check(u[4]):
             return False, 'Invalid base64 for private sign key'
@@ -160,7 +179,7 @@ class Model(object):
             return False, 'Illegal origin node UUID'
         if u[5] not in ('Certificate', 'EncryptedItem'):
             return False, 'Unknown payload type "%s"' % u[5]
-        if u[6] != 'rsa-pss-sha256':
+        if u[6] not in signature_algos.values():
             return False, 'Unkown signature algo "%s"' % u[6]
         if not base64.check(u[7]):
             return False, 'Illegal base64 for signature'
@@ -193,7 +212,7 @@ class Model(object):
             return False, 'Name too long (max = 100 characters)'
         if not base64.check(u[5]):
             return False, 'Invalid base64 for sign key'
-        if u[6] != 'rsa':
+        if u[6] not in signature_algos:
             return False, 'Unknown key type "%s" for sign key' % u[6]
         if not base64.check(u[7]):
             return False, 'Invalid base64 for encrypt key'
@@ -215,7 +234,7 @@ class Model(object):
             return False, str(e)
         assert check_uuid4(u[0])
         assert u[1] == 'EncryptedItem'
-        if u[2] != 'aes-cbc-pkcs7':
+        if u[2] not in payload_algos:
             return False, 'Unknown algo "%s"' % u[2]
         if not base64.check(u[3]):
             return False, 'Invalid base64 for IV'
@@ -283,6 +302,7 @@ class Model(object):
         self._version_cache[uuid] = {}
         self._linear_history[uuid] = {}
         self._full_history[uuid] = {}
+        self._load_peer_features(uuid)
         seqnr = self.database.execute('items', """
                 SELECT MAX($origin$seqnr)
                 FROM items
@@ -311,39 +331,45 @@ class Model(object):
         logger.debug('successfully loaded %d vaults, %d vaults had errors',
                      total-errors, errors)
 
-    def _verify_signature(self, item, pubkey):
-        """Verify the signature on an item."""
+    def _verify_signature(self, item, pubkey, keytype='rsa'):
+        """Verify the signature on an item using the sign key `pubkey`
+        which is of type `keytype`."""
         assert self.check_item(item)[0]
         log = self.logger
-        signature = item.pop('signature')
-        if signature['algo'] != 'rsa-pss-sha256':
-            log.error('unknown signature algo "%s" for item "%s"',
-                      algo, item['id'])
+        algo = item['signature']['algo']
+        if algo != signature_algos.get(keytype):
+            log.error('signature algo "%s" does not match key type "%s" '
+                      'for item "%s"', algo, keytype, item['id'])
             return False
+        signature = item.pop('signature')
         message = json.dumps_c14n(item)
+        item['signature'] = signature
         blob = base64.decode(signature['blob'])
         try:
-            status = self.crypto.rsa_verify(message, blob, pubkey, 'pss-sha256')
+            if keytype == 'ec':
+                status = self.crypto.ec_verify(message, blob, pubkey, 'sha256')
+            else:
+                status = self.crypto.rsa_verify(message, blob, pubkey, 'pss-sha256')
         except CryptoError:
             log.error('garbage in signature for item "%s"', item['id'])
             return False
         if not status:
             log.error('invalid signature for item "%s"', item['id'])
             return False
-        item['signature'] = signature
         return True
 
-    def __collect_certs(self, node, nodekey, certs, result, depth):
+    def __collect_certs(self, node, nodekey, keytype, certs, result, depth):
         """Collect valid certificates."""
         if node not in certs:
             return
         result[node] = []
         for cert in certs[node]:
-            if not self._verify_signature(cert, nodekey):
+            if not self._verify_signature(cert, nodekey, keytype):
                 continue
             synconly = cert['payload'].get('restrictions', {}).get('synconly', False)
             subject = cert['payload']['node']
             subjkey = base64.decode(cert['payload']['keys']['sign']['key'])
+            subjtype = cert['payload']['keys']['sign']['keytype']
             if node == subject:
                 # self-signed certificate
                 result[node].append((depth+1+synconly*100, cert))
@@ -356,7 +382,8 @@ class Model(object):
             if synconly:
                 # Synconly certs are not allowed to sign items
                 continue
-            self.__collect_certs(subject, subjkey, certs, result, depth+2)
+            self.__collect_certs(subject, subjkey, subjtype, certs, result,
+                                 depth+2)
 
     def _calculate_trust(self, vault):
         """Calculate a list of trusted certificates."""
@@ -377,8 +404,9 @@ class Model(object):
         # a valid certificate that does not have the "synconly" option.
         node = self.vaults[vault]['node']
         nodekey = base64.decode(self.vaults[vault]['keys']['sign']['public'])
+        keytype = self.vaults[vault]['keys']['sign']['keytype']
         result = {}
-        self.__collect_certs(node, nodekey, certs, result, 0)
+        self.__collect_certs(node, nodekey, keytype, certs, result, 0)
         trusted_certs = {}
         for signer in result:
             for cert in result[signer]:
@@ -539,11 +567,15 @@ class Model(object):
         """Add a signature to an item."""
         assert vault in self.vaults
         assert vault in self._private_keys
+        keytype = self.vaults[vault]['keys']['sign']['keytype']
         signature = {}
-        signature['algo'] = 'rsa-pss-sha256'
+        signature['algo'] = signature_algos[keytype]
         message = json.dumps_c14n(item)
         signkey = self._private_keys[vault][0]
-        blob = self.crypto.rsa_sign(message, signkey, padding='pss-sha256')
+        if keytype == 'ec':
+            blob = self.crypto.ec_sign(message, signkey, hash='sha256')
+        else:
+            blob = self.crypto.rsa_sign(message, signkey, padding='pss-sha256')
         signature['blob'] = base64.encode(blob)
         item['signature'] = signature
 
@@ -560,32 +592,40 @@ class Model(object):
         if synconly:
             return False  # synconly certs may not sign items
         pubkey = base64.decode(cert['keys']['sign']['key'])
-        return self._verify_signature(item, pubkey)
+        keytype = cert['keys']['sign']['keytype']
+        return self._verify_signature(item, pubkey, keytype)
 
     def _encrypt_item(self, vault, item):
         """INTERNAL: Encrypt an item."""
         assert vault in self.vaults
         assert vault in self._private_keys
         crypto = self.crypto
+        # Encrypt to all nodes in the vault including ourselves, but not to
+        # "synconly" nodes. AES-GCM is used only if all of them support it.
+        recipients = {}
+        for node in self._trusted_certs[vault]:
+            cert = self._trusted_certs[vault][node][0]['payload']
+            if not cert.get('restrictions', {}).get('synconly'):
+                recipients[node] = cert
+        algo = 'aes-gcm'
+        for node in recipients:
+            if not self.node_has_feature(vault, node, 'aes-gcm'):
+                algo = 'aes-cbc-pkcs7'
+                break
+        mode, ivsize = payload_algos[algo]
         clear = item.pop('payload')
         item['payload'] = payload = {}
         payload['_type'] = 'EncryptedItem'
-        payload['algo'] = 'aes-cbc-pkcs7'
-        iv = crypto.random(16)
+        payload['algo'] = algo
+        iv = crypto.random(ivsize)
         payload['iv'] = base64.encode(iv)
         symkey = crypto.random(16)
         message = json.dumps(clear)
-        blob = crypto.aes_encrypt(message, symkey, iv, mode='cbc-pkcs7')
+        blob = crypto.aes_encrypt(message, symkey, iv, mode=mode)
         payload['blob'] = base64.encode(blob)
         payload['keyalgo'] = 'rsa-oaep'
         payload['keys'] = keys = {}
-        # encrypt the symmetric key to all nodes in the vault including ourselves
-        for node in self._trusted_certs[vault]:
-            cert = self._trusted_certs[vault][node][0]['payload']
-            synconly = cert.get('restrictions', {}).get('synconly')
-            if synconly:
-                # do not encrypt items to "synconly" nodes
-                continue
+        for node,cert in recipients.items():
             pubkey = base64.decode(cert['keys']['encrypt']['key'])
             enckey = crypto.rsa_encrypt(symkey, pubkey, padding='oaep')
             keys[node] = base64.encode(enckey)
@@ -598,27 +638,35 @@ class Model(object):
         crypto = self.crypto
         algo = item['payload']['algo']
         keyalgo = item['payload']['keyalgo']
-        if algo != 'aes-cbc-pkcs7':
+        if algo not in payload_algos:
             log.error('unknow algo in encrypted payload in item %s: %s', item['id'], algo)
             return False
         if keyalgo != 'rsa-oaep':
-            log.error('unknow keyalgo in encrypted payload in item %s: %s', item['id'], algo)
+            log.error('unknow keyalgo in encrypted payload in item %s: %s', item['id'], keyalgo)
             return False
         node = self.vaults[vault]['node']
         keys = item['payload']['keys']
         if node not in keys:
             log.info('item %s was not encrypted to us, skipping' % item['id'])
             return False
+        symkey = None
         try:
             enckey = base64.decode(keys[node])
             privkey = self._private_keys[vault][1]
-            symkey = crypto.rsa_decrypt(enckey, privkey, padding='oaep')
+            symkey = crypto.rsa_decrypt(enckey, privkey, padding='oaep',
+                                        secure=True)
             blob = base64.decode(item['payload']['blob'])
             iv = base64.decode(item['payload']['iv'])
-            clear = crypto.aes_decrypt(blob, symkey, iv, mode='cbc-pkcs7')
+            # For aes-gcm this also checks the authentication tag, so a
+            # corrupted payload is rejected here already.
+            mode = payload_algos[algo][0]
+            clear = crypto.aes_decrypt(blob, symkey, iv, mode=mode)
         except CryptoError as e:
             log.error('could not decrypt encrypted payload in item %s: %s' % (item['id'], str(e)))
             return False
+        finally:
+            if symkey is not None:
+                symkey.wipe()
         payload = json.try_loads(clear)
         if payload is None:
             log.error('illegal JSON in decrypted payload in item %s', item['id'])
@@ -669,13 +717,17 @@ class Model(object):
         version['_envelope'] = payload
         return version
 
-    def _create_vault_key(self, password):
-        """Create a new vault key. Return a tuple (private, public,
-        keyinfo). The keyinfo structure contains the encrypted keys."""
+    def _create_vault_key(self, password, keytype='rsa'):
+        """Create a new vault key of type `keytype`. Return a tuple
+        (private, public, keyinfo). The keyinfo structure contains the
+        encrypted keys."""
         crypto = self.crypto
         keyinfo = {}
-        private, public = crypto.rsa_genkey(3072)
-        keyinfo['keytype'] = 'rsa'
+        if keytype == 'ec':
+            private, public = crypto.ec_genkey('prime256v1')
+        else:
+            private, public = crypto.rsa_genkey(3072)
+        keyinfo['keytype'] = keytype
         keyinfo['public'] = base64.encode(public)
         keyinfo['encinfo'] = encinfo = {}
         if not password:
@@ -708,8 +760,9 @@ class Model(object):
         pwcheck['verifier'] = base64.encode(verifier)
         return private, public, keyinfo
 
-    def _create_vault_keys(self, password):
-        """Create all 3 vault keys (sign, encrypt and auth)."""
+    def _create_vault_keys(self, password, sign_keytype='rsa'):
+        """Create all 3 vault keys (sign, encrypt and auth). The sign key
+        is of type `sign_keytype`, the others are always RSA keys."""
         # Key generation is CPU intensive and would block gevent. We therefore
         # generate the keys in a separate thread. If we have more than 1 core
         # we generate the keys in two parallel threads as the C exension module
@@ -729,15 +782,17 @@ class Model(object):
         else:
             cores = 1  # fallback assumption
         nthreads = min(cores, 3)
-        keys_needed = [('sign', True), ('encrypt', True), ('auth', False)]
+        keys_needed = [('sign', True, sign_keytype), ('encrypt', True, 'rsa'),
+                       ('auth', False, 'rsa')]
         def create_keys():
             while True:
                 try:
-                    keytype, encrypt = keys_needed.pop()
+                    name, encrypt, keytype = keys_needed.pop()
                 except IndexError:
                     break
-                keydata = self._create_vault_key(password if encrypt else '')
-                keys[keytype] = keydata
+                keydata = self._create_vault_key(password if encrypt else '',
+                                                 keytype)
+                keys[name] = keydata
             if not keys_needed:
                 keys_ready.set()
         from threading import Thread
@@ -788,7 +843,66 @@ class Model(object):
             raise ModelError('InvalidArgument', 'Invalid config uuid')
         self.database.update('config', '$id = ?', (uuid,), config)
 
-    def create_vault(self, name, password, uuid=None, notify=True):
+    def get_peer_states(self, vault=None):
+        """Return the sync state of all peers, or of the peers in `vault`.
+
+        The sync state is a dictionary that is maintained by the syncer. It
+        contains at least the "vault" and "node" of the peer.
+        """
+        if vault is None:
+            return self.database.findall('peers')
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        return self.database.findall('peers', '$vault = ?', (vault,))
+
+    def get_peer_state(self, vault, node):
+        """Return the sync state of peer `node` in `vault`, or None if there
+        is no state for this peer."""
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        if not check_uuid4(node):
+            raise ModelError('InvalidArgument', 'Illegal node uuid')
+        return self.database.findone('peers', '$vault = ? AND $node = ?',
+                                     (vault, node))
+
+    def update_peer_state(self, vault, node, state):
+        """Store `state` as the sync state of peer `node` in `vault`."""
+        if not isinstance(state, dict):
+            raise ModelError('InvalidArgument', '"state" must be a dict')
+        current = self.get_peer_state(vault, node)
+        state = dict(state)
+        state['vault'] = vault
+        state['node'] = node
+        if current is None:
+            self.database.insert('peers', state)
+        else:
+            self.database.update('peers', '$vault = ? AND $node = ?',
+                                 (vault, node), state)
+        if vault in self._peer_features:
+            features = frozenset(state.get('features', ()))
+            self._peer_features[vault][node] = features
+
+    def _load_peer_features(self, vault):
+        """Load the features that the peers in `vault` advertised from
+        their sync state. They are kept in memory because they are needed
+        for every item that is encrypted."""
+        self._peer_features[vault] = features = {}
+        for state in self.database.findall('peers', '$vault = ?', (vault,)):
+            features[state['node']] = frozenset(state.get('features', ()))
+
+    def node_has_feature(self, vault, node, feature):
+        """Return whether `node` in `vault` is known to support `feature`.
+
+        Our own node supports all of `node_features`. For other nodes this is
+        only known once we have synced with them, and the features they
+        advertised are stored in their sync state.
+        """
+        if node == self.vaults[vault]['node']:
+            return feature in node_features
+        return feature in self._peer_features[vault].get(node, ())
+
+    def create_vault(self, name, password, uuid=None, notify=True,
+                     sign_keytype='rsa'):
         """Create a new vault.
         
         The `name` argument specifies the name of the vault to create. The
@@ -796,7 +910,10 @@ class Model(object):
         `uuid` argument is given, a vault with this UUID is created. The
         default is to generate an new UUID for this vault. The `notify`
         arguments determines wether or not callbacks must be called when this
-        vault is created.
+        vault is created. The `sign_keytype` argument selects the type of the
+        vault's sign key: "rsa" (the default) or "ec" for ECDSA on P-256.
+        An "ec" key is much faster to generate and to sign with, but its
+        signatures are slower to verify. See docs/objects.txt.
         """
         if not isinstance(name, (unicode, str)):
             raise ModelError('InvalidArgument', '"name" must be str/unicode')
@@ -807,6 +924,8 @@ class Model(object):
                 raise ModelError('InvalidArgument', 'Illegal vault uuid')
             if uuid in self.vaults:
                 raise ModelError('Exists', 'A vault with this UUID already exists')
+        if sign_keytype not in signature_algos:
+            raise ModelError('InvalidArgument', 'Unknown sign key type')
         if isinstance(password, unicode):
             password = password.encode('utf8')
         vault = {}
@@ -816,24 +935,22 @@ class Model(object):
         vault['_type'] = 'Vault'
         vault['name'] = name
         vault['node'] = self.crypto.randuuid()
-        keys = self._create_vault_keys(password)
+        keys = self._create_vault_keys(password, sign_keytype)
         vault['keys'] = dict(((key, keys[key][2]) for key in keys))
         self.database.insert('vaults', vault)
         if notify:
             self.raise_event('VaultAdded', vault)
         self.vaults[uuid] = vault
         # Start unlocked by default
-        self._private_keys[uuid] = (keys['sign'][0], keys['encrypt'][0])
+        self._private_keys[uuid] = [SecureBuffer(keys['sign'][0]),
+                                    SecureBuffer(keys['encrypt'][0])]
         self._version_cache[uuid] = {}
         self._linear_history[uuid] = {}
         self._full_history[uuid] = {}
+        self._load_peer_features(uuid)
         self._next_seqnr[uuid] = 0
         # Add a self-signed certificate
-        certinfo = { 'node': vault['node'], 'name': socket.gethostname() }
-        keys = certinfo['keys'] = {}
-        for key in vault['keys']:
-            keys[key] = { 'key': vault['keys'][key]['public'],
-                          'keytype': vault['keys'][key]['keytype'] }
+        certinfo = self.get_certinfo(uuid)
         certinfo['restrictions'] = {}
         item = self._new_certificate(uuid, **certinfo)
         self._add_origin(uuid, item)
@@ -870,6 +987,7 @@ class Model(object):
             raise ModelError('NotFound', 'No such vault')
         self.database.delete('vaults', '$id = ?', (uuid,))
         self.database.delete('items', '$vault = ?', (uuid,))
+        self.database.delete('peers', '$vault = ?', (uuid,))
         # The VACUUM command here ensures that the data we just deleted is
         # removed from the sqlite database file. However, quite likely the
         # data is still on the disk, at least for some time. So this is not
@@ -877,6 +995,8 @@ class Model(object):
         self.database.execute('vaults', 'VACUUM')
         del self.vaults[uuid]
         del self._private_keys[uuid]
+        self._wipe_auth_key(uuid)
+        self._peer_features.pop(uuid, None)
         del self._version_cache[uuid]
         del self._linear_history[uuid]
         del self._full_history[uuid]
@@ -955,7 +1075,8 @@ class Model(object):
             check = crypto.hmac(symkey, random, 'sha256')
             if check != verifier:
                 raise ModelError('WrongPassword')
-            private = crypto.aes_decrypt(privkey, symkey, iv, 'cbc-pkcs7')
+            private = crypto.aes_decrypt(privkey, symkey, iv, 'cbc-pkcs7',
+                                         secure=True)
             self._private_keys[uuid].append(private)
         self._load_versions(uuid)
         log.debug('unlocked vault "%s" (%s)', uuid, self.vaults[uuid]['name'])
@@ -973,8 +1094,11 @@ class Model(object):
         if uuid not in self.vaults:
             raise ModelError('NotFound', 'No such vault')
         assert uuid in self._private_keys
+        self._wipe_auth_key(uuid)
         if len(self._private_keys[uuid]) == 0:
             return
+        for key in self._private_keys[uuid]:
+            key.wipe()
         self._private_keys[uuid] = []
         self._clear_version_cache(uuid)
         log.debug('locked vault "%s" (%s)', uuid, self.vaults[uuid]['name'])
@@ -1137,13 +1261,47 @@ class Model(object):
 
     def get_auth_key(self, vault):
         """Return the private authentication key for `vault`."""
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        if vault not in self.vaults:
+            raise ModelError('NotFound', 'No such vault')
+        # The key is needed for every authenticated sync request, so the
+        # decoded key is cached in a SecureBuffer. The cache is keyed by the
+        # encoded key so that it remains valid if the vault is updated.
+        encoded = self.vaults[vault]['keys']['auth']['private']
+        cached = self._auth_keys.get(vault)
+        if cached is None or cached[0] != encoded:
+            self._wipe_auth_key(vault)
+            key = SecureBuffer(base64.decode(encoded))
+            cached = self._auth_keys[vault] = (encoded, key)
+        return cached[1]
+
+    def _wipe_auth_key(self, vault):
+        """Wipe the cached authentication key for `vault`, if any."""
+        cached = self._auth_keys.pop(vault, None)
+        if cached is not None:
+            cached[1].wipe()
+
+    def get_certinfo(self, vault, name=None):
+        """Return a certificate info structure for our node in `vault`.
+
+        This is what we send to another node that should issue a certificate
+        for us. The `name` argument is the name of our node. It defaults to
+        the host name.
+        """
         if not check_uuid4(vault):
             raise ModelError('InvalidArgument', 'Illegal vault uuid')
         if vault not in self.vaults:
             raise ModelError('NotFound', 'No such vault')
         vault = self.vaults[vault]
-        key = base64.decode(vault['keys']['auth']['private'])
-        return key
+        if name is None:
+            name = socket.gethostname()
+        certinfo = { 'node': vault['node'], 'name': name }
+        keys = certinfo['keys'] = {}
+        for key in vault['keys']:
+            keys[key] = { 'key': vault['keys'][key]['public'],
+                          'keytype': vault['keys'][key]['keytype'] }
+        return certinfo
 
     def check_certinfo(self, certinfo):
         """Check a certificate info structure."""
@@ -1163,7 +1321,7 @@ class Model(object):
             return False, 'Name too long (max = 100 characters)'
         if not base64.check(u[2]):
             return False, 'Illegal base64 in sign key'
-        if u[3] != 'rsa':
+        if u[3] not in signature_algos:
             return False, 'Unknown sign key type: %s' % u[3]
         if not base64.check(u[4]):
             return False, 'Illegal base64 in encrypt key'
@@ -1172,7 +1330,7 @@ class Model(object):
         if not base64.check(u[6]):
             return False, 'Illegal base64 in auth key'
         if u[7] != 'rsa':
-            return False, 'Unknown auth key type: %s' % u[5]
+            return False, 'Unknown auth key type: %s' % u[7]
         return True, 'All checks passed'
 
     def add_certificate(self, vault, certinfo):
@@ -1222,8 +1380,8 @@ class Model(object):
                     GROUP BY $origin$node""", (vault,))
         return vector
 
-    def get_items(self, vault, vector=None):
-        """Return the items in `vault` that are newer than `vector`."""
+    def _check_items_args(self, vault, vector):
+        """INTERNAL: check the arguments to get_items() and iter_items()."""
         if not check_uuid4(vault):
             raise ModelError('InvalidArgument', 'Illegal vault uuid')
         if vector is not None:
@@ -1236,6 +1394,10 @@ class Model(object):
                     raise ModelError('InvalidArgument', 'Illegal vector')
         if vault not in self.vaults:
             raise ModelError('NotFound', 'no such vault')
+
+    def get_items(self, vault, vector=None):
+        """Return the items in `vault` that are newer than `vector`."""
+        self._check_items_args(vault, vector)
         query = '$vault = ?'
         args = [vault]
         if vector is not None:
@@ -1253,6 +1415,140 @@ class Model(object):
             query += ' AND (%s)' % ' OR '.join(terms)
         return self.database.findall('items', query, args)
 
+    def iter_items(self, vault, vector=None, batchsize=100, start=None):
+        """Like get_items() but return an iterator.
+
+        The items are read from the database in batches of `batchsize`, so
+        that only one batch is held in memory at a time. The items are
+        returned in ascending (node, seqnr) order. This means that the
+        iterator can be imported in batches using import_items(), and that
+        any prefix of it that was imported forms a valid vector.
+
+        If `start` is provided, it must be a (node, seqnr) tuple. Only items
+        that come after this position are returned.
+        """
+        self._check_items_args(vault, vector)
+        if start is not None:
+            if not isinstance(start, (tuple, list)) or len(start) != 2 or \
+                    not check_uuid4(start[0]) or \
+                    not isinstance(start[1], (int, long)):
+                raise ModelError('InvalidArgument', 'Illegal start position')
+        vector = dict(vector or ())
+        nodes = self.database.execute('items', """
+                        SELECT DISTINCT $origin$node FROM items
+                        WHERE $vault = ?
+                        ORDER BY $origin$node""", (vault,))
+        query = '$vault = ? AND $origin$node = ? AND $origin$seqnr > ?'
+        def iter_items():
+            for node, in nodes:
+                seqnr = vector.get(node, -1)
+                if start is not None:
+                    if node < start[0]:
+                        continue
+                    elif node == start[0]:
+                        seqnr = max(seqnr, start[1])
+                while True:
+                    items = self.database.findall('items', query,
+                                    (vault, node, seqnr), '$origin$seqnr',
+                                    batchsize)
+                    for item in items:
+                        yield item
+                    if len(items) < batchsize:
+                        break
+                    seqnr = items[-1]['origin']['seqnr']
+        return iter_items()
+
+    def _check_range(self, rng):
+        """INTERNAL: check a (node, lo, hi) range."""
+        return isinstance(rng, (tuple, list)) and len(rng) == 3 \
+                    and check_uuid4(rng[0]) \
+                    and isinstance(rng[1], (int, long)) \
+                    and isinstance(rng[2], (int, long)) and rng[1] < rng[2]
+
+    def get_range_digests(self, vault, ranges, maxkeys=0):
+        """Return a digest for each range in `ranges`.
+
+        Each range is a (node, lo, hi) tuple, and covers the items of `node`
+        with a seqnr in [lo, hi). The return value is a list with a
+        dictionary for each range, containing the "count" of items in the
+        range, and a "digest" over their seqnrs and ids. Two nodes have the
+        same items in a range if the digests are equal. If the count is at
+        most `maxkeys`, the dictionary also contains the sorted list of
+        "seqnrs" in the range.
+        """
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        if vault not in self.vaults:
+            raise ModelError('NotFound', 'No such vault')
+        if not all((self._check_range(rng) for rng in ranges)):
+            raise ModelError('InvalidArgument', 'Illegal range')
+        result = []
+        for node, lo, hi in ranges:
+            rows = self.database.execute('items', """
+                        SELECT $origin$seqnr, $id FROM items
+                        WHERE $vault = ? AND $origin$node = ?
+                            AND $origin$seqnr >= ? AND $origin$seqnr < ?
+                        ORDER BY $origin$seqnr""", (vault, node, lo, hi))
+            md = hashlib.sha1()
+            for seqnr, uuid in rows:
+                md.update('%d:%s\n' % (seqnr, uuid))
+            digest = { 'count': len(rows), 'digest': md.hexdigest() }
+            if len(rows) <= maxkeys:
+                digest['seqnrs'] = [ row[0] for row in rows ]
+            result.append(digest)
+        return result
+
+    def get_items_by_origin(self, vault, keys):
+        """Return the items with the (node, seqnr) origins in `keys`.
+        Origins that we do not have are skipped."""
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        nodes = {}
+        for key in keys:
+            if not isinstance(key, (tuple, list)) or len(key) != 2 or \
+                    not check_uuid4(key[0]) or \
+                    not isinstance(key[1], (int, long)):
+                raise ModelError('InvalidArgument', 'Illegal origin')
+            nodes.setdefault(key[0], set()).add(key[1])
+        items = []
+        # Query in chunks to stay below the SQLite host parameter limit.
+        for node in sorted(nodes):
+            seqnrs = sorted(nodes[node])
+            for i in range(0, len(seqnrs), 500):
+                chunk = seqnrs[i:i+500]
+                query = '$vault = ? AND $origin$node = ?' \
+                        ' AND $origin$seqnr IN (%s)' % ','.join(['?'] * len(chunk))
+                args = [vault, node] + chunk
+                items += self.database.findall('items', query, args,
+                                               '$origin$seqnr')
+        return items
+
+    def get_snapshot_items(self, vault):
+        """Return the items that make up the current state of `vault`.
+
+        These are all certificates, and the most recent item of every
+        version, including deleted versions. This is enough for a new node
+        to show the current versions, without the rest of the history. The
+        items are sorted by origin.
+        """
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        if vault not in self.vaults:
+            raise ModelError('NotFound', 'No such vault')
+        if self.vault_is_locked(vault):
+            raise ModelError('Locked', 'Vault is locked')
+        query = "$vault = ? AND $payload$_type = 'Certificate'"
+        items = self.database.findall('items', query, (vault,))
+        # The version caches contain decrypted items. Get the items as they
+        # are stored instead.
+        keys = [ (history[0]['origin']['node'], history[0]['origin']['seqnr'])
+                 for history in self._linear_history[vault].values()
+                 if history ]
+        items += self.get_items_by_origin(vault, keys)
+        items.sort(key=lambda item: (item['origin']['node'],
+                                     item['origin']['seqnr']))
+        return items
+
     def import_item(self, vault, item, notify=True):
         """Import a single item."""
         if not check_uuid4(vault):
@@ -1282,6 +1578,7 @@ class Model(object):
             items = [item]
         else:
             raise ModelError('InvalidArgument', 'Unknown payload type')
+        self.raise_event('VectorUpdated', vault)
         if self.vault_is_locked(vault):
             return
         # See if the wider set of certificates exposed some versions
@@ -1296,10 +1593,30 @@ class Model(object):
         logger.debug('updating version cache for %d versions', len(versions))
         self._update_version_cache(versions, notify=notify)
 
-    def import_items(self, vault, items, notify=True):
+    def import_items(self, vault, items, notify=True, fill_gaps=False):
         """Import multiple items. This is more efficient than calling
         import_item() multiple times. Items with errors are silently skipped
-        and do not prevent good items to be imported."""
+        and do not prevent good items to be imported.
+
+        Normally, items that are not newer than our vector are assumed to be
+        present already. If `fill_gaps` is True, this is checked against the
+        database instead, so that items below the vector can be imported.
+        """
+        count, touched = self.store_items(vault, items, fill_gaps)
+        self.update_versions(vault, touched, notify=notify)
+        return count
+
+    def store_items(self, vault, items, fill_gaps=False):
+        """Store multiple items, without updating the version cache.
+
+        This is the first half of import_items(). It only performs the
+        checks that are needed to store the items, and the trust calculation
+        for new certificates. The return value is a tuple (count, touched).
+        The `count` is the number of items that were stored, and `touched`
+        is a list of items whose versions need to be updated by passing them
+        to update_versions(). That is where the signatures are verified and
+        the items are decrypted.
+        """
         if not check_uuid4(vault):
             raise ModelError('InvalidArgument', 'Illegal vault uuid')
         if vault not in self.vaults:
@@ -1309,10 +1626,18 @@ class Model(object):
         items = [ item for item in items if self.check_item(item)[0] ]
         log.debug('%d items are well formed', len(items))
         # Weed out items we already have.
-        vector = dict(self.get_vector(vault))
-        items = [ item for item in items
-                  if item['origin']['seqnr']
-                        > vector.get(item['origin']['node'], -1) ]
+        if fill_gaps:
+            keys = [ (item['origin']['node'], item['origin']['seqnr'])
+                     for item in items ]
+            have = set(((item['origin']['node'], item['origin']['seqnr'])
+                        for item in self.get_items_by_origin(vault, keys)))
+            items = [ item for item, key in zip(items, keys)
+                      if key not in have ]
+        else:
+            vector = dict(self.get_vector(vault))
+            items = [ item for item in items
+                      if item['origin']['seqnr']
+                            > vector.get(item['origin']['node'], -1) ]
         log.debug('%d items are new', len(items))
         # If we are adding certs we need to add them first and re-calculate
         # trust before adding the other items.
@@ -1342,15 +1667,29 @@ class Model(object):
                             and self.check_encrypted_item(item)[0] ]
         self.database.insert_many('items', encitems)
         log.debug('imported %d encrypted items', len(encitems))
-        # Update version and history caches (if the vault is unlocked)
-        if not self.vault_is_locked(vault):
-            versions = []
-            for item in itertools.chain(encitems, certitems):
-                if not self._verify_item(vault, item) or \
-                        not self._decrypt_item(vault, item) or \
-                        not self.check_decrypted_item(item)[0] or \
-                        not self.check_version(item)[0]:
-                    continue
-                versions.append(item)
-            self._update_version_cache(versions, notify=notify)
-        return len(certs) + len(encitems)
+        if certs or encitems:
+            self.raise_event('VectorUpdated', vault)
+        return len(certs) + len(encitems), encitems + certitems
+
+    def update_versions(self, vault, items, notify=True):
+        """Update the version and history caches for stored `items`.
+
+        Items with invalid signatures or contents are skipped. If the vault
+        is locked, this does nothing. The caches are rebuilt from the
+        database when the vault is unlocked.
+        """
+        if not check_uuid4(vault):
+            raise ModelError('InvalidArgument', 'Illegal vault uuid')
+        if vault not in self.vaults:
+            raise ModelError('NotFound')
+        if self.vault_is_locked(vault):
+            return
+        versions = []
+        for item in items:
+            if not self._verify_item(vault, item) or \
+                    not self._decrypt_item(vault, item) or \
+                    not self.check_decrypted_item(item)[0] or \
+                    not self.check_version(item)[0]:
+                continue
+            versions.append(item)
+        self._update_version_cache(versions, notify=notify)
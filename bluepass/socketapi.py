@@ -14,11 +14,13 @@ from bluepass.util import misc
 from bluepass.factory import instance
 from bluepass.error import StructuredError
 from bluepass.crypto import CryptoProvider
-from bluepass.model import Model
+from bluepass.model import Model, signature_algos
 from bluepass.passwords import PasswordGenerator
 from bluepass.locator import Locator
-from bluepass.messagebus import MessageBusHandler, MessageBusServer, method
-from bluepass.syncapi import SyncAPIPublisher, SyncAPIClient, SyncAPIError
+from bluepass.messagebus import (MessageBusHandler, MessageBusServer,
+                                  MessageBusError, method)
+from bluepass.syncapi import SyncAPIPublisher, SyncAPIClientPool, SyncAPIError, \
+        SyncAPIServer
 
 
 class PairingError(StructuredError):
@@ -30,6 +32,10 @@ class SocketAPIHandler(MessageBusHandler):
 
     # NOTE: all methods run in separate greenlets!
 
+    # Events that are only used inside the backend. They are raised often
+    # during a sync, and are not forwarded to frontends.
+    internal_events = frozenset(('VectorUpdated',))
+
     def __init__(self):
         super(SocketAPIHandler, self).__init__()
         self.crypto = instance(CryptoProvider)
@@ -39,9 +45,60 @@ class SocketAPIHandler(MessageBusHandler):
         instance(SyncAPIPublisher).add_callback(self._event_callback)
         self.pairdata = {}
 
+    def _event_vault(self, event, args):
+        """Return the UUID of the vault that an event relates to, if any."""
+        if not args:
+            return
+        if event.startswith('Vault'):
+            return args[0]['id']
+        elif event.startswith('Neighbor'):
+            return args[0]['vault']
+        elif event in ('VersionsAdded', 'ImportProgress', 'PeerUpdated'):
+            return args[0]
+
     def _event_callback(self, event, *args):
         # Forward the event over the message bus.
-        instance(MessageBusServer).send_signal(None, event, *args)
+        if event in self.internal_events:
+            return
+        vault = self._event_vault(event, args)
+        instance(MessageBusServer).send_signal(None, event, *args, vault=vault)
+
+    # Signal subscriptions
+
+    @method()
+    def subscribe(self, signal_names, vault_filter=None):
+        """Subscribe to signals.
+
+        By default a client receives all signals. After it has subscribed, it
+        receives only the signals in *signal_names*, a list of signal names
+        that may contain wildcards. Subscribing to "*" restores the default.
+
+        If *vault_filter* is provided, it must be a list of vault UUIDs. The
+        signals in *signal_names* are then only received for those vaults.
+        Signals that do not relate to a vault are not filtered. Note that a
+        "VaultAdded" signal relates to the new vault.
+        """
+        if not isinstance(signal_names, list) or \
+                not all(isinstance(name, basestring) for name in signal_names):
+            raise MessageBusError('InvalidArgument',
+                                  '"signal_names" must be a list of strings')
+        if vault_filter is not None and (not isinstance(vault_filter, list) or
+                not all(isinstance(uuid, basestring) for uuid in vault_filter)):
+            raise MessageBusError('InvalidArgument',
+                                  '"vault_filter" must be a list of strings')
+        server = instance(MessageBusServer)
+        server.subscribe(self.connection, signal_names, vault_filter)
+
+    @method()
+    def unsubscribe(self, signal_names=None):
+        """Unsubscribe from the signals in *signal_names*, or from all signals
+        if *signal_names* is not provided."""
+        if signal_names is not None and (not isinstance(signal_names, list) or
+                not all(isinstance(name, basestring) for name in signal_names)):
+            raise MessageBusError('InvalidArgument',
+                                  '"signal_names" must be a list of strings')
+        server = instance(MessageBusServer)
+        server.unsubscribe(self.connection, signal_names)
 
     # Version
 
@@ -75,12 +132,19 @@ class SocketAPIHandler(MessageBusHandler):
         return instance(Model).update_config(config)
 
     @method()
-    def create_vault(self, name, password, async=False):
+    def create_vault(self, name, password, async=False, sign_keytype='rsa'):
         """Create a new vault.
 
         The vault will have the name *name*. The vault's private keys will be
         encrypted with *password*.
 
+        The *sign_keytype* parameter selects the type of the vault's sign key:
+        "rsa" (the default) or "ec" for ECDSA on P-256. An "ec" key is much
+        quicker to generate and to sign with, but verifying its signatures is
+        about twice as slow as for "rsa". Nodes that do not support "ec" sign
+        keys cannot be paired with the vault, because they reject its
+        certificates.
+
         The *async* parameter specifies if the vault creation needs to be
         asynchronous. If it is set to False, then the vault is created
         synchronously and it is returned as a dictionary. If async is set to
@@ -95,13 +159,19 @@ class SocketAPIHandler(MessageBusHandler):
         """
         # Vault creation is time consuming because 3 RSA keys have
         # to be generated. Therefore an async variant is provided.
+        if sign_keytype not in signature_algos:
+            raise MessageBusError('InvalidArgument',
+                                  '"sign_keytype" must be one of: %s'
+                                  % ', '.join(sorted(signature_algos)))
         model = instance(Model)
         if not async:
-            return model.create_vault(name, password)
+            return model.create_vault(name, password,
+                                      sign_keytype=sign_keytype)
         uuid = self.crypto.randuuid()
         self.early_response(uuid)
         try:
-            vault = model.create_vault(name, password, uuid)
+            vault = model.create_vault(name, password, uuid,
+                                       sign_keytype=sign_keytype)
         except StructuredError as e:
             status = e[0]
             detail = e.asdict()
@@ -299,6 +369,15 @@ class SocketAPIHandler(MessageBusHandler):
         """
         return instance(Locator).get_neighbors()
 
+    @method()
+    def get_sync_statistics(self):
+        """Return statistics on the sync API server.
+
+        The return value is a dictionary with request counters, and with the
+        load on the request handlers. See :meth:`SyncAPIServer.get_stats`.
+        """
+        return instance(SyncAPIServer).get_stats()
+
     # Pairing methods
 
     @method()
@@ -337,10 +416,10 @@ class SocketAPIHandler(MessageBusHandler):
         cookie = self.crypto.random(16).encode('hex')
         self.early_response(cookie)
         name = misc.gethostname()
+        pool = instance(SyncAPIClientPool)
         for addr in neighbor['addresses']:
-            client = SyncAPIClient(addr)
             try:
-                client.connect()
+                client = pool.get(addr)
             except SyncAPIError as e:
                 continue  # try next address
             try:
@@ -348,13 +427,14 @@ class SocketAPIHandler(MessageBusHandler):
             except SyncAPIError as e:
                 status = e[0]
                 detail = e.asdict()
+                pool.discard(client)
             else:
                 status = 'OK'
                 detail = {}
                 self.pairdata[cookie] = (kxid, neighbor, addr)
+                pool.put(client)
             self.connection.send_signal('PairNeighborStep1Completed', cookie,
                                         status, detail)
-            client.close()
             break
 
     @method()
@@ -376,30 +456,49 @@ class SocketAPIHandler(MessageBusHandler):
         if cookie not in self.pairdata:
             raise PairingError('NotFound', 'No such key exchange ID')
         kxid, neighbor, addr = self.pairdata.pop(cookie)
-        # Again don't keep the GUI blocked while we pair and do a full sync
+        # Again don't keep the GUI blocked while we pair and do the first sync
         self.early_response()
         model = instance(Model)
         vault = model.create_vault(name, password, neighbor['vault'],
                                    notify=False)
-        certinfo = { 'node': vault['node'], 'name': misc.gethostname() }
-        keys = certinfo['keys'] = {}
-        for key in vault['keys']:
-            keys[key] = { 'key': vault['keys'][key]['public'],
-                          'keytype': vault['keys'][key]['keytype'] }
-        client = SyncAPIClient(addr)
-        client.connect()
+        certinfo = model.get_certinfo(vault['id'], misc.gethostname())
+        pool = instance(SyncAPIClientPool)
+        client = None
+        # The pairing is only complete when the first sync succeeded as
+        # well. Otherwise the vault is removed again, and an error is
+        # reported to the client.
         try:
+            client = pool.get(addr)
             peercert = client.pair_step2(vault['id'], kxid, pin, certinfo)
+            model.add_certificate(vault['id'], peercert)
+            # Start with a snapshot of the current versions, so that the
+            # vault can be used right away. Peers that cannot provide a
+            # snapshot get a full sync instead.
+            snapshot = client.bootstrap(vault['id'], model, notify=False)
+            if snapshot is None:
+                client.sync(vault['id'], model, notify=False)
         except SyncAPIError as e:
             status = e[0]
             detail = e.asdict()
             model.delete_vault(vault)
+            if client is not None:
+                pool.discard(client)
         else:
             status = 'OK'
             detail = {}
-            model.add_certificate(vault['id'], peercert)
-            client.sync(vault['id'], model, notify=False)
             model.raise_event('VaultAdded', vault)
         self.connection.send_signal('PairNeighborStep2Completed', cookie,
                                     status, detail)
-        client.close()
+        if status != 'OK':
+            return
+        if snapshot is not None:
+            # Now fill in the history. A normal sync retrieves the items
+            # above our vector, and reconciliation the gaps below it.
+            try:
+                client.sync(vault['id'], model, notify=False)
+                client.reconcile(vault['id'], model, notify=False)
+            except SyncAPIError as e:
+                self.logger.error('could not retrieve history: %s', str(e))
+                pool.discard(client)
+                return
+        pool.put(client)
@@ -9,8 +9,14 @@
 import re
 import sys
 import time
+import zlib
+import types
+import struct
+import hashlib
 import logging
+import itertools
 import traceback
+import collections
 
 try:
     import httplib as http
@@ -21,24 +27,27 @@ except ImportError:
     from http.client import HTTPException
     from urllib.parse import parse_qs
 
-from gevent import socket, local, Greenlet
+import gevent
+from gevent import socket, select, local, Greenlet
 from gevent.event import Event
+from gevent.lock import Semaphore
+from gevent.pool import Pool
 from gevent.pywsgi import WSGIHandler, WSGIServer
 
 from bluepass import _version
 from bluepass.error import StructuredError
 from bluepass.factory import instance
 from bluepass.crypto import CryptoProvider, CryptoError, dhparams
-from bluepass.model import Model
+from bluepass.model import Model, ModelError, node_features
 from bluepass.locator import Locator
 from bluepass.messagebus import MessageBusServer
 from bluepass.util import json, base64
-from bluepass.util.ssl import wrap_socket, HTTPSConnection
+from bluepass.util.ssl import wrap_socket, session_ticket_keys, HTTPSConnection
 from bluepass.util.uuid import check_uuid4
 from bluepass.util.logging import ContextLogger
 
-__all__ = ('SyncAPIError', 'SyncAPIClient', 'SyncAPIApplication',
-           'SyncAPIServer')
+__all__ = ('SyncAPIError', 'SyncAPIClient', 'SyncAPIClientPool',
+           'SyncAPIApplication', 'SyncAPIServer')
 
 
 class SyncAPIError(StructuredError):
@@ -113,6 +122,273 @@ def dump_vector(vector):
         vec = vec.encode('iso-8859-1')  # XXX: investiage
     return vec
 
+def vector_digest(vector):
+    """Return a digest of `vector`, formatted as an HTTP entity tag. Two
+    vectors have the same digest if they contain the same elements."""
+    digest = hashlib.sha1(dump_vector(sorted(vector))).hexdigest()
+    return '"%s"' % digest
+
+def vector_covers(vector, other):
+    """Return whether `vector` is at least as new as `other` for every
+    node in `other`."""
+    vector = dict(vector)
+    return all((vector.get(node, -1) >= seqnr for node, seqnr in other))
+
+def merge_vectors(vector, other):
+    """Return a vector that contains the newest elements of `vector` and
+    `other`."""
+    merged = dict(vector)
+    for node, seqnr in other:
+        merged[node] = max(seqnr, merged.get(node, -1))
+    return sorted(merged.items())
+
+
+# Supported content encodings, in order of our preference, with the zlib
+# window bits that select their format.
+content_encodings = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+
+def select_encoding(header):
+    """Select a content encoding from an Accept-Encoding header. Return None
+    if none of the encodings we support is acceptable."""
+    accepted = {}
+    for value in header.split(','):
+        parts = value.split(';')
+        coding = parts[0].strip().lower()
+        qvalue = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    qvalue = float(param[2:])
+                except ValueError:
+                    qvalue = 0.0
+        accepted[coding] = qvalue
+    for coding, wbits in content_encodings:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0.0:
+            return coding
+
+def compress(data, encoding):
+    """Compress the string `data` using content encoding `encoding`."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, dict(content_encodings)[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(chunks, encoding):
+    """Compress the strings from the iterable `chunks` using content encoding
+    `encoding`. This is a generator. Each input chunk is flushed so that the
+    receiver can decompress it as soon as it arrives."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, dict(content_encodings)[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Decompressor(object):
+    """A file-like object that decompresses a gzip or deflate encoded body
+    that is read from the file-like object `fin`.
+
+    The read() method returns at most `size` bytes, so that the amount of
+    memory that is used does not depend on the compression ratio.
+    """
+
+    def __init__(self, fin, bufsize=16384):
+        self.fin = fin
+        self.bufsize = bufsize
+        # Automatically detect a gzip or zlib header
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.eof = False
+
+    def read(self, size=-1):
+        """Read up to `size` bytes of decompressed data. If `size` is
+        negative, read until the end of the input."""
+        if size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self.bufsize)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return ''.join(chunks)
+        decompressor = self.decompressor
+        while not self.eof:
+            if decompressor.unconsumed_tail:
+                data = decompressor.decompress(decompressor.unconsumed_tail, size)
+            else:
+                chunk = self.fin.read(self.bufsize)
+                if not chunk:
+                    self.eof = True
+                    data = decompressor.flush()
+                else:
+                    data = decompressor.decompress(chunk, size)
+            if data:
+                return data
+        return ''
+
+
+_import_locks = {}
+
+def _get_import_lock(model, vault):
+    """Return the lock that serializes imports into `vault` of `model`."""
+    lock = _import_locks.get((model, vault))
+    if lock is None:
+        lock = _import_locks[(model, vault)] = Semaphore()
+    return lock
+
+
+class VersionUpdateJob(Greenlet):
+    """Update the version cache for stored items in the background.
+
+    Verifying and decrypting items is expensive. This job does it in
+    batches, and yields to the other greenlets in between, so that a large
+    inbound sync does not block the backend. After every batch, an
+    "ImportProgress" event is raised by the model, with the number of items
+    that were processed and the total number of items.
+
+    A batch that fails is logged and skipped, and the job continues with
+    the next batch.
+    """
+
+    batchsize = 20
+
+    def __init__(self, model, vault):
+        super(VersionUpdateJob, self).__init__()
+        self.model = model
+        self.vault = vault
+        self.pending = []
+        self.done = 0
+        self.total = 0
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, items):
+        """Add `items` to the job."""
+        self.pending += items
+        self.total += len(items)
+
+    def _run(self):
+        model = self.model
+        try:
+            while self.pending:
+                batch = self.pending[:self.batchsize]
+                del self.pending[:self.batchsize]
+                try:
+                    with _get_import_lock(model, self.vault):
+                        model.update_versions(self.vault, batch)
+                except Exception:
+                    lines = ['Could not update versions for %d items in '
+                             'vault %s\n' % (len(batch), self.vault)]
+                    lines += traceback.format_exception(*sys.exc_info())
+                    self.logger.error(''.join(lines))
+                self.done += len(batch)
+                model.raise_event('ImportProgress', self.vault, self.done,
+                                  self.total)
+                gevent.sleep(0)
+        finally:
+            del _version_jobs[(model, self.vault)]
+            if self.pending:
+                self.logger.error('dropped %d pending version updates for '
+                                  'vault %s', len(self.pending), self.vault)
+
+
+_version_jobs = {}
+
+def update_versions(model, vault, items):
+    """Update the versions for `items` in a background job, and return
+    the job. There is at most one job per vault."""
+    job = _version_jobs.get((model, vault))
+    if job is None:
+        job = _version_jobs[(model, vault)] = VersionUpdateJob(model, vault)
+        job.start()
+    job.add(items)
+    return job
+
+
+def import_items(model, vault, items, notify=True, fill_gaps=False,
+                 defer=False):
+    """Import `items` into `vault` using Model.import_items().
+
+    Imports into the same vault are serialized. This makes sure that
+    concurrent syncs with different peers do not interleave their trust
+    recalculations and version cache updates.
+
+    If `defer` is True, the items are only stored, and the version cache
+    is updated in the background by update_versions().
+    """
+    with _get_import_lock(model, vault):
+        if not defer:
+            return model.import_items(vault, items, notify=notify,
+                                      fill_gaps=fill_gaps)
+        count, touched = model.store_items(vault, items, fill_gaps)
+    if touched:
+        update_versions(model, vault, touched)
+    return count
+
+
+def split_batches(objects):
+    """Split a stream of sync headers, each followed by the items of its
+    vault, into (header, items) tuples.
+
+    The `items` iterator must be consumed before the next tuple is
+    requested. If it is not, it is consumed when the next tuple is
+    requested. A ValueError is raised if the stream does not start with a
+    header, or if an item does not belong to the vault of its header.
+    """
+    end = object()
+    objects = iter(objects)
+    pending = [next(objects, end)]
+    def is_header(obj):
+        return isinstance(obj, dict) and obj.get('_type') == 'SyncHeader'
+    def items(vault):
+        while True:
+            obj = next(objects, end)
+            if obj is end or is_header(obj):
+                pending[0] = obj
+                return
+            if isinstance(obj, dict) and obj.get('vault') != vault:
+                raise ValueError('item does not belong to vault')
+            yield obj
+    while pending[0] is not end:
+        header = pending[0]
+        if not is_header(header):
+            raise ValueError('expecting a sync header')
+        pending[0] = end
+        section = items(header.get('vault'))
+        yield header, section
+        for item in section:
+            pass
+
+
+def import_stream(model, vault, items, batchsize=100, notify=True,
+                  defer=False):
+    """Import the items from the iterable `items` into `vault`.
+
+    The items are imported in batches of `batchsize` using
+    import_items(), so that items become available while the rest is
+    still being transferred. This requires the items to be in ascending
+    seqnr order for each node, otherwise the vector based duplicate check in
+    import_items() would drop them. A ValueError is raised if the items are
+    not in this order. The return value is the number of items read.
+    """
+    batch = []
+    seqnrs = {}
+    count = 0
+    for item in items:
+        try:
+            node, seqnr = item['origin']['node'], item['origin']['seqnr']
+        except (TypeError, KeyError):
+            raise ValueError('illegal item in stream')
+        if not isinstance(seqnr, (int, long)) or seqnr <= seqnrs.get(node, -1):
+            raise ValueError('items in stream are out of order')
+        seqnrs[node] = seqnr
+        batch.append(item)
+        count += 1
+        if len(batch) == batchsize:
+            import_items(model, vault, batch, notify=notify, defer=defer)
+            batch = []
+    if batch:
+        import_items(model, vault, batch, notify=notify, defer=defer)
+    return count
+
 
 class SyncAPIClient(object):
     """
@@ -123,6 +399,22 @@ class SyncAPIClient(object):
     and synchronization (sync()).
     """
 
+    # Request bodies smaller than this are not compressed.
+    compress_threshold = 1024
+    # Reconciliation: the number of sub-ranges a differing range is split
+    # into, the item count below which the seqnrs in a range are listed,
+    # and the maximum number of ranges or items per request.
+    range_fanout = 16
+    range_leaf_size = 32
+    max_ranges = 1000
+    # Sessions are not used after this many seconds. This is less than the
+    # server's lifetime, so that the server does not expire them first.
+    session_lifetime = 1800
+    # The delay in seconds after which a busy server is retried if it did
+    # not send a valid "Retry-After" header, and the maximum delay.
+    retry_after = 10
+    max_retry_after = 600
+
     def __init__(self, address, **ssl_args):
         """Create a new client for the syncapi API at `address`."""
         self.address = address
@@ -130,38 +422,108 @@ class SyncAPIClient(object):
         ssl_args.setdefault('ciphers', 'ADH+AES')
         self.ssl_args = ssl_args
         self.connection = None
+        # The encoding we use for request bodies. This is only set once the
+        # server has shown, via an Accept-Encoding header, that it supports
+        # compressed requests. Older servers do not, and get plain bodies.
+        self.content_encoding = None
+        # The maximum number of items to request per page during sync.
+        self.page_size = 1000
+        # Authenticated sessions established with the server, by vault.
+        self.sessions = {}
+        # The vectors of the server after the last sync, by vault.
+        self.peer_vectors = {}
+        # The optional features that the server advertises.
+        self.peer_features = []
+        self.rtt = None
         logger = logging.getLogger(__name__)
         self.logger = ContextLogger(logger)
         self.crypto = CryptoProvider()
 
     def _make_request(self, method, url, headers=None, body=None):
         """Make an HTTP request to the API.
+
+        If `body` is a generator, the objects it yields are sent chunked as
+        newline delimited JSON. Otherwise it is sent as a JSON document.
         
         This returns the HTTPResponse object on success, or None on failure.
+        The parsed response body is available as the "entity" attribute.
+        If the server is busy, a SyncAPIError "Busy" is raised. Its
+        "retry_after" attribute has the number of seconds after which the
+        request may be retried. The connection can still be used.
+        For a "text/x-ndjson" response, the entity is an iterator that parses
+        the objects as they arrive. It must be exhausted before the next
+        request is made on this connection.
         """
         logger = self.logger
-        if headers is None:
-            headers = []
+        headers = list(headers or [])
         headers.append(('User-Agent', 'Bluepass/%s' % _version.version))
-        headers.append(('Accept', 'text/json'))
-        if body is None:
+        headers.append(('X-Features', ' '.join(node_features)))
+        headers.append(('Accept', 'text/x-ndjson, text/json'))
+        headers.append(('Accept-Encoding', ', '.join([ coding
+                                for coding, wbits in content_encodings ])))
+        encoding = self.content_encoding
+        if isinstance(body, types.GeneratorType):
+            headers.append(('Content-Type', 'text/x-ndjson'))
+            headers.append(('Transfer-Encoding', 'chunked'))
+            body = json.iterdumps(body)
+            if encoding:
+                headers.append(('Content-Encoding', encoding))
+                body = compress_stream(body, encoding)
+        elif body is None:
             body = ''
         else:
             body = json.dumps(body)
             headers.append(('Content-Type', 'text/json'))
+            if encoding and len(body) >= self.compress_threshold:
+                size = len(body)
+                body = compress(body, encoding)
+                headers.append(('Content-Encoding', encoding))
+                logger.debug('compressed request body from %d to %d bytes',
+                             size, len(body))
         connection = self.connection
         assert connection is not None
         try:
             logger.debug('client request: %s %s', method, url)
-            connection.request(method, url, body, dict(headers))
+            if isinstance(body, types.GeneratorType):
+                connection.putrequest(method, url, skip_accept_encoding=True)
+                for name, value in headers:
+                    connection.putheader(name, value)
+                connection.endheaders()
+                for chunk in body:
+                    connection.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+                connection.send('0\r\n\r\n')
+            else:
+                connection.request(method, url, body, dict(headers))
+            sent = time.time()
             response = connection.getresponse()
+            # Smoothed round trip time, including the server's processing
+            # time, as for TCP (RFC 6298).
+            sample = time.time() - sent
+            self.rtt = sample if self.rtt is None \
+                            else 0.875 * self.rtt + 0.125 * sample
             headers = response.getheaders()
-            body = response.read()
-        except (socket.error, HTTPException) as e:
+            ctype = response.getheader('Content-Type')
+            coding = response.getheader('Content-Encoding')
+            if coding and coding not in dict(content_encodings):
+                response.read()
+                logger.error('unsupported response Content-Encoding: %s', coding)
+                return
+            reader = Decompressor(response) if coding else response
+            if ctype != 'text/x-ndjson':
+                body = reader.read()
+        except (socket.error, HTTPException, zlib.error) as e:
             logger.error('error when making HTTP request: %s', str(e))
             return
-        ctype = response.getheader('Content-Type')
-        if ctype == 'text/json':
+        accept = response.getheader('Accept-Encoding')
+        if accept:
+            self.content_encoding = select_encoding(accept)
+        features = response.getheader('X-Features')
+        if features is not None:
+            self.peer_features = features.split()
+        if ctype == 'text/x-ndjson':
+            response.entity = json.iterloads(reader)
+            logger.debug('streaming "%s" response body', ctype)
+        elif ctype == 'text/json':
             parsed = json.try_loads(body)
             if parsed is None:
                 logger.error('response body contains invalid JSON')
@@ -170,11 +532,23 @@ class SyncAPIClient(object):
             logger.debug('parsed "%s" request body (%d bytes)', ctype, len(body))
         else:
             response.entity = None
+        if response.status == http.SERVICE_UNAVAILABLE:
+            try:
+                delay = int(response.getheader('Retry-After', ''))
+            except ValueError:
+                delay = self.retry_after
+            error = SyncAPIError('Busy', 'Server is busy')
+            error.retry_after = max(1, min(self.max_retry_after, delay))
+            raise error
         return response
 
     def connect(self):
-        """Connect to the remote syncapi."""
-        ssl_args = { 'dhparams': dhparams['skip2048'], 'ciphers': 'ADH+AES' }
+        """Connect to the remote syncapi.
+
+        If a "session" was passed in the SSL arguments to the constructor,
+        an attempt is made to resume it, which is a lot cheaper than a full
+        handshake.
+        """
         # Support both dict style addresses for arbitrary address families,
         # as well as (host, port) tuples for IPv4.
         if isinstance(self.address, dict):
@@ -183,19 +557,44 @@ class SyncAPIClient(object):
         else:
             host, port = self.address
             sockinfo = None
-        connection = HTTPSConnection(host, port, sockinfo=sockinfo, **ssl_args)
+        connection = HTTPSConnection(host, port, sockinfo=sockinfo,
+                                     **self.ssl_args)
         try:
             connection.connect()
         except socket.error as e:
-            self.logger.error('could not connect to %s:%d' % self.address)
+            self.logger.error('could not connect to %s: %s', self.address, str(e))
             raise SyncAPIError('RemoteError', 'Could not connect')
         self.connection = connection
 
+    def is_connected(self):
+        """Return whether the client is connected and the connection can be
+        used for a new request. A connection that was closed by the peer, or
+        that has unexpected data waiting, is not usable."""
+        if self.connection is None or self.connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.connection.sock], [], [], 0)
+        except (socket.error, select.error, ValueError):
+            return False
+        return not readable
+
+    def get_session(self):
+        """Return the TLS session of the connection, for resumption."""
+        if self.connection is None or self.connection.sock is None:
+            return
+        return self.connection.sock.get_session()
+
+    def session_reused(self):
+        """Return whether the connection resumed an earlier TLS session."""
+        if self.connection is None or self.connection.sock is None:
+            return False
+        return self.connection.sock.session_reused()
+
     def close(self):
         """Close the connection."""
         if self.connection is not None:
             try:
-                conection.close()
+                self.connection.close()
             except Exception:
                 pass
         self.connection = None
@@ -224,7 +623,7 @@ class SyncAPIClient(object):
         signature = base64.decode(options['signature'])
         cb = self.connection.sock.get_channel_binding('tls-unique')
         check = self.crypto.hmac(adjust_pin(pin, -1), cb, 'sha1')
-        if check != signature:
+        if not self.crypto.compare_digest(check, signature):
             logger.error('HMAC_CB signature did not match')
             return False
         return True
@@ -284,9 +683,31 @@ class SyncAPIClient(object):
             raise SyncAPIError('RemoteError', 'Illegal syncapi response')
         return peercert
 
+    def _get_session(self, uuid, cb):
+        """Return the session for vault `uuid` on the connection with
+        channel binding `cb`, or None if there is no such session."""
+        session = self.sessions.get(uuid)
+        if session is None or session[0] != cb \
+                    or time.time() - session[3] > self.session_lifetime:
+            return
+        return session
+
     def _get_rsa_cb_auth(self, uuid, model):
-        """Return the headers for RSA_CB authentication."""
+        """Return the headers for RSA_CB authentication.
+
+        If the server established a session on this connection, this returns
+        the headers for SESSION_CB authentication instead. This uses a HMAC
+        rather than an RSA signature.
+        """
         cb = self.connection.sock.get_channel_binding('tls-unique')
+        session = self._get_session(uuid, cb)
+        if session is not None:
+            signature = self.crypto.hmac(session[1], 'client' + cb)
+            signature = base64.encode(signature)
+            vault = model.get_vault(uuid)
+            auth = create_option_header('SESSION_CB', node=vault['node'],
+                                        signature=signature)
+            return [('Authorization', auth)]
         privkey = model.get_auth_key(uuid)
         assert privkey is not None
         signature = self.crypto.rsa_sign(cb, privkey, 'pss-sha1')
@@ -296,10 +717,44 @@ class SyncAPIClient(object):
         headers = [('Authorization', auth)]
         return headers
 
+    def _make_auth_request(self, method, url, uuid, model, headers=None,
+                           body=None):
+        """Make a request for vault `uuid` with RSA_CB authentication.
+
+        If the request used SESSION_CB and the server responds with "401
+        Unauthorized", the server no longer has our session, for example
+        because it expired or was evicted. The session is then dropped and
+        the request is retried once with RSA_CB. Because of this, a streamed
+        `body` must be passed as a function that returns the generator.
+        """
+        while True:
+            authheaders = self._get_rsa_cb_auth(uuid, model)
+            session = authheaders[0][1].startswith('SESSION_CB')
+            response = self._make_request(method, url,
+                                          authheaders + list(headers or []),
+                                          body() if callable(body) else body)
+            if response is None or response.status != 401 or not session:
+                return response
+            self.logger.debug('server rejected our session, retrying '
+                              'with RSA_CB')
+            self.sessions.pop(uuid, None)
+            if not self.is_connected():
+                self.close()
+                self.connect()
+
     def _check_rsa_cb_auth(self, uuid, response, model):
-        """Verify RSA_CB authentication."""
-        logger = self.logger
+        """Verify RSA_CB or SESSION_CB authentication.
+
+        If the server established a session, it is stored so that the next
+        requests on this connection can use SESSION_CB authentication.
+        """
         authinfo = response.getheader('Authentication-Info', '')
+        return self._check_authinfo(uuid, authinfo, model)
+
+    def _check_authinfo(self, uuid, authinfo, model):
+        """Verify the Authentication-Info value `authinfo` for vault
+        `uuid`."""
+        logger = self.logger
         try:
             method, options = parse_option_header(authinfo)
         except ValueError:
@@ -312,9 +767,20 @@ class SyncAPIClient(object):
             return False
         cb = self.connection.sock.get_channel_binding('tls-unique')
         signature = base64.decode(options['signature'])
+        if method == 'SESSION_CB':
+            session = self._get_session(uuid, cb)
+            if session is None or session[2] != options['node']:
+                logger.error('SESSION_CB authentication without a session')
+                return False
+            check = self.crypto.hmac(session[1], 'server' + cb)
+            status = self.crypto.compare_digest(check, signature)
+            if not status:
+                logger.error('SESSION_CB signature did not match')
+            return status
         cert = model.get_certificate(uuid, options['node'])
         if cert is None:
-            logger.error('unknown node in RSA_CB authentication', node)
+            logger.error('unknown node in RSA_CB authentication: %s',
+                         options['node'])
             return False
         pubkey = base64.decode(cert['payload']['keys']['auth']['key'])
         try:
@@ -324,54 +790,530 @@ class SyncAPIClient(object):
             return False
         if not status:
             logger.error('RSA_CB signature did not match')
+            return False
+        # Older servers do not establish sessions.
+        key = base64.try_decode(options.get('session', ''))
+        if key:
+            self.sessions[uuid] = (cb, key, options['node'], time.time())
         return status
 
-    def sync(self, uuid, model, notify=True):
-        """Synchronize vault `uuid` with the remote peer."""
-        if self.connection is None:
-            raise SyncAPIError('ProgrammingError', 'Not connected')
+    def _get_items_page(self, uuid, model, start, notify):
+        """Retrieve one page of items from the peer and import it.
+
+        The page is requested relative to our current vector, so a sync that
+        was interrupted resumes where the last import stopped. The `start`
+        argument is the continuation token of the previous page, if any.
+
+        The first page is requested with an If-None-Match header containing
+        the digest of our vector. If the peer has the same vector, it
+        responds with "304 Not Modified" and no items.
+
+        Return a tuple (response, nitems, streaming).
+        """
         logger = self.logger
-        logger.setContext('sync')
-        vault = model.get_vault(uuid)
-        if vault is None:
-            raise SyncAPIError('NotFound', 'Vault not found')
         vector = model.get_vector(uuid)
-        vector = dump_vector(vector)
-        url = '/api/vaults/%s/items?vector=%s' % (vault['id'], vector)
-        headers = self._get_rsa_cb_auth(uuid, model)
-        response = self._make_request('GET', url, headers)
+        url = '/api/vaults/%s/items?vector=%s&limit=%d' \
+                    % (uuid, dump_vector(vector), self.page_size)
+        headers = []
+        if start:
+            url += '&start=%s' % start
+        else:
+            headers.append(('If-None-Match', vector_digest(vector)))
+        response = self._make_auth_request('GET', url, uuid, model, headers)
         if not response:
             raise SyncAPIError('RemoteError', 'Could not make HTTP request')
         status = response.status
-        if status != 200:
+        if status not in (200, 304) or (status == 304 and start):
             logger.error('expecting HTTP status 200 (got: %s)', status)
             raise SyncAPIError('RemoteError', 'Illegal syncapi response')
         if not self._check_rsa_cb_auth(uuid, response, model):
             raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        if status == 304:
+            logger.debug('peer has the same vector')
+            return response, 0, False
+        # A peer that streams its items also accepts a streamed push. Older
+        # peers send and expect a single JSON list.
+        streaming = response.getheader('Content-Type') == 'text/x-ndjson'
         initems = response.entity
-        if initems is None or not isinstance(initems, list):
-            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
-        nitems = model.import_items(uuid, initems, notify=notify)
+        if streaming:
+            try:
+                nitems = import_stream(model, uuid, initems, notify=notify)
+            except (socket.error, HTTPException, ValueError, zlib.error) as e:
+                logger.error('error reading items from peer: %s', str(e))
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        else:
+            if initems is None or not isinstance(initems, list):
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            import_items(model, uuid, initems, notify=notify)
+            nitems = len(initems)
         logger.debug('imported %d items into model', nitems)
+        return response, nitems, streaming
+
+    def sync(self, uuid, model, notify=True):
+        """Synchronize vault `uuid` with the remote peer.
+
+        Items are retrieved in pages. Each page is imported before the next
+        one is requested, so that an interrupted sync does not need to
+        transfer and import these items again.
+        """
+        if self.connection is None:
+            raise SyncAPIError('ProgrammingError', 'Not connected')
+        logger = self.logger
+        logger.setContext('sync')
+        vault = model.get_vault(uuid)
+        if vault is None:
+            raise SyncAPIError('NotFound', 'Vault not found')
+        start = None
+        nitems = 0
+        while True:
+            response, count, streaming = \
+                    self._get_items_page(uuid, model, start, notify)
+            nitems += count
+            # Older peers do not page, and never set this header.
+            start = response.getheader('X-Continuation')
+            if not start:
+                break
+            logger.debug('continuing sync at %s', start)
         vector = response.getheader('X-Vector', '')
         try:
-            vector = parse_vector(vector)
+            vector = parse_vector(vector) if vector else []
         except ValueError as e:
             logger.error('illegal X-Vector header: %s (%s)', vector, str(e))
             raise SyncAPIError('RemoteError', 'Invalid response')
-        outitems = model.get_items(uuid, vector)
+        # Do not push if the peer already has everything that we have.
+        myvector = model.get_vector(uuid)
+        if vector_covers(vector, myvector):
+            logger.debug('peer is up to date, not pushing')
+            self.peer_vectors[uuid] = vector
+            return nitems
+        pushed = [0]
+        def outitems():
+            pushed[0] = 0
+            for item in model.iter_items(uuid, vector):
+                pushed[0] += 1
+                yield item
+        if not streaming:
+            outitems = model.get_items(uuid, vector)
+            pushed[0] = len(outitems)
         url = '/api/vaults/%s/items' % uuid
-        response = self._make_request('POST', url, headers, outitems)
+        response = self._make_auth_request('POST', url, uuid, model,
+                                           body=outitems)
         if not response:
             raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        status = response.status
         if status != 200:
             logger.error('expecting HTTP status 200 (got: %s)', status)
             raise SyncAPIError('RemoteError', 'Illegal syncapi response')
         if not self._check_rsa_cb_auth(uuid, response, model):
             raise SyncAPIError('RemoteError', 'Illegal syncapi response')
-        logger.debug('succesfully retrieved %d items from peer', len(initems))
-        logger.debug('succesfully pushed %d items to peer', len(outitems))
-        return len(initems) + len(outitems)
+        logger.debug('succesfully retrieved %d items from peer', nitems)
+        logger.debug('succesfully pushed %d items to peer', pushed[0])
+        # The peer now has everything that we had when we pushed.
+        self.peer_vectors[uuid] = merge_vectors(vector, myvector)
+        return nitems + pushed[0]
+
+    def sync_many(self, uuids, model, notify=True):
+        """Synchronize the vaults in `uuids` with the remote peer.
+
+        This does the same as calling sync() for each vault, but it uses a
+        single request to retrieve the items for all vaults, and a single
+        request to push items. Vaults with more items than fit in one page
+        are finished with sync().
+
+        The return value is a dictionary with the number of items that were
+        transferred for each vault, or None for vaults that could not be
+        synced. If the peer does not support batched syncs, None is
+        returned, and the vaults should be synced with sync() instead.
+        """
+        if self.connection is None:
+            raise SyncAPIError('ProgrammingError', 'Not connected')
+        logger = self.logger
+        logger.setContext('sync_many')
+        request = []
+        for uuid in uuids:
+            if model.get_vault(uuid) is None:
+                raise SyncAPIError('NotFound', 'Vault not found')
+            auth = self._get_rsa_cb_auth(uuid, model)[0][1]
+            vector = dump_vector(model.get_vector(uuid))
+            request.append({ 'vault': uuid, 'authorization': auth,
+                             'vector': vector })
+        response = self._make_request('POST', '/api/sync', None, request)
+        if not response:
+            raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+        status = response.status
+        if status == 404:
+            logger.debug('peer does not support batched syncs')
+            return
+        if status != 200 or \
+                response.getheader('Content-Type') != 'text/x-ndjson':
+            logger.error('expecting a streamed HTTP 200 response (got: %s)',
+                         status)
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        results = dict.fromkeys(uuids)
+        vectors = {}
+        continued = []
+        try:
+            for header, items in split_batches(response.entity):
+                uuid = header.get('vault')
+                if uuid not in results or uuid in vectors:
+                    raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+                if header.get('status') not in (200, 304):
+                    logger.error('peer could not sync vault %s (status: %s)',
+                                 uuid, header.get('status'))
+                    if header.get('status') == 401:
+                        # Our session is gone. Use RSA_CB for this vault
+                        # when it is synced individually.
+                        self.sessions.pop(uuid, None)
+                    continue
+                if not self._check_authinfo(uuid, header.get('authinfo', ''),
+                                            model):
+                    raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+                vector = header.get('vector')
+                vectors[uuid] = parse_vector(vector) if vector else []
+                results[uuid] = import_stream(model, uuid, items, notify=notify)
+                if header.get('continuation'):
+                    continued.append(uuid)
+        except (socket.error, HTTPException, ValueError, AttributeError,
+                zlib.error) as e:
+            logger.error('error reading items from peer: %s', str(e))
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        logger.debug('retrieved %d items for %d vaults from peer',
+                     sum(filter(None, results.values())), len(vectors))
+        for uuid in continued:
+            logger.debug('continuing sync of vault %s', uuid)
+            results[uuid] += self.sync(uuid, model, notify)
+            del vectors[uuid]
+        # Push the items that the peer does not have yet.
+        myvectors = {}
+        for uuid in vectors:
+            myvectors[uuid] = model.get_vector(uuid)
+            if vector_covers(vectors[uuid], myvectors[uuid]):
+                self.peer_vectors[uuid] = vectors[uuid]
+                del myvectors[uuid]
+        if not myvectors:
+            return results
+        pushed = dict.fromkeys(myvectors, 0)
+        def outitems():
+            for uuid in myvectors:
+                auth = self._get_rsa_cb_auth(uuid, model)[0][1]
+                yield { '_type': 'SyncHeader', 'vault': uuid,
+                        'authorization': auth }
+                for item in model.iter_items(uuid, vectors[uuid]):
+                    pushed[uuid] += 1
+                    yield item
+        response = self._make_request('POST', '/api/sync/items', None,
+                                      outitems())
+        if not response:
+            raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+        if response.status != 200 or not isinstance(response.entity, list):
+            logger.error('expecting HTTP status 200 (got: %s)', response.status)
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        for result in response.entity:
+            uuid = result.get('vault') if isinstance(result, dict) else None
+            if uuid not in myvectors:
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            if result.get('status') != 200:
+                logger.error('peer did not accept items for vault %s '
+                             '(status: %s)', uuid, result.get('status'))
+                if result.get('status') == 401:
+                    self.sessions.pop(uuid, None)
+                results[uuid] = None
+                continue
+            if not self._check_authinfo(uuid, result.get('authinfo', ''),
+                                        model):
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            results[uuid] += pushed[uuid]
+            self.peer_vectors[uuid] = merge_vectors(vectors[uuid],
+                                                    myvectors[uuid])
+        logger.debug('pushed %d items for %d vaults to peer',
+                     sum(pushed.values()), len(pushed))
+        return results
+
+    def bootstrap(self, uuid, model, notify=True):
+        """Bootstrap vault `uuid` from a snapshot of the remote peer.
+
+        The snapshot contains the certificates and the current item of each
+        version, which is enough to use the vault. The rest of the history
+        can be retrieved later with sync() and reconcile(). The vector of
+        the peer at the time of the snapshot is stored in `peer_vectors`.
+
+        Return the number of items that were imported, or None if the peer
+        cannot provide a snapshot. In that case a sync() should be done.
+        """
+        if self.connection is None:
+            raise SyncAPIError('ProgrammingError', 'Not connected')
+        logger = self.logger
+        logger.setContext('bootstrap')
+        if model.get_vault(uuid) is None:
+            raise SyncAPIError('NotFound', 'Vault not found')
+        url = '/api/vaults/%s/snapshot' % uuid
+        response = self._make_auth_request('GET', url, uuid, model)
+        if not response:
+            raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+        status = response.status
+        if status == 404:
+            logger.debug('peer cannot provide a snapshot')
+            return
+        if status != 200:
+            logger.error('expecting HTTP status 200 (got: %s)', status)
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        if not self._check_rsa_cb_auth(uuid, response, model):
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        snapshot = response.entity
+        try:
+            items = snapshot['items']
+            vector = parse_vector(snapshot['vector'])
+        except (TypeError, KeyError, ValueError, AttributeError):
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        if not isinstance(items, list):
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        count = import_items(model, uuid, items, notify=notify)
+        logger.debug('imported %d items from snapshot', count)
+        self.peer_vectors[uuid] = vector
+        return count
+
+    def _get_range_digests(self, uuid, model, ranges):
+        """Return the peer's digests for `ranges`.
+
+        Return None if the peer does not support range digests.
+        """
+        logger = self.logger
+        url = '/api/vaults/%s/ranges' % uuid
+        body = { 'ranges': ranges, 'maxkeys': self.range_leaf_size }
+        response = self._make_auth_request('POST', url, uuid, model, body=body)
+        if not response:
+            raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+        status = response.status
+        if status == 404:
+            return
+        if status != 200:
+            logger.error('expecting HTTP status 200 (got: %s)', status)
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        if not self._check_rsa_cb_auth(uuid, response, model):
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        digests = response.entity
+        if not isinstance(digests, list) or len(digests) != len(ranges) or \
+                not all((isinstance(d, dict) and 'digest' in d
+                         for d in digests)):
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        return digests
+
+    def _split_range(self, rng):
+        """Split the range `rng` into `range_fanout` sub-ranges."""
+        node, lo, hi = rng
+        step = max(1, (hi - lo + self.range_fanout - 1) // self.range_fanout)
+        return [ [node, start, min(start+step, hi)]
+                 for start in range(lo, hi, step) ]
+
+    def reconcile(self, uuid, model, notify=True):
+        """Find and exchange the items that are missing below the vector.
+
+        A normal sync only transfers items that are newer than the vector.
+        If a node has a gap below its vector, for example because an item
+        was rejected earlier, that gap is never filled by a sync. This method
+        compares digests over (node, seqnr) ranges with the peer, and
+        recursively splits the ranges that differ, until the missing seqnrs
+        are known. Only those items are then fetched and pushed. This takes
+        O(log n) round trips.
+
+        This is meant to run after sync(), when both vectors are equal.
+        Return the number of items that were transferred, or None if the
+        peer does not support reconciliation.
+        """
+        if self.connection is None:
+            raise SyncAPIError('ProgrammingError', 'Not connected')
+        logger = self.logger
+        logger.setContext('reconcile')
+        if model.get_vault(uuid) is None:
+            raise SyncAPIError('NotFound', 'Vault not found')
+        ranges = [ [node, 0, seqnr+1] for node, seqnr in model.get_vector(uuid) ]
+        fetch = []; push = []
+        rounds = 0
+        while ranges:
+            rounds += 1
+            nextranges = []
+            for i in range(0, len(ranges), self.max_ranges):
+                chunk = ranges[i:i+self.max_ranges]
+                theirs = self._get_range_digests(uuid, model, chunk)
+                if theirs is None:
+                    logger.debug('peer does not support reconciliation')
+                    return
+                ours = model.get_range_digests(uuid, chunk, self.range_leaf_size)
+                for rng, remote, local in zip(chunk, theirs, ours):
+                    if remote['digest'] == local['digest']:
+                        continue
+                    remote = remote.get('seqnrs')
+                    if isinstance(remote, list) and 'seqnrs' in local:
+                        remote = set(remote); local = set(local['seqnrs'])
+                        fetch += [ (rng[0], seqnr) for seqnr in remote - local ]
+                        push += [ (rng[0], seqnr) for seqnr in local - remote ]
+                    elif rng[2] - rng[1] > 1:
+                        nextranges += self._split_range(rng)
+            ranges = nextranges
+        logger.debug('reconciled in %d rounds, %d items missing locally, '
+                     '%d items missing remotely', rounds, len(fetch), len(push))
+        fetched = 0
+        url = '/api/vaults/%s/fetch' % uuid
+        for i in range(0, len(fetch), self.max_ranges):
+            body = fetch[i:i+self.max_ranges]
+            response = self._make_auth_request('POST', url, uuid, model,
+                                               body=body)
+            if not response:
+                raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+            if response.status != 200:
+                logger.error('expecting HTTP status 200 (got: %s)',
+                             response.status)
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            if not self._check_rsa_cb_auth(uuid, response, model):
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            items = response.entity
+            if not isinstance(items, list):
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            fetched += import_items(model, uuid, items, notify=notify,
+                                    fill_gaps=True)
+        url = '/api/vaults/%s/items?gaps=1' % uuid
+        for i in range(0, len(push), self.max_ranges):
+            items = model.get_items_by_origin(uuid, push[i:i+self.max_ranges])
+            response = self._make_auth_request('POST', url, uuid, model,
+                                               body=items)
+            if not response:
+                raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+            if response.status != 200:
+                logger.error('expecting HTTP status 200 (got: %s)',
+                             response.status)
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+            if not self._check_rsa_cb_auth(uuid, response, model):
+                raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        logger.debug('fetched %d items and pushed %d items', fetched, len(push))
+        return fetched + len(push)
+
+    def notify(self, uuid, model):
+        """Notify the remote peer that our vector for vault `uuid` changed.
+
+        The peer will sync with us if it does not have our items yet. Return
+        True if the notification was delivered, or False if the peer does
+        not support notifications.
+        """
+        if self.connection is None:
+            raise SyncAPIError('ProgrammingError', 'Not connected')
+        logger = self.logger
+        logger.setContext('notify')
+        url = '/api/vaults/%s/notify' % uuid
+        headers = [('X-Vector', dump_vector(model.get_vector(uuid)))]
+        response = self._make_auth_request('POST', url, uuid, model, headers)
+        if not response:
+            raise SyncAPIError('RemoteError', 'Could not make HTTP request')
+        status = response.status
+        if status == 404:
+            logger.debug('peer does not support notifications')
+            return False
+        if status != 200:
+            logger.error('expecting HTTP status 200 (got: %s)', status)
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        if not self._check_rsa_cb_auth(uuid, response, model):
+            raise SyncAPIError('RemoteError', 'Illegal syncapi response')
+        return True
+
+
+class SyncAPIClientPool(object):
+    """A pool of SyncAPI client connections, keyed by address.
+
+    Clients that are returned to the pool with put() are kept connected for
+    up to `idle_timeout` seconds, and are handed out again by get(). The pool
+    also remembers the last TLS session for each address. A new connection
+    resumes this session, which avoids the expensive Diffie-Hellman key
+    agreement of a full handshake.
+
+    Because RSA_CB and HMAC_CB authentication rely on the tls-unique channel
+    binding, sessions are only resumed if they use the extended master
+    secret. See bluepass.util.ssl.SSLSocket.
+    """
+
+    idle_timeout = 60
+
+    def __init__(self, **ssl_args):
+        """Create a new pool. The `ssl_args` are passed to each client."""
+        self.ssl_args = ssl_args
+        self.idle = {}
+        self.sessions = {}
+        self.logger = logging.getLogger(__name__)
+
+    def _address_key(self, address):
+        """INTERNAL: return a hashable key for `address`."""
+        if isinstance(address, dict):
+            return address['id']
+        return tuple(address)
+
+    def get(self, address):
+        """Return a connected client for `address`.
+
+        An idle client is returned if one is available. Otherwise a new
+        connection is made. A SyncAPIError is raised if this fails.
+        """
+        key = self._address_key(address)
+        idle = self.idle.get(key, [])
+        now = time.time()
+        while idle:
+            since, client = idle.pop()
+            if now - since < self.idle_timeout and client.is_connected():
+                self.logger.debug('reusing connection to %s', key)
+                return client
+            client.close()
+        ssl_args = self.ssl_args.copy()
+        if key in self.sessions:
+            ssl_args['session'] = self.sessions[key]
+        client = SyncAPIClient(address, **ssl_args)
+        client.connect()
+        if client.session_reused():
+            self.logger.debug('resumed TLS session with %s', key)
+        session = client.get_session()
+        if session:
+            self.sessions[key] = session
+        return client
+
+    def put(self, client):
+        """Return a client to the pool, after it was used succesfully."""
+        if not client.is_connected():
+            client.close()
+            return
+        key = self._address_key(client.address)
+        self.idle.setdefault(key, []).append((time.time(), client))
+
+    def discard(self, client):
+        """Close a client that failed, rather than returning it to the
+        pool. The TLS session is still used for the next connection."""
+        client.close()
+
+    def expire(self):
+        """Close clients that have been idle for too long.
+
+        Return the number of seconds until the next client expires, or None
+        if there are no idle clients.
+        """
+        now = time.time()
+        timeout = None
+        for key in list(self.idle):
+            idle = []
+            for since, client in self.idle[key]:
+                remaining = since + self.idle_timeout - now
+                if remaining <= 0:
+                    client.close()
+                    continue
+                idle.append((since, client))
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+            if idle:
+                self.idle[key] = idle
+            else:
+                del self.idle[key]
+        return timeout
+
+    def close(self):
+        """Close all idle clients."""
+        for idle in self.idle.values():
+            for since, client in idle:
+                client.close()
+        self.idle.clear()
 
 
 def expose(path, **kwargs):
@@ -384,6 +1326,32 @@ def expose(path, **kwargs):
     return _f
 
 
+def read_limited(fin, limit, bufsize=16384):
+    """Read the file-like object `fin` until the end. Return None as soon
+    as more than `limit` bytes were read."""
+    chunks = []
+    size = 0
+    while True:
+        chunk = fin.read(bufsize)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            return
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def call_after(result, callbacks):
+    """Iterate over `result`, and call `callbacks` when done."""
+    try:
+        for chunk in result:
+            yield chunk
+    finally:
+        for callback in callbacks:
+            callback()
+
+
 class HTTPReturn(Exception):
     """When raised, this exception will issue a HTTP return."""
 
@@ -401,11 +1369,18 @@ class WSGIApplication(object):
 
     _re_var = re.compile(':([a-z-A-Z_][a-z-A-Z0-9_]*)')
 
+    # Response bodies smaller than this are not compressed.
+    compress_threshold = 1024
+    # The maximum size of a request body, after decompression. For a
+    # streamed body, this is the maximum size of a single object.
+    max_entity_size = 16*1024*1024
+
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.routes = []
         self._init_mapper()
         self.local = local.local()
+        self.stats = { 'requests': 0, 'rejected': 0, 'too_large': 0 }
 
     def _init_mapper(self):
         """Add all routes that were configured with the @expose() decorator."""
@@ -443,11 +1418,40 @@ class WSGIApplication(object):
 
     headers = property(_get_headers)
 
+    def _get_entity(self):
+        return self.local.entity
+
+    entity = property(_get_entity)
+
+    def at_end(self, callback):
+        """Call `callback` when the current request is done. For a streamed
+        response, this is after the response body was sent."""
+        self.local.at_end.append(callback)
+
     def __call__(self, env, start_response):
         """WSGI entry point."""
+        callbacks = self.local.at_end = []
+        self.stats['requests'] += 1
+        try:
+            result = self._handle_request(env, start_response)
+        except:
+            for callback in callbacks:
+                callback()
+            raise
+        if isinstance(result, types.GeneratorType):
+            return call_after(result, callbacks)
+        for callback in callbacks:
+            callback()
+        return result
+
+    def _handle_request(self, env, start_response):
+        """Handle a single request."""
         logger = self.logger
         self.local.environ = env
-        self.local.headers = []
+        # Tell the client that it may compress its request bodies.
+        accept = ', '.join([ coding for coding, wbits in content_encodings ])
+        self.local.headers = [('Accept-Encoding', accept),
+                              ('X-Features', ' '.join(node_features))]
         self.local.start_response = start_response
         logger.debug('server request: %s %s', env['REQUEST_METHOD'], env['PATH_INFO'])
         match = self._match_routes(env)
@@ -456,16 +1460,39 @@ class WSGIApplication(object):
         for key in match:
             env['mapper.%s' % key] = match[key]
         ctype = env.get('CONTENT_TYPE')
-        if ctype:
+        coding = env.get('HTTP_CONTENT_ENCODING')
+        reader = env['wsgi.input']
+        # Reject bodies that are too large before reading them, if we can.
+        # Chunked or compressed bodies are rejected once the limit is hit.
+        length = env.get('CONTENT_LENGTH')
+        if length and length.isdigit() and ctype != 'text/x-ndjson' \
+                    and int(length) > self.max_entity_size:
+            self.stats['too_large'] += 1
+            return self._simple_response(http.REQUEST_ENTITY_TOO_LARGE)
+        if coding:
+            if coding not in dict(content_encodings):
+                return self._simple_response(http.UNSUPPORTED_MEDIA_TYPE)
+            reader = Decompressor(reader)
+        if ctype == 'text/x-ndjson':
+            # Streamed request: the handler parses it while it is read.
+            self.local.entity = json.iterloads(reader,
+                                               maxline=self.max_entity_size)
+        elif ctype:
             if ctype != 'text/json':
                 return self._simple_response(http.UNSUPPORTED_MEDIA_TYPE)
-            entity = env['wsgi.input'].read()
+            try:
+                entity = read_limited(reader, self.max_entity_size)
+            except zlib.error:
+                return self._simple_response(http.BAD_REQUEST)
+            if entity is None:
+                self.stats['too_large'] += 1
+                return self._simple_response(http.REQUEST_ENTITY_TOO_LARGE)
             entity = json.try_loads(entity)
             if entity is None:
                 return self._simple_response(http.BAD_REQUEST)
-            self.entity = entity
+            self.local.entity = entity
         else:
-            self.entity = None
+            self.local.entity = None
         handler = getattr(self,  match['handler'])
         try:
             result = handler(env)
@@ -476,18 +1503,44 @@ class WSGIApplication(object):
             lines += traceback.format_exception(*sys.exc_info())
             self.logger.error(''.join(lines))
             return self._simple_response(http.INTERNAL_SERVER_ERROR)
+        encoding = select_encoding(env.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+        if isinstance(result, types.GeneratorType):
+            # Streamed response: sent chunked as newline delimited JSON.
+            self.headers.append(('Content-Type', 'text/x-ndjson'))
+            result = json.iterdumps(result)
+            if encoding:
+                self.headers.append(('Content-Encoding', encoding))
+                result = compress_stream(result, encoding)
+            start_response('200 OK', self.headers)
+            return result
         if result is not None:
             result = json.dumps(result)
             self.headers.append(('Content-Type', 'text/json'))
+            if encoding and len(result) >= self.compress_threshold:
+                result = compress(result, encoding)
+                self.headers.append(('Content-Encoding', encoding))
         else:
             result = ''
         start_response('200 OK', self.headers)
         return [result]
 
-    def _simple_response(self, status, headers=[]):
+    def accepts(self, ctype):
+        """Return whether the client accepts the media type `ctype`."""
+        accept = self.environ.get('HTTP_ACCEPT', '')
+        ctypes = [ value.split(';')[0].strip() for value in accept.split(',') ]
+        return ctype in ctypes
+
+    def _simple_response(self, status, headers=None):
         """Return a simple text/plain response."""
         if isinstance(status, int):
             status = '%s %s' % (status, http.responses[status])
+        headers = list(headers or [])
+        if status.startswith('304 '):
+            # A 304 response does not have a body.
+            self.local.start_response(status, headers)
+            return []
         headers.append(('Content-Type', 'text/plain'))
         headers.append(('Content-Length', str(len(status))))
         self.local.start_response(status, headers)
@@ -497,11 +1550,52 @@ class WSGIApplication(object):
 class SyncAPIApplication(WSGIApplication):
     """A WSGI application that implements our SyncAPI."""
 
-    def __init__(self):
+    # The maximum number of items per page in a paged sync.
+    max_page_size = 1000
+    # The maximum number of ranges, or items to fetch, per reconciliation
+    # request, and the maximum number of seqnrs listed for a range.
+    max_ranges = 1000
+    max_range_keys = 256
+    # The maximum number of authenticated sessions, and their lifetime.
+    max_sessions = 1000
+    session_lifetime = 3600
+    # The maximum number of concurrent requests per peer node. Requests
+    # beyond this are rejected, and the peer may retry after the number
+    # of seconds in "retry_after".
+    max_node_requests = 4
+    retry_after = 10
+    # The maximum number of vaults in a batched sync.
+    max_batch_size = 50
+
+    def __init__(self, model=None, max_node_requests=None,
+                 max_entity_size=None):
         super(SyncAPIApplication, self).__init__()
+        self._model = model
+        if max_node_requests is not None:
+            self.max_node_requests = max_node_requests
+        if max_entity_size is not None:
+            self.max_entity_size = max_entity_size
         self.crypto = CryptoProvider()
         self.allow_pairing = False
         self.key_exchanges = {}
+        self.sessions = collections.OrderedDict()
+        self.active = {}
+        self.callbacks = []
+
+    @property
+    def model(self):
+        """The model that is served. This is the Model instance, unless a
+        model was passed to the constructor."""
+        return self._model or instance(Model)
+
+    def add_callback(self, callback):
+        """Add a callback that gets notified of events."""
+        self.callbacks.append(callback)
+
+    def raise_event(self, event, *args):
+        """Raise an event to all registered callbacks."""
+        for callback in self.callbacks:
+            callback(event, *args)
 
     def _do_auth_hmac_cb(self, uuid):
         """Perform mutual HMAC_CB authentication."""
@@ -547,7 +1641,7 @@ class SyncAPIApplication(WSGIApplication):
                 raise HTTPReturn('403 Request Timeout')
             cb = self.environ['SSL_CHANNEL_BINDING_TLS_UNIQUE']
             check = self.crypto.hmac(adjust_pin(pin, +1), cb, 'sha1')
-            if check != signature:
+            if not self.crypto.compare_digest(check, signature):
                 raise HTTPReturn('403 Invalid PIN')
             bus = instance(MessageBusServer)
             bus.send_signal(None, 'PairingComplete', kxid)
@@ -560,24 +1654,90 @@ class SyncAPIApplication(WSGIApplication):
         else:
             raise HTTPReturn(http.UNAUTHORIZED, headers)
  
+    def _admit(self, node):
+        """Admit a request from `node`, or reject it with "503 Service
+        Unavailable" if the node has too many requests in progress."""
+        active = self.active.get(node, 0)
+        if active >= self.max_node_requests:
+            self.stats['rejected'] += 1
+            headers = [('Retry-After', str(self.retry_after))]
+            raise HTTPReturn(http.SERVICE_UNAVAILABLE, headers)
+        self.active[node] = active + 1
+        def release():
+            self.active[node] -= 1
+            if not self.active[node]:
+                del self.active[node]
+        self.at_end(release)
+
+    def _check_session_cb(self, uuid, opts, headers):
+        """Perform mutual SESSION_CB authentication. Return a tuple with
+        the UUID of the peer node, and our Authentication-Info."""
+        cb = self.environ['SSL_CHANNEL_BINDING_TLS_UNIQUE']
+        session = self.sessions.get((cb, uuid))
+        if session is None:
+            raise HTTPReturn(http.UNAUTHORIZED, headers)
+        node, key, created = session
+        if time.time() - created > self.session_lifetime:
+            del self.sessions[(cb, uuid)]
+            raise HTTPReturn(http.UNAUTHORIZED, headers)
+        signature = base64.try_decode(opts.get('signature', ''))
+        check = self.crypto.hmac(key, 'client' + cb)
+        if opts.get('node') != node or not signature \
+                    or not self.crypto.compare_digest(check, signature):
+            raise HTTPReturn(http.UNAUTHORIZED, headers)
+        vault = self.model.get_vault(uuid)
+        signature = base64.encode(self.crypto.hmac(key, 'server' + cb))
+        auth = create_option_header('SESSION_CB', node=vault['node'],
+                                    signature=signature)
+        return node, auth
+
+    def _add_session(self, cb, uuid, node):
+        """Establish a session for `node` in vault `uuid` on the connection
+        with channel binding `cb`. Return the session key."""
+        key = self.crypto.random(32)
+        self.sessions.pop((cb, uuid), None)
+        self.sessions[(cb, uuid)] = (node, key, time.time())
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return key
+
     def _do_auth_rsa_cb(self, uuid):
-        """Perform mutual RSA_CB authentication."""
+        """Perform mutual RSA_CB authentication. Return the UUID of the peer
+        node.
+
+        On success, a session is established that is tied to the channel
+        binding of the connection. Later requests on the same connection may
+        authenticate with SESSION_CB, which uses a HMAC with the session key
+        instead of RSA signatures.
+        """
+        auth = self.environ.get('HTTP_AUTHORIZATION')
+        node, authinfo = self._check_rsa_cb(uuid, auth)
+        self.headers.append(('Authentication-Info', authinfo))
+        return node
+
+    def _check_rsa_cb(self, uuid, auth):
+        """Check the RSA_CB or SESSION_CB authorization `auth` for vault
+        `uuid`. Return a tuple with the UUID of the peer node, and our
+        Authentication-Info. An HTTPReturn is raised on failure."""
         wwwauth = create_option_header('RSA_CB', realm=uuid)
         headers = [('WWW-Authenticate', wwwauth)]
-        auth = self.environ.get('HTTP_AUTHORIZATION')
         if auth  is None:
             raise HTTPReturn(http.UNAUTHORIZED, headers)
         try:
             method, opts = parse_option_header(auth)
         except ValueError:
             raise HTTPReturn(http.UNAUTHORIZED, headers)
-        if method != 'RSA_CB':
-            raise HTTPReturn(http.UNAUTHORIZED, headers)
         if 'node' not in opts or not check_uuid4(opts['node']):
             raise HTTPReturn(http.UNAUTHORIZED, headers)
+        # Admission control is done before the expensive part.
+        self._admit(opts['node'])
+        if method == 'SESSION_CB':
+            return self._check_session_cb(uuid, opts, headers)
+        if method != 'RSA_CB':
+            raise HTTPReturn(http.UNAUTHORIZED, headers)
         if 'signature' not in opts or not base64.check(opts['signature']):
             raise HTTPReturn(http.UNAUTHORIZED, headers)
-        model = instance(Model)
+        model = self.model
         cert = model.get_certificate(uuid, opts['node'])
         if cert is None:
             raise HTTPReturn(http.UNAUTHORIZED, headers)
@@ -592,15 +1752,17 @@ class SyncAPIApplication(WSGIApplication):
         node = vault['node']
         signature = self.crypto.rsa_sign(cb, privkey, 'pss-sha1')
         signature = base64.encode(signature)
-        auth = create_option_header('RSA_CB', node=node, signature=signature)
-        self.headers.append(('Authentication-Info', auth))
+        key = self._add_session(cb, uuid, opts['node'])
+        auth = create_option_header('RSA_CB', node=node, signature=signature,
+                                    session=base64.encode(key))
+        return opts['node'], auth
 
     @expose('/api/vaults/:vault/pair', method='POST')
     def pair(self, env):
         uuid = env['mapper.vault']
         if not check_uuid4(uuid):
             raise HTTPReturn(http.NOT_FOUND)
-        model = instance(Model)
+        model = self.model
         vault = model.get_vault(uuid)
         if not vault:
             raise HTTPReturn(http.NOT_FOUND)
@@ -611,19 +1773,14 @@ class SyncAPIApplication(WSGIApplication):
             raise HTTPReturn(http.BAD_REQUEST)
         model.add_certificate(uuid, certinfo)
         # And send our own certificate request in return
-        certinfo = { 'node': vault['node'], 'name': socket.gethostname() }
-        certkeys = certinfo['keys'] = {}
-        for key in vault['keys']:
-            certkeys[key] = { 'key': vault['keys'][key]['public'],
-                              'keytype': vault['keys'][key]['keytype'] }
-        return certinfo
+        return model.get_certinfo(uuid)
 
     @expose('/api/vaults/:vault/items', method='GET')
     def sync_outbound(self, env):
         uuid = env['mapper.vault']
         if not check_uuid4(uuid):
             raise HTTPReturn(http.NOT_FOUND)
-        model = instance(Model)
+        model = self.model
         vault = model.get_vault(uuid)
         if vault is None:
             raise HTTPReturn(http.NOT_FOUND)
@@ -635,25 +1792,235 @@ class SyncAPIApplication(WSGIApplication):
                 vector = parse_vector(vector)
             except ValueError:
                 raise HTTPReturn(http.BAD_REQUEST)
-        items = model.get_items(uuid, vector)
+        limit = args.get('limit', [''])[0]
+        start = args.get('start', [''])[0]
+        try:
+            limit = min(int(limit), self.max_page_size) if limit else None
+            start = parse_vector(start) if start else None
+        except ValueError:
+            raise HTTPReturn(http.BAD_REQUEST)
+        if (limit is not None and limit <= 0) or (start and len(start) != 1):
+            raise HTTPReturn(http.BAD_REQUEST)
         myvector = model.get_vector(uuid)
         self.headers.append(('X-Vector', dump_vector(myvector)))
-        return items
+        # Fast path: the client has the same vector as we do.
+        etag = vector_digest(myvector)
+        self.headers.append(('ETag', etag))
+        if not start and env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise HTTPReturn(http.NOT_MODIFIED, self.headers)
+        items = model.iter_items(uuid, vector or None,
+                                 start=start[0] if start else None)
+        if limit is not None:
+            # Paged sync. The page is read ahead by one item to find out if
+            # a continuation is needed. The continuation token is the
+            # (node, seqnr) position of the last item in the page.
+            page = list(itertools.islice(items, limit + 1))
+            if len(page) > limit:
+                del page[limit:]
+                origin = page[-1]['origin']
+                token = dump_vector([(origin['node'], origin['seqnr'])])
+                self.headers.append(('X-Continuation', token))
+            items = (item for item in page)
+        if self.accepts('text/x-ndjson'):
+            return items
+        return list(items)
 
     @expose('/api/vaults/:vault/items', method='POST')
     def sync_inbound(self, env):
         uuid = env['mapper.vault']
         if not check_uuid4(uuid):
             raise HTTPReturn(http.NOT_FOUND)
-        model = instance(Model)
+        model = self.model
         vault = model.get_vault(uuid)
         if vault is None:
             raise HTTPReturn(http.NOT_FOUND)
         self._do_auth_rsa_cb(uuid)
+        # The items are only stored before we respond. Their signatures are
+        # verified and they are decrypted by a background job, so that a
+        # large push does not block the backend.
         items = self.entity
+        if isinstance(items, types.GeneratorType):
+            try:
+                import_stream(model, uuid, items, defer=True)
+            except (ValueError, zlib.error):
+                raise HTTPReturn(http.BAD_REQUEST)
+            return
         if items is None or not isinstance(items, list):
             raise HTTPReturn(http.BAD_REQUEST)
-        model.import_items(uuid, items)
+        # Items that fill gaps below our vector are pushed during
+        # reconciliation.
+        args = parse_qs(env.get('QUERY_STRING', ''))
+        fill_gaps = args.get('gaps', [''])[0] == '1'
+        import_items(model, uuid, items, fill_gaps=fill_gaps, defer=True)
+
+    @expose('/api/vaults/:vault/ranges', method='POST')
+    def range_digests(self, env):
+        uuid = env['mapper.vault']
+        if not check_uuid4(uuid):
+            raise HTTPReturn(http.NOT_FOUND)
+        model = self.model
+        vault = model.get_vault(uuid)
+        if vault is None:
+            raise HTTPReturn(http.NOT_FOUND)
+        self._do_auth_rsa_cb(uuid)
+        request = self.entity
+        if not isinstance(request, dict) or \
+                not isinstance(request.get('ranges'), list) or \
+                len(request['ranges']) > self.max_ranges or \
+                not isinstance(request.get('maxkeys', 0), (int, long)):
+            raise HTTPReturn(http.BAD_REQUEST)
+        maxkeys = min(request.get('maxkeys', 0), self.max_range_keys)
+        try:
+            return model.get_range_digests(uuid, request['ranges'], maxkeys)
+        except ModelError:
+            raise HTTPReturn(http.BAD_REQUEST)
+
+    @expose('/api/vaults/:vault/fetch', method='POST')
+    def fetch(self, env):
+        uuid = env['mapper.vault']
+        if not check_uuid4(uuid):
+            raise HTTPReturn(http.NOT_FOUND)
+        model = self.model
+        vault = model.get_vault(uuid)
+        if vault is None:
+            raise HTTPReturn(http.NOT_FOUND)
+        self._do_auth_rsa_cb(uuid)
+        keys = self.entity
+        if not isinstance(keys, list) or len(keys) > self.max_ranges:
+            raise HTTPReturn(http.BAD_REQUEST)
+        try:
+            return model.get_items_by_origin(uuid, keys)
+        except ModelError:
+            raise HTTPReturn(http.BAD_REQUEST)
+
+    @expose('/api/vaults/:vault/snapshot', method='GET')
+    def snapshot(self, env):
+        uuid = env['mapper.vault']
+        if not check_uuid4(uuid):
+            raise HTTPReturn(http.NOT_FOUND)
+        model = self.model
+        vault = model.get_vault(uuid)
+        if vault is None:
+            raise HTTPReturn(http.NOT_FOUND)
+        self._do_auth_rsa_cb(uuid)
+        # The current versions are only known when the vault is unlocked.
+        # Otherwise the client falls back to a full sync.
+        if model.vault_is_locked(uuid):
+            raise HTTPReturn(http.NOT_FOUND, self.headers)
+        vector = model.get_vector(uuid)
+        items = model.get_snapshot_items(uuid)
+        return { 'vector': dump_vector(vector), 'items': items }
+
+    @expose('/api/vaults/:vault/notify', method='POST')
+    def notify(self, env):
+        uuid = env['mapper.vault']
+        if not check_uuid4(uuid):
+            raise HTTPReturn(http.NOT_FOUND)
+        model = self.model
+        vault = model.get_vault(uuid)
+        if vault is None:
+            raise HTTPReturn(http.NOT_FOUND)
+        node = self._do_auth_rsa_cb(uuid)
+        try:
+            vector = parse_vector(env.get('HTTP_X_VECTOR', ''))
+        except ValueError:
+            raise HTTPReturn(http.BAD_REQUEST)
+        # Only raise an event if the peer has items that we do not have.
+        # This stops notifications from bouncing back and forth.
+        if not vector_covers(model.get_vector(uuid), vector):
+            self.raise_event('PeerUpdated', uuid, node)
+
+
+    @expose('/api/sync', method='POST')
+    def sync_many_outbound(self, env):
+        request = self.entity
+        if not isinstance(request, list) or len(request) > self.max_batch_size:
+            raise HTTPReturn(http.BAD_REQUEST)
+        for entry in request:
+            if not isinstance(entry, dict) or not check_uuid4(entry.get('vault')):
+                raise HTTPReturn(http.BAD_REQUEST)
+        model = self.model
+        # The vaults are authenticated and read one by one while the response
+        # is streamed, so that only one page of items is held in memory. A
+        # header with the status of each vault precedes its items.
+        def sync_vaults():
+            for entry in request:
+                uuid = entry['vault']
+                header = { '_type': 'SyncHeader', 'vault': uuid }
+                vault = model.get_vault(uuid)
+                if vault is None:
+                    header['status'] = http.NOT_FOUND
+                    yield header
+                    continue
+                try:
+                    node, authinfo = self._check_rsa_cb(uuid,
+                                                entry.get('authorization'))
+                    vector = entry.get('vector')
+                    vector = parse_vector(vector) if vector else []
+                except HTTPReturn as e:
+                    status = e.status
+                    if not isinstance(status, int):
+                        status = int(status.split()[0])
+                    header['status'] = status
+                    yield header
+                    continue
+                except (ValueError, AttributeError):
+                    header['status'] = http.BAD_REQUEST
+                    yield header
+                    continue
+                header['authinfo'] = authinfo
+                myvector = model.get_vector(uuid)
+                header['vector'] = dump_vector(myvector)
+                if vector_digest(vector) == vector_digest(myvector):
+                    header['status'] = http.NOT_MODIFIED
+                    yield header
+                    continue
+                items = model.iter_items(uuid, vector or None)
+                limit = self.max_page_size
+                page = list(itertools.islice(items, limit + 1))
+                if len(page) > limit:
+                    del page[limit:]
+                    origin = page[-1]['origin']
+                    token = dump_vector([(origin['node'], origin['seqnr'])])
+                    header['continuation'] = token
+                header['status'] = http.OK
+                yield header
+                for item in page:
+                    yield item
+        return sync_vaults()
+
+    @expose('/api/sync/items', method='POST')
+    def sync_many_inbound(self, env):
+        objects = self.entity
+        if not isinstance(objects, types.GeneratorType):
+            raise HTTPReturn(http.BAD_REQUEST)
+        model = self.model
+        results = []
+        try:
+            for header, items in split_batches(objects):
+                uuid = header.get('vault')
+                result = { 'vault': uuid }
+                results.append(result)
+                if len(results) > self.max_batch_size:
+                    raise HTTPReturn(http.BAD_REQUEST)
+                if not check_uuid4(uuid) or model.get_vault(uuid) is None:
+                    result['status'] = http.NOT_FOUND
+                    continue
+                try:
+                    node, authinfo = self._check_rsa_cb(uuid,
+                                                header.get('authorization'))
+                except HTTPReturn as e:
+                    status = e.status
+                    if not isinstance(status, int):
+                        status = int(status.split()[0])
+                    result['status'] = status
+                    continue
+                import_stream(model, uuid, items, defer=True)
+                result['status'] = http.OK
+                result['authinfo'] = authinfo
+        except (ValueError, zlib.error):
+            raise HTTPReturn(http.BAD_REQUEST)
+        return results
 
 
 class SyncAPIHandler(WSGIHandler):
@@ -667,17 +2034,83 @@ class SyncAPIHandler(WSGIHandler):
 
 
 class SyncAPIServer(WSGIServer):
-    """The WSGI server that runs the syncapi."""
+    """The WSGI server that runs the syncapi.
+
+    Connections are handled by a pool of `pool_size` greenlets. When the
+    pool is full, new connections are not accepted until a handler becomes
+    free, and they wait in the listen backlog instead. The number of times
+    this happened, and the total time that accepting was paused, are
+    available from get_stats().
+    """
 
     handler_class = SyncAPIHandler
+    pool_size = 10
 
-    def __init__(self, listener, application, **ssl_args):
+    def __init__(self, listener, application, pool_size=None, **ssl_args):
         listener.setblocking(0)
         ssl_args.setdefault('dhparams', dhparams['skip2048'])
         ssl_args.setdefault('ciphers', 'ADH+AES')
-        super(SyncAPIServer, self).__init__(listener, application, spawn=10,
+        ssl_args.setdefault('ticket_keys', session_ticket_keys)
+        spawn = Pool(pool_size or self.pool_size)
+        super(SyncAPIServer, self).__init__(listener, application, spawn=spawn,
                                             log=None, **ssl_args)
         self.wrap_socket = wrap_socket
+        self.accept_paused = 0
+        self.accept_paused_time = 0.0
+        self._paused_since = None
+
+    def stop_accepting(self):
+        # This is called when the pool is full, and when the server stops.
+        if self._paused_since is None and self.pool.full() and self.started:
+            self.accept_paused += 1
+            self._paused_since = time.time()
+        super(SyncAPIServer, self).stop_accepting()
+
+    def start_accepting(self):
+        if self._paused_since is not None:
+            self.accept_paused_time += time.time() - self._paused_since
+            self._paused_since = None
+        super(SyncAPIServer, self).start_accepting()
+
+    def get_backlog(self):
+        """Return the number of connections that are waiting to be
+        accepted, or None if this is not known on this platform."""
+        # On Linux, the "unacked" field of the TCP_INFO of a listening socket
+        # holds the length of its accept queue.
+        if not hasattr(socket, 'TCP_INFO'):
+            return
+        try:
+            info = self.socket.getsockopt(socket.IPPROTO_TCP,
+                                          socket.TCP_INFO, 104)
+        except socket.error:
+            return
+        if len(info) < 28:
+            return
+        return struct.unpack_from('=I', info, 24)[0]
+
+    def get_stats(self):
+        """Return a dictionary with statistics on the request handlers.
+
+        Next to the request counters of the application, this contains the
+        size of the handler pool ("pool_size"), the number of busy handlers
+        ("busy"), the number of connections waiting to be accepted
+        ("backlog", None if unknown), how often accepting was paused because
+        the pool was full ("accept_paused") and for how many seconds in
+        total ("accept_paused_time"), and the number of nodes with requests
+        in progress ("active_nodes").
+        """
+        application = self.application
+        stats = dict(application.stats)
+        stats['pool_size'] = self.pool.size
+        stats['busy'] = len(self.pool)
+        stats['backlog'] = self.get_backlog()
+        stats['accept_paused'] = self.accept_paused
+        paused_time = self.accept_paused_time
+        if self._paused_since is not None:
+            paused_time += time.time() - self._paused_since
+        stats['accept_paused_time'] = paused_time
+        stats['active_nodes'] = len(getattr(application, 'active', ()))
+        return stats
 
 
 class SyncAPIPublisher(Greenlet):
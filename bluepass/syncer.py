@@ -7,15 +7,70 @@
 # licensing terms.
 
 import time
+import heapq
+import random
 import logging
 
-from gevent import Greenlet
+from gevent import Greenlet, Timeout
 from gevent.event import Event
+from gevent.pool import Pool
 
 from bluepass.factory import instance
 from bluepass.model import Model
 from bluepass.locator import Locator
-from bluepass.syncapi import SyncAPIClient, SyncAPIError
+from bluepass.syncapi import SyncAPIApplication, SyncAPIClientPool, \
+        SyncAPIError, vector_covers
+
+
+class SyncSchedule(object):
+    """A priority queue of the times at which nodes are due for a sync.
+
+    Each node has at most one due time. Rescheduling a node pushes a new
+    entry onto the heap and leaves the old one in place; stale entries are
+    skipped when they reach the top. All operations are O(log n).
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self, node):
+        return node in self.due
+
+    def schedule(self, node, due):
+        """Schedule `node` to be synced at time `due`."""
+        self.due[node] = due
+        heapq.heappush(self.heap, (due, node))
+
+    def remove(self, node):
+        """Remove `node` from the schedule."""
+        self.due.pop(node, None)
+
+    def _prune(self):
+        """Drop stale entries from the top of the heap."""
+        heap = self.heap
+        while heap and self.due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_due(self):
+        """Return the earliest due time, or None if the schedule is empty."""
+        self._prune()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return the nodes that are due at time `now`."""
+        nodes = []
+        self._prune()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            due, node = heapq.heappop(heap)
+            del self.due[node]
+            nodes.append(node)
+            self._prune()
+        return nodes
 
 
 class Syncer(Greenlet):
@@ -25,18 +80,87 @@ class Syncer(Greenlet):
     synchronization. The sync jobs are run either periodically, or based on
     certain system events, like a neighbor becoming visible on the network or
     an entry being added.
+
+    When the vector of a vault changes, for example because items were
+    imported from another node, the syncer notifies the other peers of the
+    vault. Peers that do not have these items yet will then sync with us. In
+    the same way, we sync with a peer when it notifies us.
+
+    The sync state of each peer is stored in the database. This includes the
+    time of the last succesful sync, so that a restart does not cause a sync
+    with every peer at once. It also includes the peer's vector after the
+    last sync, so that peers that already have our items are not notified.
+
+    Periodic syncs are kept in a SyncSchedule. The interval of each peer
+    adapts to its activity: it is halved after a sync that transferred
+    items, and doubled after a sync that did not, within the bounds of
+    `min_interval` and `max_interval`. The schedule is updated from events,
+    so a wakeup only looks at the peers that are due.
+
+    The model, locator, syncapi application and client pool default to the
+    process wide instances. Passing them to the constructor allows multiple
+    syncers to run in one process, as in the sync simulation.
     """
 
+    # Initial interval between syncs with a peer, and its bounds.
     interval = 300
+    min_interval = 60
+    max_interval = 1800
+    # Relative random spread that is applied to sync intervals and backoff
+    # delays, so that peers do not synchronize their retries.
+    jitter = 0.1
+    # Number of addresses that are synced concurrently.
+    concurrency = 5
+    # Deadline in seconds for syncing with a single address.
+    timeout = 120
+    # Minimum and maximum delay before retrying a failed address. The delay
+    # doubles on every consecutive failure.
+    backoff_min = 10
+    backoff_max = 1800
+    # Interval in seconds at which a node is reconciled after a sync.
+    reconcile_interval = 3600
 
-    def __init__(self):
+    def __init__(self, model=None, locator=None, application=None,
+                 client_pool=None):
         """Constructor."""
         super(Syncer, self).__init__()
+        self._model = model
+        self._locator = locator
+        self._application = application
+        self._client_pool = client_pool
         self.logger = logging.getLogger(__name__)
         self.queue = []
         self.queue_notempty = Event()
         self.neighbors = {}
+        self.vault_nodes = {}
+        self.address_nodes = {}
+        self.schedule = SyncSchedule()
+        self.intervals = {}
         self.last_sync = {}
+        self.last_reconcile = {}
+        self.backoff = {}
+        self.syncing = set()
+        self.notify_vaults = set()
+
+    @property
+    def model(self):
+        """The model whose vaults are synced."""
+        return self._model or instance(Model)
+
+    @property
+    def locator(self):
+        """The locator that is used to find our peers."""
+        return self._locator or instance(Locator)
+
+    @property
+    def application(self):
+        """The syncapi application that receives notifications from peers."""
+        return self._application or instance(SyncAPIApplication)
+
+    @property
+    def client_pool(self):
+        """The pool of syncapi clients that connect to our peers."""
+        return self._client_pool or instance(SyncAPIClientPool)
 
     def _event_callback(self, event, *args):
         """Store events and wake up the main loop."""
@@ -46,53 +170,347 @@ class Syncer(Greenlet):
     def set_last_sync(self, node, time):
         """Set the last_sync time for `node` to `time`."""
         self.last_sync[node] = time
+        if node in self.schedule:
+            self.schedule.schedule(node, time + self._jittered(self.interval))
+
+    def _jittered(self, delay):
+        """Return `delay` with a random spread of `jitter` applied."""
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _add_neighbor(self, neighbor):
+        """Start tracking `neighbor`, or update it if it is known."""
+        node = neighbor['node']
+        if node in self.neighbors:
+            self._remove_addresses(self.neighbors[node])
+        self.neighbors[node] = neighbor
+        self.vault_nodes.setdefault(neighbor['vault'], set()).add(node)
+        for addr in neighbor['addresses']:
+            self.address_nodes.setdefault(addr['id'], set()).add(node)
+        if node not in self.schedule:
+            due = self.last_sync.get(node, 0) + self.intervals.get(node,
+                                                            self.interval)
+            self.schedule.schedule(node, due)
+
+    def _remove_addresses(self, neighbor):
+        """Remove the addresses of `neighbor` from the address index."""
+        for addr in neighbor['addresses']:
+            nodes = self.address_nodes.get(addr['id'], set())
+            nodes.discard(neighbor['node'])
+            if not nodes:
+                self.address_nodes.pop(addr['id'], None)
+
+    def _remove_neighbor(self, neighbor):
+        """Stop tracking `neighbor`."""
+        node = neighbor['node']
+        neighbor = self.neighbors.pop(node, neighbor)
+        self._remove_addresses(neighbor)
+        nodes = self.vault_nodes.get(neighbor['vault'], set())
+        nodes.discard(node)
+        if not nodes:
+            self.vault_nodes.pop(neighbor['vault'], None)
+        self.schedule.remove(node)
+
+    def _reschedule(self, node, changed=False, failed=False):
+        """Schedule the next periodic sync with `node` after a sync.
+
+        A sync that `changed` items shortens the interval, and a sync that
+        did not lengthens it. After a failure, the node is retried when its
+        first address is no longer backing off.
+        """
+        if node not in self.neighbors:
+            return
+        now = time.time()
+        if failed:
+            retry = min([ self._retry_time(addr['id'])
+                          for addr in self.neighbors[node]['addresses'] ]
+                        or [0])
+            due = max(retry, now + self._jittered(self.backoff_min))
+            self.schedule.schedule(node, due)
+            return
+        interval = self.intervals.get(node, self.interval)
+        if changed:
+            interval = max(self.min_interval, interval // 2)
+        else:
+            interval = min(self.max_interval, interval * 2)
+        self.intervals[node] = interval
+        self.schedule.schedule(node, now + self._jittered(interval))
+
+    def _is_peer(self, node, mynodes, myvaults):
+        """Return whether we sync with `node`."""
+        neighbor = self.neighbors.get(node)
+        if neighbor is None or node in mynodes:
+            return False
+        vault = neighbor['vault']
+        return vault in myvaults and \
+                bool(self.model.get_certificate(vault, node))
+
+    def _update_backoff(self, key, failed):
+        """Update the backoff state for the address with key `key`."""
+        if not failed:
+            self.backoff.pop(key, None)
+            return
+        failures = self.backoff.get(key, (0, 0))[0] + 1
+        delay = min(self.backoff_max, self.backoff_min * 2 ** (failures - 1))
+        delay = self._jittered(delay)
+        self.backoff[key] = (failures, time.time() + delay)
+        self.logger.debug('backing off from %s for %d seconds', key, delay)
+
+    def _set_busy(self, key, due):
+        """Do not use the address with key `key` before `due`, because the
+        peer is busy. Unlike a failure, this does not increase the backoff."""
+        failures, retry = self.backoff.get(key, (0, 0))
+        self.backoff[key] = (failures, max(retry, due))
+
+    def _retry_time(self, key):
+        """Return the time at which address `key` may be tried again."""
+        return self.backoff.get(key, (0, 0))[1]
+
+    def _update_peer_state(self, vault, node, client, starttime, failed):
+        """Store the outcome of a sync with `node` in the database."""
+        model = self.model
+        state = model.get_peer_state(vault, node) or {}
+        if failed:
+            state['failures'] = state.get('failures', 0) + 1
+            state['last_failure'] = time.time()
+        else:
+            state['failures'] = 0
+            state['last_sync'] = starttime
+            state['vector'] = client.peer_vectors.get(vault)
+            state['features'] = client.peer_features
+            state['rtt'] = client.rtt
+        model.update_peer_state(vault, node, state)
+
+    def _connect(self, addr, stats):
+        """Return a client connected to `addr`, or None on failure."""
+        pool = self.client_pool
+        try:
+            client = pool.get(addr)
+        except SyncAPIError as e:
+            self.logger.error('could not connect to %s: %s', addr, str(e))
+            return
+        self.logger.debug('connected to %s', addr)
+        stats['connections'] += 1
+        return client
+
+    def _sync_address(self, addr, neighbors, sync_nodes, stats):
+        """Sync the vaults of `neighbors` over a connection to `addr`.
+
+        This runs in a greenlet from the sync pool. Nodes that were synced
+        are removed from `sync_nodes`. The job as a whole has a deadline of
+        `timeout` seconds, so that a slow or unresponsive peer does not hold
+        up the sync round.
+
+        If more than one vault needs to be synced, the items for all vaults
+        are first exchanged with a single batched request. Only vaults that
+        were not completed by the batch are synced individually.
+
+        If the peer is busy, the connection is kept and the remaining nodes
+        are synced after the delay that the peer asked for. This does not
+        count as a failure.
+        """
+        logger = self.logger
+        model = self.model
+        pool = self.client_pool
+        key = addr['id']
+        client = None
+        failed = False
+        busy = None
+        deadline = Timeout(self.timeout)
+        deadline.start()
+        try:
+            todo = [ neighbor for neighbor in neighbors
+                     if neighbor['node'] in sync_nodes
+                        and neighbor['node'] not in self.syncing ]
+            batched = {}
+            if len(todo) > 1:
+                client = self._connect(addr, stats)
+                if client is None:
+                    failed = True
+                    todo = []
+            if len(todo) > 1:
+                vaults = [ neighbor['vault'] for neighbor in todo ]
+                nodes = [ neighbor['node'] for neighbor in todo ]
+                logger.debug('batch syncing %d vaults', len(vaults))
+                self.syncing.update(nodes)
+                starttime = time.time()
+                try:
+                    results = client.sync_many(vaults, model)
+                except SyncAPIError as e:
+                    if e.error_name == 'Busy':
+                        busy = e.retry_after
+                    else:
+                        logger.error('failed to batch sync vaults at %s', addr)
+                        pool.discard(client)
+                        client = None
+                    results = None
+                finally:
+                    self.syncing.difference_update(nodes)
+                for vault, count in (results or {}).items():
+                    if count is not None:
+                        batched[vault] = (starttime, count)
+            for neighbor in todo:
+                if busy is not None:
+                    break
+                node = neighbor['node']
+                if node not in sync_nodes or node in self.syncing:
+                    continue  # already synced, or syncing via other address
+                if client is None:
+                    client = self._connect(addr, stats)
+                    if client is None:
+                        failed = True
+                        break
+                vault = neighbor['vault']
+                logger.debug('syncing vault %s with node %s', vault, node)
+                self.syncing.add(node)
+                starttime, count = batched.get(vault, (time.time(), None))
+                try:
+                    if count is None:
+                        count = client.sync(vault, model)
+                    # Reconciliation is expensive compared to a sync that
+                    # is up to date, so it is done only periodically.
+                    if starttime - self.last_reconcile.get(node, 0) \
+                                > self.reconcile_interval:
+                        count += client.reconcile(vault, model) or 0
+                        self.last_reconcile[node] = starttime
+                except SyncAPIError as e:
+                    if e.error_name == 'Busy':
+                        busy = e.retry_after
+                        continue
+                    logger.error('failed to sync vault %s at %s',
+                                  vault, addr)
+                    self._update_peer_state(vault, node, client, starttime,
+                                            True)
+                    pool.discard(client)
+                    client = None
+                    failed = True
+                else:
+                    logger.debug('succesfully synced vault %s at %s',
+                                 vault, addr)
+                    stats['nodes'] += 1
+                    sync_nodes.discard(node)
+                    self.last_sync[node] = starttime
+                    self._update_peer_state(vault, node, client, starttime,
+                                            False)
+                    self._reschedule(node, changed=count > 0)
+                finally:
+                    self.syncing.discard(node)
+        except Timeout as e:
+            if e is not deadline:
+                raise
+            logger.error('sync with %s did not complete within %d seconds',
+                         addr, self.timeout)
+            if client is not None:
+                pool.discard(client)
+                client = None
+            failed = True
+        finally:
+            deadline.cancel()
+        if client is not None:
+            pool.put(client)
+        self._update_backoff(key, failed)
+        if busy is not None:
+            logger.debug('%s is busy, retrying after %d seconds', addr, busy)
+            due = time.time() + busy
+            self._set_busy(key, due)
+            for neighbor in todo:
+                node = neighbor['node']
+                if node in sync_nodes and node not in self.syncing:
+                    sync_nodes.discard(node)
+                    self.schedule.schedule(node, due)
+
+    def _notify_address(self, addr, vaults):
+        """Notify the peer at `addr` that our vector for `vaults` changed.
+
+        This runs in a greenlet from the sync pool, with the same deadline
+        as a sync job. If the peer is busy, the address is not used until
+        the delay that the peer asked for has passed.
+        """
+        logger = self.logger
+        model = self.model
+        pool = self.client_pool
+        client = None
+        failed = False
+        busy = None
+        deadline = Timeout(self.timeout)
+        deadline.start()
+        try:
+            client = pool.get(addr)
+            for vault in vaults:
+                if not client.notify(vault, model):
+                    break
+                logger.debug('notified %s of changes to vault %s', addr, vault)
+        except SyncAPIError as e:
+            if e.error_name == 'Busy':
+                busy = e.retry_after
+            else:
+                logger.error('could not notify %s: %s', addr, str(e))
+                failed = True
+        except Timeout as e:
+            if e is not deadline:
+                raise
+            logger.error('notifying %s did not complete within %d seconds',
+                         addr, self.timeout)
+            failed = True
+        finally:
+            deadline.cancel()
+        if client is not None:
+            if failed:
+                pool.discard(client)
+            else:
+                pool.put(client)
+        self._update_backoff(addr['id'], failed)
+        if busy is not None:
+            logger.debug('%s is busy, retrying after %d seconds', addr, busy)
+            self._set_busy(addr['id'], time.time() + busy)
 
     def _run(self):
         """This runs the synchronization loop."""
         logger = self.logger
-        model = instance(Model)
+        model = self.model
         model.add_callback(self._event_callback)
-        locator = instance(Locator)
+        locator = self.locator
         locator.add_callback(self._event_callback)
-        neighbors = locator.get_neighbors()
-        mynodes = set((v['node'] for v in model.get_vaults()))
-        myvaults = set((v['id'] for v in model.get_vaults()))
+        self.application.add_callback(self._event_callback)
+        pool = self.client_pool
+        for state in model.get_peer_states():
+            last_sync = state.get('last_sync', 0)
+            if last_sync > self.last_sync.get(state['node'], 0):
+                self.last_sync[state['node']] = last_sync
+        for neighbor in locator.get_neighbors():
+            self._add_neighbor(neighbor)
         while True:
-            # Determine how long we need to wait
+            # Wait until the first node is due, or for an event. Wake up to
+            # close connections that have been idle for too long as well.
             now = time.time()
             timeout = self.interval
-            for neighbor in neighbors:
-                node = neighbor['node']
-                vault = neighbor['vault']
-                if node in mynodes or vault not in myvaults \
-                            or not model.get_certificate(vault, node):
-                    continue
-                last_sync = self.last_sync.get(node, 0)
-                timeout = min(timeout, max(0, last_sync + self.interval - now))
-            # Now wait for a timeout, or an event.
+            due = self.schedule.next_due()
+            if due is not None:
+                timeout = min(timeout, max(0, due - now))
+            idle_timeout = pool.expire()
+            if idle_timeout is not None:
+                timeout = min(timeout, idle_timeout)
             self.queue_notempty.wait(timeout)
             self.queue_notempty.clear()
             # Build a list of nodes that we need to sync with.
             #
             # We sync to nodes that are are not ours, whose vault we also
             # have, and where there is a certificate. In addition, at least
-            # one of the following three needs to be true:
+            # one of the following four needs to be true:
             #
-            # 1. The last sync to this node is > interval seconds ago.
+            # 1. The node is due according to the schedule.
             # 2. A version was added locally to the node's vault
-            # 3. The node resides at an address that we are already syncing
+            # 3. The node notified us that it has items we do not have.
+            # 4. The node resides at an address that we are already syncing
             #    with.
             #
-            # Regarding #3, we organize the nodes by network address, and try
+            # Regarding #4, we organize the nodes by network address, and try
             # to sync all nodes over a single connection. So the nodes in #3
             # are almost "free" to do so that's they are included.
             now = time.time()
-            neighbors = locator.get_neighbors()
             mynodes = set((v['node'] for v in model.get_vaults()))
             myvaults = set((v['id'] for v in model.get_vaults()))
             byaddress = {}
             sync_nodes = set()
-            sync_vaults = set()
             # First process events.
             while self.queue:
                 event, args = self.queue.pop(0)
@@ -102,6 +520,11 @@ class Syncer(Greenlet):
                     # are discovered while we are running, because we known
                     # that when they are started up they will sync with us.
                     self.last_sync[neighbor['node']] = now
+                    self._add_neighbor(neighbor)
+                elif event == 'NeighborUpdated':
+                    self._add_neighbor(args[0])
+                elif event == 'NeighborDisappeared':
+                    self._remove_neighbor(args[0])
                 elif event == 'VersionsAdded':
                     vault, versions = args
                     # As an optimization, only push out a list of added
@@ -113,82 +536,96 @@ class Syncer(Greenlet):
                             continue
                         logger.debug('local update, syncing to all nodes for '
                                      'vault %s', vault)
-                        sync_vaults.add(vault)
+                        for node in self.vault_nodes.get(vault, ()):
+                            self.schedule.schedule(node, now)
                         break
+                elif event == 'VectorUpdated':
+                    self.notify_vaults.add(args[0])
+                elif event == 'PeerUpdated':
+                    vault, node = args
+                    logger.debug('node %s has updates for vault %s',
+                                 node, vault)
+                    if node in self.neighbors:
+                        self.schedule.schedule(node, now)
             # Now build a list of nodes including a "byaddress" list.
-            for neighbor in neighbors:
-                node = neighbor['node']
-                vault = neighbor['vault']
-                if node in mynodes or vault not in myvaults \
-                            or not model.get_certificate(vault, node):
-                    # Never sync with these nodes...
-                    continue
-                last_sync = self.last_sync.get(node, 0)
-                timeout = last_sync + self.interval < now
-                if timeout or vault in sync_vaults:
-                    for addr in neighbor['addresses']:
-                        key = addr['id']
-                        if key not in byaddress:
-                            byaddress[key] = (addr['family'], addr, [])
-                        byaddress[key][2].append(neighbor)
-                    sync_nodes.add(node)
+            for node in self.schedule.pop_due(now):
+                if not self._is_peer(node, mynodes, myvaults):
+                    # Never sync with these nodes... for now. A certificate
+                    # may still be added later.
+                    self.schedule.schedule(node, now + self.interval)
                     continue
-                # See if we are already syncing with an address, and if so,
-                # include /that address only/ in the sync job.
-                for addr in neighbor['addresses']:
+                neighbor = self.neighbors[node]
+                addresses = [ addr for addr in neighbor['addresses']
+                              if self._retry_time(addr['id']) <= now ]
+                if not addresses:
+                    self._reschedule(node, failed=True)
+                    continue  # backing off from all addresses
+                for addr in addresses:
                     key = addr['id']
-                    if key in byaddress:
-                        byaddress[key][2].append(neighbor)
-                        sync_nodes.add(node)
-            if not sync_nodes:
+                    if key not in byaddress:
+                        byaddress[key] = (addr['family'], addr, [])
+                    byaddress[key][2].append(neighbor)
+                sync_nodes.add(node)
+            # See if we are already syncing with an address, and if so,
+            # include the other nodes at /that address only/ in the sync job.
+            for key in byaddress:
+                for node in self.address_nodes.get(key, ()):
+                    if node in sync_nodes or \
+                            not self._is_peer(node, mynodes, myvaults):
+                        continue
+                    byaddress[key][2].append(self.neighbors[node])
+                    sync_nodes.add(node)
+                    self.schedule.remove(node)
+            # Notify the nodes that we do not sync with about changes to
+            # our vectors. One address per node is enough.
+            notify = {}
+            for vault in self.notify_vaults:
+                for node in self.vault_nodes.get(vault, ()):
+                    if node in sync_nodes or \
+                            not self._is_peer(node, mynodes, myvaults):
+                        continue
+                    # No need to notify a peer that already has our items.
+                    state = model.get_peer_state(vault, node)
+                    if state and state.get('vector') is not None and \
+                            vector_covers(state['vector'],
+                                          model.get_vector(vault)):
+                        continue
+                    for addr in self.neighbors[node]['addresses']:
+                        key = addr['id']
+                        if self._retry_time(key) > now:
+                            continue
+                        if key not in notify:
+                            notify[key] = (addr, set())
+                        notify[key][1].add(vault)
+                        break
+            self.notify_vaults.clear()
+            if not sync_nodes and not notify:
                 # Nothing to do...
                 continue
             logger.debug('total nodes to sync: %d', len(sync_nodes))
-            # Now sync to the nodes. Try to reuse the network connection for
-            # multiple nodes. We sort the addresses on location source so that
-            # we will be able to give different priorites to different sources
-            # later.
-            nnodes = nconnections = 0
-            addresses = sorted(byaddress.itervalues(), key=lambda x: x[0])
-            for source,addr,neighbors in addresses:
-                client = None
-                for neighbor in neighbors:
-                    node = neighbor['node']
-                    if node not in sync_nodes:
-                        continue  # already synced
-                    logger.debug('syncing with node %s', node)
-                    if client is None:
-                        client = SyncAPIClient(addr)
-                        try:
-                            client.connect()
-                        except SyncAPIError as e:
-                            logger.error('could not connect to %s: %s',
-                                          addr, str(e))
-                            client.close()
-                            break
-                        logger.debug('connected to %s', addr)
-                        nconnections += 1
-                    vault = neighbor['vault']
-                    starttime = time.time()
-                    try:
-                        client.sync(vault, model)
-                    except SyncAPIError:
-                        logger.error('failed to sync vault %s at %s',
-                                      vault, addr)
-                        client.close()
-                        client = None
-                    else:
-                        logger.debug('succesfully synced vault %s at %s',
-                                     vault, addr)
-                        nnodes += 1
-                        sync_nodes.remove(node)
-                        self.last_sync[node] = starttime
-                if client:
-                    client.close()
-                if not sync_nodes:
-                    break  # we are done
+            logger.debug('total addresses to notify: %d', len(notify))
+            # Now sync to the nodes. Every address is synced by a job in a
+            # bounded pool, so that a slow peer does not delay the others.
+            # Within a job, the network connection is reused for multiple
+            # nodes. Connections are taken from a pool, so that they can also
+            # be reused in the next round, or resumed cheaply. The addresses
+            # with the most out of date nodes are synced first.
+            stats = { 'nodes': 0, 'connections': 0 }
+            jobs = Pool(self.concurrency)
+            def staleness(address):
+                return min([ self.last_sync.get(neighbor['node'], 0)
+                             for neighbor in address[2] ])
+            addresses = sorted(byaddress.itervalues(), key=staleness)
+            for source,addr,addrneighbors in addresses:
+                jobs.spawn(self._sync_address, addr, addrneighbors, sync_nodes,
+                           stats)
+            for addr, vaults in notify.itervalues():
+                jobs.spawn(self._notify_address, addr, vaults)
+            jobs.join()
             logger.debug('synced to %d nodes using %d network connections',
-                         nnodes, nconnections)
+                         stats['nodes'], stats['connections'])
             if sync_nodes:
                 logger.debug('failed to sync with %d nodes', len(sync_nodes))
+            for node in sync_nodes:
+                self._reschedule(node, failed=True)
         logger.debug('syncer loop terminated')
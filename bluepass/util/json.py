@@ -28,6 +28,51 @@ def try_loads(s, cls=None):
         return
     return obj
 
+def iterdumps(objs, chunksize=16384):
+    """Serialize the objects from the iterable `objs` as newline delimited
+    JSON. This is a generator that yields chunks of about `chunksize` bytes,
+    each containing one or more complete lines."""
+    chunk = []; size = 0
+    for obj in objs:
+        line = dumps(obj) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= chunksize:
+            yield ''.join(chunk)
+            chunk = []; size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+def iterloads(fin, bufsize=16384, maxline=None):
+    """Parse newline delimited JSON from the file-like object `fin`. This is
+    a generator that yields the objects as soon as they have been read. A
+    ValueError is raised if a line is not valid JSON, if a line is longer
+    than `maxline` bytes, or if the input ends with an incomplete line."""
+    pending = []
+    pendingsize = 0
+    while True:
+        data = fin.read(bufsize)
+        if not data:
+            break
+        lines = data.split('\n')
+        if len(lines) == 1:
+            pending.append(data)
+            pendingsize += len(data)
+            if maxline is not None and pendingsize > maxline:
+                raise ValueError('line too long')
+            continue
+        pending.append(lines[0])
+        lines[0] = ''.join(pending)
+        pending = [lines.pop()]
+        pendingsize = len(pending[0])
+        for line in lines:
+            if maxline is not None and len(line) > maxline:
+                raise ValueError('line too long')
+            if line.strip():
+                yield loads(line)
+    if ''.join(pending).strip():
+        raise ValueError('incomplete line at end of input')
+
 
 class UnpackError(Exception):
     """Validation error."""
@@ -6,13 +6,52 @@
 # version 3. See the file LICENSE distributed with this file for the exact
 # licensing terms.
 
+import os
+
 try:
     import httplib
 except ImportError:
     from http import client as httplib
 
+import gevent
 from gevent import socket, ssl
 from bluepass.ext import _sslex
+from bluepass.ext.secmem import SecureBuffer
+
+
+# A session ticket contains the master secret of its session, encrypted with
+# the ticket keys. Whoever has the keys can decrypt every ticket that was
+# issued with them. To keep forward secrecy, the keys are replaced every
+# "ticket_key_lifetime" seconds and the old keys are wiped. Tickets are valid
+# for at most as long (see SSLSocket), so no ticket outlives its keys by
+# more than that.
+
+ticket_key_lifetime = 3600
+_ticket_keys = None
+_ticket_timer = None
+
+def _rotate_ticket_keys():
+    """Replace the session ticket keys, and wipe the old ones."""
+    global _ticket_keys, _ticket_timer
+    if _ticket_timer is not None and _ticket_timer is not gevent.getcurrent():
+        _ticket_timer.kill(block=False)
+    if _ticket_keys is not None:
+        _ticket_keys.wipe()
+    _ticket_keys = SecureBuffer(os.urandom(48))
+    _ticket_timer = gevent.spawn_later(ticket_key_lifetime, _rotate_ticket_keys)
+
+def session_ticket_keys():
+    """Return the current TLS session ticket keys for this process.
+
+    The keys are generated when this function is first called, and are
+    rotated every `ticket_key_lifetime` seconds after that. Servers that use
+    the same keys can resume each other's sessions. Pass this function
+    rather than its result as the "ticket_keys" argument to SSLSocket, so
+    that every connection uses the current keys.
+    """
+    if _ticket_keys is None:
+        _rotate_ticket_keys()
+    return _ticket_keys
 
 
 class SSLSocket(ssl.SSLSocket):
@@ -23,6 +62,22 @@ class SSLSocket(ssl.SSLSocket):
     * Retrieving the channel bindings (get_channel_bindings()).
     * Setting the Diffie-Hellman group parameters (via the "dhparams"
        and dh_single_use keyword arguments to the constructor).
+
+    In addition it supports TLS session resumption. A client can pass a
+    session from get_session() of an earlier connection via the "session"
+    keyword argument. A server enables session tickets by passing the
+    "ticket_keys" keyword argument, which may also be a function that
+    returns the current keys (see session_ticket_keys()). Tickets have a
+    lifetime of "session_timeout" seconds, which defaults to the rotation
+    interval of the ticket keys.
+
+    Our authentication relies on the tls-unique channel binding. Without the
+    extended master secret (RFC 7627), a man in the middle can arrange two
+    connections with the same tls-unique value by resuming a session (the
+    "triple handshake" attack). Sessions are therefore only resumed when the
+    extended master secret is used, and a resumed handshake without it is
+    refused. With an OpenSSL that does not support it, every connection
+    does a full handshake.
     """
 
     def __init__(self, *args, **kwargs):
@@ -38,18 +93,36 @@ class SSLSocket(ssl.SSLSocket):
         self.dh_single_use = kwargs.pop('dh_single_use', False)
         self.server_side = kwargs.pop('server_side', False)
         self.ciphers = kwargs.pop('ciphers', None)
+        self.session = kwargs.pop('session', None)
+        self.ticket_keys = kwargs.pop('ticket_keys', None)
+        self.session_timeout = kwargs.pop('session_timeout',
+                                          ticket_key_lifetime)
         super(SSLSocket, self).__init__(*args, **kwargs)
 
     def do_handshake(self):
-        """Set DH parameters prior to handshake."""
+        """Set DH parameters and session parameters prior to handshake."""
         if self.dhparams:
             _sslex.set_dh_params(self._sslobj, self.dhparams, self.dh_single_use)
         if self.ciphers:
             _sslex.set_ciphers(self._sslobj, self.ciphers)
+        if _sslex.HAVE_EXTMS and self.ticket_keys and self.server_side:
+            keys = self.ticket_keys
+            if callable(keys):
+                keys = keys()
+            _sslex.set_session_tickets(self._sslobj, keys,
+                                       self.session_timeout)
+        if _sslex.HAVE_EXTMS and self.session and not self.server_side:
+            try:
+                _sslex.set_session(self._sslobj, self.session)
+            except _sslex.Error:
+                pass  # not resumable: do a full handshake
         # Now make it a server socket again if we need to..
         if self.server_side:
             _sslex._set_accept_state(self._sslobj)
         super(SSLSocket, self).do_handshake()
+        if self.session_reused() and not self.extms_used():
+            self.close()
+            raise ssl.SSLError('session resumed without extended master secret')
 
     def get_channel_binding(self, typ='tls-unique'):
         """Return the channel binding for this SSL socket."""
@@ -59,6 +132,26 @@ class SSLSocket(ssl.SSLSocket):
             return
         return _sslex.get_channel_binding(self._sslobj)
 
+    def get_session(self):
+        """Return the TLS session as a string, or None if there is no
+        session that may be resumed. The string contains the master secret
+        of the session."""
+        if self._sslobj is None or not self.extms_used():
+            return
+        return _sslex.get_session(self._sslobj)
+
+    def extms_used(self):
+        """Return whether the connection uses the extended master secret."""
+        if self._sslobj is None:
+            return False
+        return _sslex.extms_used(self._sslobj)
+
+    def session_reused(self):
+        """Return whether the handshake resumed an earlier session."""
+        if self._sslobj is None:
+            return False
+        return _sslex.session_reused(self._sslobj)
+
 
 def wrap_socket(*args, **kwargs):
     return SSLSocket(*args, **kwargs)
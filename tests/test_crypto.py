@@ -13,7 +13,9 @@ import sys
 from subprocess import Popen, PIPE
 
 from .unit import UnitTest, assert_raises, SkipTest
-from bluepass.crypto import CryptoProvider, CryptoError, dhparams
+from bluepass.crypto import CryptoProvider, CryptoError, SecureBuffer, dhparams
+from bluepass.ext import secmem
+from bluepass.util.uuid import check_uuid4
 
 
 class CryptoTest(UnitTest):
@@ -63,6 +65,19 @@ class TestCrypto(CryptoTest):
                 pt2 = cp.rsa_decrypt(ct, key[0])
                 assert pt == pt2
 
+    def test_rsa_decrypt_secure(self):
+        cp = self.provider
+        for keysize,key in self.rsakeys:
+            pt = os.urandom(16)
+            ct = cp.rsa_encrypt(pt, key[1])
+            pt2 = cp.rsa_decrypt(ct, key[0], secure=True)
+            assert isinstance(pt2, SecureBuffer)
+            assert len(pt2) == 16
+            assert str(buffer(pt2)) == pt
+            # A SecureBuffer can be used as a key without copying it
+            sig = cp.rsa_sign('foo', SecureBuffer(key[0]))
+            assert cp.rsa_verify('foo', sig, key[1])
+
     def test_rsa_sign(self):
         cp = self.provider
         for keysize,key in self.rsakeys:
@@ -95,6 +110,21 @@ class TestCrypto(CryptoTest):
             assert cp.rsa_verify(vector['MSG'], vector['SIG'],
                                  vector['PUBKEY'], 'pss-sha1')
 
+    def test_ec_sign(self):
+        cp = self.provider
+        key = cp.ec_genkey('prime256v1')
+        assert cp.ec_checkkey(key[0])
+        assert cp.ec_size(key[1]) == 256
+        for size in range(0, 10000, 100):
+            msg = os.urandom(size)
+            sig = cp.ec_sign(msg, key[0])
+            assert cp.ec_verify(msg, sig, key[1])
+            assert not cp.ec_verify(msg + 'x', sig, key[1])
+
+    def test_ec_genkey_unknown_curve(self):
+        cp = self.provider
+        assert_raises(CryptoError, cp.ec_genkey, 'nosuchcurve')
+
     def test_dh_exchange(self):
         cp = self.provider
         params = dhparams['skip2048']
@@ -117,6 +147,70 @@ class TestCrypto(CryptoTest):
                 clear2 = cp.aes_decrypt(ciphertext, key, iv)
                 assert cleartext == clear2
 
+    def test_aes_gcm(self):
+        cp = self.provider
+        for keysize in (16, 24, 32):
+            for size in range(0, 1000, 7):
+                key = os.urandom(keysize)
+                iv = os.urandom(12)
+                pt = os.urandom(size)
+                ct = cp.aes_encrypt(pt, key, iv, 'gcm')
+                assert len(ct) == size + 16
+                pt2 = cp.aes_decrypt(ct, key, iv, 'gcm')
+                assert pt == pt2
+
+    def test_compare_digest(self):
+        cp = self.provider
+        assert cp.compare_digest('foo', 'foo')
+        assert not cp.compare_digest('foo', 'fox')
+        assert not cp.compare_digest('foo', 'fo')
+        assert not cp.compare_digest('', 'x')
+
+    def test_aes_gcm_tampered(self):
+        cp = self.provider
+        key = os.urandom(16)
+        iv = os.urandom(12)
+        ct = cp.aes_encrypt('foo bar baz', key, iv, 'gcm')
+        for i in range(len(ct)):
+            bad = ct[:i] + chr(ord(ct[i]) ^ 1) + ct[i+1:]
+            assert_raises(CryptoError, cp.aes_decrypt, bad, key, iv, 'gcm')
+        assert_raises(CryptoError, cp.aes_decrypt, ct[:15], key, iv, 'gcm')
+
+    def test_aes_decrypt_secure(self):
+        cp = self.provider
+        key = SecureBuffer(os.urandom(16))
+        for mode,ivlen in (('cbc-pkcs7', 16), ('gcm', 12)):
+            for size in (0, 1, 15, 16, 17, 100):
+                iv = os.urandom(ivlen)
+                pt = os.urandom(size)
+                ct = cp.aes_encrypt(pt, key, iv, mode)
+                pt2 = cp.aes_decrypt(ct, key, iv, mode, secure=True)
+                assert isinstance(pt2, SecureBuffer)
+                assert str(buffer(pt2)) == pt
+        assert_raises(CryptoError, cp.engine.aes_decrypt, ct, key, iv, 'gcm',
+                      SecureBuffer(10))
+
+    def test_secure_buffer(self):
+        buf = SecureBuffer('foobar')
+        assert len(buf) == 6
+        assert 'foobar' not in repr(buf)
+        buf.truncate(3)
+        assert str(buffer(buf)) == 'foo'
+        buf.wipe()
+        assert str(buffer(buf)) == '\x00\x00\x00'
+        stats = secmem.arena_stats()
+        assert stats['inuse'] > 0
+        assert stats['inuse'] <= stats['allocated'] <= stats['size']
+
+    def test_secure_arena_growth(self):
+        # Thousands of RSA keys fit in locked memory
+        fallbacks = secmem.arena_stats()['fallbacks']
+        keys = [ SecureBuffer(1800) for i in range(2000) ]
+        stats = secmem.arena_stats()
+        assert stats['regions'] > 1
+        assert stats['fallbacks'] == fallbacks
+        del keys
+
     def test_aes_vectors(self):
         cp = self.provider
         vectors = self.load_vectors('vectors/aes-cbc-pkcs7.txt', start='PT')
@@ -193,3 +287,42 @@ class TestCrypto(CryptoTest):
         assert isinstance(rnd, unicode)
         assert len(rnd) == 14
         assert rnd.isdigit()
+
+    def test_random_fork(self):
+        cp = self.provider
+        cp.random(16)  # fill the pool
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            os.write(wfd, cp.random(16))
+            os._exit(0)
+        os.close(wfd)
+        child = os.read(rfd, 16)
+        os.close(rfd)
+        os.waitpid(pid, 0)
+        # The child must not be served from the parent's pool
+        assert len(child) == 16
+        assert child != cp.random(16)
+
+    def test_random_large(self):
+        cp = self.provider
+        rnd = cp.random(100000)
+        assert len(rnd) == 100000
+        assert rnd.count('\x00') < 1000
+
+    def test_random_distribution(self):
+        cp = self.provider
+        rnd = cp.random(30000, 'abc')
+        for ch in 'abc':
+            assert 9000 < rnd.count(ch) < 11000
+
+    def test_randuuid(self):
+        cp = self.provider
+        uuids = set()
+        for i in range(1000):
+            uuid = cp.randuuid()
+            assert isinstance(uuid, str)
+            assert check_uuid4(uuid)
+            uuids.add(uuid)
+        assert len(uuids) == 1000
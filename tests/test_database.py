@@ -166,3 +166,10 @@ class TestDatabase(UnitTest):
         docs = db.findall('items')
         assert len(docs) == 1
         assert docs[0] != doc
+
+    def test_find_limit(self):
+        db = self.database
+        for i in range(10):
+            db.insert('items', {'foo': i})
+        docs = db.findall('items', '$foo > ?', (2,), '$foo', 3)
+        assert docs == [{'foo': 3}, {'foo': 4}, {'foo': 5}]
@@ -51,6 +51,10 @@ class ClientHandler(MessageBusHandler):
     def client_echo(self, *args):
         return args
 
+    @signal_handler(spawn=None)
+    def broadcast(self, value):
+        self.value = value
+
 
 class TestMessageBus(UnitTest):
 
@@ -91,6 +95,61 @@ class TestMessageBus(UnitTest):
         reply = self.client.call_method('getsignal')
         assert reply == 'foo'
 
+    def test_signal_burst(self):
+        # Queued messages are coalesced into a few large writes
+        client = self.client
+        for i in range(500):
+            client.send_signal('mysignal', 'x' * i)
+        assert len(client._outgoing) > 0
+        gevent.sleep(1)
+        assert len(client._outgoing) == 0
+        reply = client.call_method('getsignal')
+        assert reply == 'x' * 499
+
+    def test_broadcast_signal(self):
+        # A broadcast signal is serialized once and shared by all connections
+        csock = socket.socket()
+        csock.connect(self.address)
+        handler = ClientHandler()
+        client = MessageBusConnection(csock, self.authtok, handler=handler)
+        client.call_method('echo')
+        value = 'x' * 100000
+        self.server.send_signal(None, 'broadcast', value)
+        queued = [ conn._outgoing[-1][1] for conn in self.server.connections ]
+        assert len(queued) >= 2
+        assert all(message is queued[0] for message in queued)
+        gevent.sleep(1)
+        assert handler.value == value
+        assert self.client.handler.value == value
+        client.close()
+
+    def test_subscriptions(self):
+        csock = socket.socket()
+        csock.connect(self.address)
+        handler = ClientHandler()
+        client = MessageBusConnection(csock, self.authtok, handler=handler)
+        client.call_method('echo')
+        server = self.server
+        connection = server.connections[-1]
+        assert server.is_subscribed(connection, 'broadcast')
+        server.subscribe(connection, ['broad*'], ['v1'])
+        assert server.is_subscribed(connection, 'broadcast')
+        assert server.is_subscribed(connection, 'broadcast', 'v1')
+        assert not server.is_subscribed(connection, 'broadcast', 'v2')
+        assert not server.is_subscribed(connection, 'other')
+        # Filtered signals are not even queued
+        handler.value = None
+        server.send_signal(None, 'broadcast', 'foo', vault='v2')
+        assert len(connection._outgoing) == 0
+        server.send_signal(None, 'broadcast', 'bar', vault='v1')
+        gevent.sleep(1)
+        assert handler.value == 'bar'
+        server.unsubscribe(connection)
+        assert not server.is_subscribed(connection, 'broadcast', 'v1')
+        client.close()
+        gevent.sleep(1)
+        assert connection not in server.subscriptions
+
     def test_arg_count(self):
         reply = self.client.call_method('set_value', 10)
         assert reply is None
@@ -146,3 +205,40 @@ class TestMessageBus(UnitTest):
         for i in range(100):
             reply = self.client.call_method('get_value')
             assert reply == 20
+
+    def test_length_framing(self):
+        csock = socket.socket()
+        csock.connect(self.address)
+        client = MessageBusConnection(csock, self.authtok)
+        client.framing = 'length'
+        value = 'x' * 100000
+        reply = client.call_method('echo', value)
+        assert reply == [value]
+        client.close()
+
+    def test_framer(self):
+        messages = [ '{"a": "}{\\"", "b": [{"c": %d}]}' % i for i in range(20) ]
+        stream = ''
+        for i, message in enumerate(messages):
+            if i % 2:
+                message = '%d:%s' % (len(message), message)
+            stream += '\n ' + message
+        framer = MessageFramer()
+        result = []
+        pos = 0
+        while pos < len(stream):
+            size = random.randint(1, 20)
+            framer.feed(stream[pos:pos+size])
+            pos += size
+            message = framer.next_message()
+            while message is not None:
+                result.append(message)
+                message = framer.next_message()
+        assert result == messages
+        assert len(framer) == 0
+        framer = MessageFramer()
+        framer.feed('[]')
+        assert_raises(ValueError, framer.next_message)
+        framer = MessageFramer(max_message_size=100)
+        framer.feed('1000:{')
+        assert_raises(ValueError, framer.next_message)
@@ -15,6 +15,8 @@ import logging
 from .unit import UnitTest, assert_raises
 from bluepass.database import *
 from bluepass.model import *
+from bluepass.crypto import SecureBuffer
+from bluepass.util import json
 
 
 class TestModel(UnitTest):
@@ -46,6 +48,144 @@ class TestModel(UnitTest):
         assert 'node' in vault
         assert 'keys' in vault
 
+    def test_create_vault_ec(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd', sign_keytype='ec')
+        assert vault['keys']['sign']['keytype'] == 'ec'
+        assert vault['keys']['encrypt']['keytype'] == 'rsa'
+        assert model.check_vault(vault)[0]
+        version = model.add_version(vault['id'], {'foo': 'bar'})
+        items = model.get_items(vault['id'])
+        for item in items:
+            assert item['signature']['algo'] == 'ecdsa-sha256'
+        assert model.get_version(vault['id'], version['id']) is not None
+
+    def test_create_vault_unknown_keytype(self):
+        model = self.model
+        assert_raises(ModelError, model.create_vault, 'My Vault', 'Passw0rd',
+                      sign_keytype='dsa')
+
+    def test_payload_algo(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        model.add_version(vault['id'], {'foo': 'bar'})
+        items = model.get_items(vault['id'])
+        encitems = [ item for item in items
+                     if item['payload']['_type'] == 'EncryptedItem' ]
+        assert len(encitems) == 1
+        assert encitems[0]['payload']['algo'] == 'aes-gcm'
+        # A node that has not advertised aes-gcm forces us back to CBC
+        model2 = Model(Database(self.tempfile()))
+        vault2 = model2.create_vault('My Vault', 'Passw0rd', uuid=vault['id'])
+        certinfo = model2.get_certinfo(vault2['id'], 'node2')
+        model.add_certificate(vault['id'], certinfo)
+        version = model.add_version(vault['id'], {'foo': 'baz'})
+        items = model.get_items(vault['id'])
+        items.sort(key=lambda item: item['origin']['seqnr'])
+        assert items[-1]['payload']['algo'] == 'aes-cbc-pkcs7'
+        assert len(items[-1]['payload']['keys']) == 2
+        version = model.get_version(vault['id'], version['id'])
+        assert version['foo'] == 'baz'
+        # Once it has, aes-gcm is used again
+        model.update_peer_state(vault['id'], vault2['node'],
+                                {'features': ['aes-gcm']})
+        model.add_version(vault['id'], {'foo': 'qux'})
+        items = model.get_items(vault['id'])
+        items.sort(key=lambda item: item['origin']['seqnr'])
+        assert items[-1]['payload']['algo'] == 'aes-gcm'
+        # The advertised features are loaded with the vault
+        model3 = Model(model.database)
+        assert model3.node_has_feature(vault['id'], vault2['node'], 'aes-gcm')
+
+    def test_certinfo_compat(self):
+        # The certinfo that we send when pairing must be accepted by the
+        # strict check of older nodes, which rejects unknown fields.
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        certinfo = model.get_certinfo(vault['id'])
+        json.unpack(certinfo, '{s:s,s:s,s:{s:{s:s,s:s!},' \
+                    's:{s:s,s:s!},s:{s:s,s:s!}!},s?:{s?:b!}!}',
+                    ('node', 'name', 'keys', 'sign', 'key', 'keytype',
+                     'encrypt', 'key', 'keytype', 'auth', 'key',
+                     'keytype', 'restrictions', 'synconly'))
+        status, detail = model.check_certinfo(certinfo)
+        assert status, detail
+
+    def test_iter_items(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        for i in range(5):
+            model.add_version(vault['id'], {'foo': i})
+        items = list(model.iter_items(vault['id'], batchsize=2))
+        assert items == model.get_items(vault['id'])
+        seqnrs = [ item['origin']['seqnr'] for item in items ]
+        assert seqnrs == sorted(seqnrs)
+        vector = [(vault['node'], seqnrs[2])]
+        items = list(model.iter_items(vault['id'], vector, batchsize=2))
+        assert [ item['origin']['seqnr'] for item in items ] == seqnrs[3:]
+        assert_raises(ModelError, model.iter_items, vault['id'], 'foo')
+        start = (vault['node'], seqnrs[3])
+        items = list(model.iter_items(vault['id'], start=start))
+        assert [ item['origin']['seqnr'] for item in items ] == seqnrs[4:]
+        assert_raises(ModelError, model.iter_items, vault['id'], start='foo')
+
+    def test_range_digests(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        for i in range(5):
+            model.add_version(vault['id'], {'foo': i})
+        node, seqnr = model.get_vector(vault['id'])[0]
+        ranges = [(node, 0, seqnr+1), (node, seqnr, seqnr+1)]
+        digests = model.get_range_digests(vault['id'], ranges, maxkeys=1)
+        assert digests[0]['count'] == len(model.get_items(vault['id']))
+        assert 'seqnrs' not in digests[0]
+        assert digests[1]['count'] == 1
+        assert digests[1]['seqnrs'] == [seqnr]
+        assert digests[0]['digest'] != digests[1]['digest']
+        assert_raises(ModelError, model.get_range_digests, vault['id'],
+                      [(node, seqnr, seqnr)])
+        # Remove an item below the vector and import it again
+        item, = model.get_items_by_origin(vault['id'], [(node, seqnr-1)])
+        model.database.delete('items', '$origin$node = ? AND $origin$seqnr = ?',
+                              (node, seqnr-1))
+        assert model.import_items(vault['id'], [item]) == 0
+        assert model.import_items(vault['id'], [item], fill_gaps=True) == 1
+        assert model.import_items(vault['id'], [item], fill_gaps=True) == 0
+        assert model.get_range_digests(vault['id'], ranges[:1]) == digests[:1]
+
+    def test_snapshot_items(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        version1 = model.add_version(vault['id'], {'foo': 'bar'})
+        version1['foo'] = 'baz'
+        del version1['_envelope']
+        model.update_version(vault['id'], version1)
+        version2 = model.add_version(vault['id'], {'foo': 'qux'})
+        model.delete_version(vault['id'], version2)
+        items = model.get_snapshot_items(vault['id'])
+        types = [ item['payload']['_type'] for item in items ]
+        # One certificate, and the last item of each version
+        assert types.count('Certificate') == 1
+        assert types.count('EncryptedItem') == 2
+        assert len(model.get_items(vault['id'])) == 5
+        assert [ item['origin']['seqnr'] for item in items ] == [0, 2, 4]
+        model.lock_vault(vault['id'])
+        assert_raises(ModelError, model.get_snapshot_items, vault['id'])
+
+    def test_peer_state(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        node = model.crypto.randuuid()
+        assert model.get_peer_state(vault['id'], node) is None
+        model.update_peer_state(vault['id'], node, {'failures': 1})
+        model.update_peer_state(vault['id'], node, {'last_sync': 10})
+        state = model.get_peer_state(vault['id'], node)
+        assert state == {'vault': vault['id'], 'node': node, 'last_sync': 10}
+        assert model.get_peer_states() == [state]
+        assert model.get_peer_states(vault['id']) == [state]
+        model.delete_vault(vault)
+        assert model.get_peer_states() == []
+
     def test_get_vaults(self):
         model = self.model
         uuid = model.create_vault('My Vault', 'Passw0rd')
@@ -80,6 +220,19 @@ class TestModel(UnitTest):
         model.lock_vault(vault['id'])
         assert model.vault_is_locked(vault['id'])
 
+    def test_auth_key(self):
+        model = self.model
+        vault = model.create_vault('My Vault', 'Passw0rd')
+        key = model.get_auth_key(vault['id'])
+        assert isinstance(key, SecureBuffer)
+        assert model.get_auth_key(vault['id']) is key
+        # Locking the vault wipes the cached key
+        model.lock_vault(vault['id'])
+        assert str(buffer(key)) == '\0' * len(key)
+        key2 = model.get_auth_key(vault['id'])
+        assert key2 is not key
+        assert str(buffer(key2)).strip('\0')
+
     def test_unlock_vault(self):
         model = self.model
         vault = model.create_vault('My Vault', 'Passw0rd')
@@ -9,15 +9,20 @@
 from __future__ import absolute_import, print_function
 
 import time
+from io import BytesIO
 
 from gevent import socket
 from gevent.event import Event
 
-from .unit import UnitTest
+from .unit import UnitTest, assert_raises
 from bluepass.factory import create, instance
 from bluepass.database import Database
 from bluepass.model import Model
+from bluepass.ext import _sslex
 from bluepass.syncapi import *
+from bluepass.syncapi import _version_jobs, HTTPReturn, import_stream, \
+        select_encoding, compress, compress_stream, Decompressor, \
+        vector_digest, vector_covers, split_batches, VersionUpdateJob
 from bluepass.messagebus import *
 
 
@@ -83,3 +88,262 @@ class TestSyncAPI(UnitTest):
         version2 = model2.get_version(vault1['id'], version1['id'])
         assert version2 is not None
         assert version2['foo'] == 'bar'
+        # The first request established a session for the next requests
+        assert vault1['id'] in client.sessions
+        assert len(syncapp.sessions) == 1
+        cb, key, node, created = client.sessions[vault1['id']]
+        assert node == vault1['node']
+        # A session that the server rejects is dropped, and the request is
+        # retried with RSA_CB, which establishes a new session.
+        client.sessions[vault1['id']] = (cb, 'x' * len(key), node, created)
+        client.sync(vault1['id'], model2)
+        assert client.sessions[vault1['id']][1] != 'x' * len(key)
+        # The same happens when the server has evicted the session
+        syncapp.sessions.clear()
+        client.sync(vault1['id'], model2)
+        assert len(syncapp.sessions) == 1
+        # Sync more items than fit in a single import batch, in pages
+        versions = [ model1.add_version(vault1['id'], {'foo': i})
+                     for i in range(250) ]
+        client.page_size = 100
+        client.sync(vault1['id'], model2)
+        assert model2.get_vector(vault1['id']) == model1.get_vector(vault1['id'])
+        assert sorted(client.peer_vectors[vault1['id']]) == \
+                    sorted(model1.get_vector(vault1['id']))
+        assert client.rtt > 0
+        assert 'aes-gcm' in client.peer_features
+        # Nothing is transferred when both sides are up to date
+        assert client.sync(vault1['id'], model2) == 0
+        # Notifications only raise an event if the peer has new items
+        events = []
+        syncapp.add_callback(lambda *args: events.append(args))
+        assert client.notify(vault1['id'], model2)
+        assert events == []
+        model2.add_version(vault1['id'], {'foo': 'baz'})
+        assert client.notify(vault1['id'], model2)
+        assert events == [('PeerUpdated', vault1['id'], vault2['node'])]
+        for version in versions:
+            version2 = model2.get_version(vault1['id'], version['id'])
+            assert version2 is not None
+            assert version2['foo'] == version['foo']
+        # The server updates its versions in the background
+        progress = []
+        model1.add_callback(lambda event, *args: event == 'ImportProgress'
+                                    and progress.append(args))
+        version3 = model2.add_version(vault1['id'], {'foo': 'qux'})
+        client.sync(vault1['id'], model2)
+        job = _version_jobs.get((model1, vault1['id']))
+        if job is not None:
+            job.join()
+        assert model1.get_version(vault1['id'], version3['id'])['foo'] == 'qux'
+        assert progress[-1] == (vault1['id'], 2, 2)
+        # Reconciliation fills gaps below the vector, in both directions
+        vector = dict(model1.get_vector(vault1['id']))
+        query = '$origin$node = ? AND $origin$seqnr = ?'
+        node1, node2 = vault1['node'], vault2['node']
+        database2.delete('items', query, (node1, vector[node1] - 10))
+        database2.delete('items', query, (node1, vector[node1] - 100))
+        database1.delete('items', query, (node2, vector[node2] - 1))
+        assert model2.get_vector(vault1['id']) == model1.get_vector(vault1['id'])
+        assert client.reconcile(vault1['id'], model2) == 3
+        ranges = [ (node, 0, seqnr+1) for node, seqnr in vector.items() ]
+        assert model1.get_range_digests(vault1['id'], ranges) == \
+                    model2.get_range_digests(vault1['id'], ranges)
+        assert client.reconcile(vault1['id'], model2) == 0
+        # Batched sync retrieves and pushes items with a single request each
+        model1.add_version(vault1['id'], {'foo': 'batch1'})
+        model2.add_version(vault1['id'], {'foo': 'batch2'})
+        assert client.sync_many([vault1['id']], model2) == {vault1['id']: 2}
+        job = _version_jobs.get((model1, vault1['id']))
+        if job is not None:
+            job.join()
+        assert model2.get_vector(vault1['id']) == model1.get_vector(vault1['id'])
+        assert client.sync_many([vault1['id']], model2) == {vault1['id']: 0}
+        # A busy server asks us to retry later, and the connection is kept
+        syncapp.max_node_requests = 0
+        try:
+            client.sync(vault1['id'], model2)
+        except SyncAPIError as e:
+            assert e.error_name == 'Busy'
+            assert e.retry_after == syncapp.retry_after
+        else:
+            assert False, 'expecting a SyncAPIError'
+        assert client.is_connected()
+        del syncapp.max_node_requests
+        assert client.sync(vault1['id'], model2) == 0
+        # A new node starts from a snapshot, and fills in the history later
+        database3 = Database(self.tempfile())
+        model3 = Model(database3)
+        model3.create_vault('Vault3', 'Passw0rd', uuid=vault1['id'])
+        model1.add_certificate(vault1['id'], model3.get_certinfo(vault1['id']))
+        model3.add_certificate(vault1['id'], model1.get_certinfo(vault1['id']))
+        client3 = SyncAPIClient(address)
+        client3.connect()
+        count = client3.bootstrap(vault1['id'], model3)
+        assert 0 < count < len(model1.get_items(vault1['id']))
+        versions1 = sorted(((v['id'], v.get('foo'))
+                            for v in model1.get_versions(vault1['id'])))
+        versions3 = sorted(((v['id'], v.get('foo'))
+                            for v in model3.get_versions(vault1['id'])))
+        assert versions3 == versions1
+        client3.sync(vault1['id'], model3)
+        client3.reconcile(vault1['id'], model3)
+        job = _version_jobs.get((model1, vault1['id']))
+        if job is not None:
+            job.join()
+        assert model3.get_vector(vault1['id']) == model1.get_vector(vault1['id'])
+
+    def test_split_batches(self):
+        vault1 = '7a3b2a5c-3f8d-4c4e-9d4e-0b1a2c3d4e5f'
+        vault2 = '0b4e1c3a-6b2d-4f6e-8a9c-1d2e3f4a5b6c'
+        objects = [ {'_type': 'SyncHeader', 'vault': vault1},
+                    {'vault': vault1, 'n': 1}, {'vault': vault1, 'n': 2},
+                    {'_type': 'SyncHeader', 'vault': vault2},
+                    {'_type': 'SyncHeader', 'vault': vault1},
+                    {'vault': vault1, 'n': 3} ]
+        batches = [ (header['vault'], [ item['n'] for item in items ])
+                    for header, items in split_batches(objects) ]
+        assert batches == [(vault1, [1, 2]), (vault2, []), (vault1, [3])]
+        # Items that are not consumed are skipped
+        headers = [ header['vault'] for header, items in split_batches(objects) ]
+        assert headers == [vault1, vault2, vault1]
+        assert list(split_batches([])) == []
+        assert_raises(ValueError, list, split_batches(objects[1:]))
+        objects[2]['vault'] = vault2
+        assert_raises(ValueError, list, split_batches(objects))
+
+    def test_import_stream(self):
+        class Recorder(object):
+            def __init__(self):
+                self.batches = []
+            def import_items(self, vault, items, notify=True,
+                             fill_gaps=False):
+                self.batches.append(items)
+        node = '7a3b2a5c-3f8d-4c4e-9d4e-0b1a2c3d4e5f'
+        items = [ {'origin': {'node': node, 'seqnr': i}} for i in range(5) ]
+        recorder = Recorder()
+        count = import_stream(recorder, None, iter(items), batchsize=2)
+        assert count == 5
+        assert [ len(batch) for batch in recorder.batches ] == [2, 2, 1]
+        items.reverse()
+        assert_raises(ValueError, import_stream, recorder, None, iter(items))
+
+    def test_version_job_errors(self):
+        class FailingModel(object):
+            def __init__(self):
+                self.batches = []
+            def update_versions(self, vault, items):
+                self.batches.append(items)
+                if len(self.batches) == 1:
+                    raise ValueError('first batch fails')
+            def raise_event(self, *args):
+                pass
+        model = FailingModel()
+        vault = '7a3b2a5c-3f8d-4c4e-9d4e-0b1a2c3d4e5f'
+        job = VersionUpdateJob(model, vault)
+        _version_jobs[(model, vault)] = job
+        job.batchsize = 2
+        job.add(list(range(5)))
+        job.start()
+        job.join()
+        # The failed batch does not stop the remaining batches
+        assert model.batches == [[0, 1], [2, 3], [4]]
+        assert job.done == 5
+        assert (model, vault) not in _version_jobs
+
+    def test_vector_digest(self):
+        node1 = '7a3b2a5c-3f8d-4c4e-9d4e-0b1a2c3d4e5f'
+        node2 = '0d2c1b4a-5e6f-4a7b-8c9d-1e2f3a4b5c6d'
+        vector = [(node1, 10), (node2, 20)]
+        assert vector_digest(vector) == vector_digest(list(reversed(vector)))
+        assert vector_digest(vector) != vector_digest([(node1, 10)])
+        assert vector_covers(vector, [(node1, 5)])
+        assert vector_covers(vector, vector)
+        assert not vector_covers(vector, [(node1, 11)])
+        assert not vector_covers([(node1, 10)], vector)
+
+    def test_select_encoding(self):
+        assert select_encoding('gzip, deflate') == 'gzip'
+        assert select_encoding('deflate') == 'deflate'
+        assert select_encoding('gzip;q=0, deflate;q=0.5') == 'deflate'
+        assert select_encoding('identity') is None
+        assert select_encoding('') is None
+
+    def test_compress(self):
+        data = b''.join([ b'{"id": %d, "vault": "foo"}\n' % i for i in range(1000) ])
+        for encoding in ('gzip', 'deflate'):
+            compressed = compress(data, encoding)
+            assert len(compressed) < len(data)
+            assert Decompressor(BytesIO(compressed)).read() == data
+            chunks = [ data[i:i+1000] for i in range(0, len(data), 1000) ]
+            compressed = b''.join(compress_stream(chunks, encoding))
+            reader = Decompressor(BytesIO(compressed), 100)
+            result = []
+            while True:
+                chunk = reader.read(500)
+                if not chunk:
+                    break
+                assert len(chunk) <= 500
+                result.append(chunk)
+            assert b''.join(result) == data
+
+    def test_client_pool(self):
+        lsock = socket.socket()
+        lsock.bind(('localhost', 0))
+        lsock.listen(2)
+        server = SyncAPIServer(lsock, SyncAPIApplication(), pool_size=5)
+        server.start()
+        address = lsock.getsockname()
+        stats = server.get_stats()
+        assert stats['pool_size'] == 5
+        assert stats['busy'] == 0
+        assert stats['accept_paused'] == 0
+        pool = SyncAPIClientPool()
+        client = pool.get(address)
+        assert client.is_connected()
+        assert not client.session_reused()
+        cb = client.connection.sock.get_channel_binding()
+        # An idle client is reused
+        pool.put(client)
+        assert pool.get(address) is client
+        # A new connection resumes the TLS session, with new channel
+        # bindings, but only if the extended master secret is supported.
+        pool.discard(client)
+        client = pool.get(address)
+        assert client.session_reused() == bool(_sslex.HAVE_EXTMS)
+        assert client.connection.sock.get_channel_binding() != cb
+        # Idle clients are closed after the idle timeout
+        pool.put(client)
+        assert pool.expire() > 0
+        pool.idle_timeout = 0
+        assert pool.expire() is None
+        assert client.connection is None
+        server.stop()
+
+    def test_request_limits(self):
+        app = SyncAPIApplication(max_node_requests=2, max_entity_size=10)
+        assert app.max_node_requests == 2
+        assert app.max_entity_size == 10
+        statuses = []
+        def start_response(status, headers):
+            statuses.append(status)
+        url = '/api/vaults/%s/items' % app.crypto.randuuid()
+        env = { 'REQUEST_METHOD': 'POST', 'PATH_INFO': url,
+                'CONTENT_TYPE': 'text/json', 'CONTENT_LENGTH': '11',
+                'wsgi.input': BytesIO(b'[' + b'1,' * 5 + b'1]') }
+        app(env, start_response)
+        assert statuses[-1].startswith('413 ')
+        del env['CONTENT_LENGTH']
+        app(env, start_response)
+        assert statuses[-1].startswith('413 ')
+        assert app.stats['too_large'] == 2
+        # Admission control per node
+        node = app.crypto.randuuid()
+        app.local.at_end = callbacks = []
+        for i in range(app.max_node_requests):
+            app._admit(node)
+        assert_raises(HTTPReturn, app._admit, node)
+        assert app.stats['rejected'] == 1
+        for callback in callbacks:
+            callback()
+        assert app.active == {}
@@ -0,0 +1,81 @@
+#
+# This file is part of Bluepass. Bluepass is Copyright (c) 2012-2013
+# Geert Jansen.
+#
+# Bluepass is free software available under the GNU General Public License,
+# version 3. See the file LICENSE distributed with this file for the exact
+# licensing terms.
+
+from __future__ import absolute_import, print_function
+
+import time
+
+from .unit import UnitTest
+from bluepass.syncer import SyncSchedule, Syncer
+
+
+class TestSyncer(UnitTest):
+
+    def test_schedule(self):
+        schedule = SyncSchedule()
+        assert schedule.next_due() is None
+        schedule.schedule('a', 30)
+        schedule.schedule('b', 10)
+        schedule.schedule('c', 20)
+        assert len(schedule) == 3
+        assert schedule.next_due() == 10
+        # Rescheduling replaces the earlier due time
+        schedule.schedule('b', 40)
+        assert schedule.next_due() == 20
+        schedule.remove('c')
+        assert 'c' not in schedule
+        assert schedule.next_due() == 30
+        assert schedule.pop_due(5) == []
+        assert schedule.pop_due(35) == ['a']
+        assert schedule.pop_due(100) == ['b']
+        assert len(schedule) == 0
+        assert schedule.next_due() is None
+
+    def test_adaptive_interval(self):
+        syncer = Syncer()
+        neighbor = { 'node': 'n1', 'vault': 'v1',
+                     'addresses': [{ 'id': 'a1' }] }
+        syncer._add_neighbor(neighbor)
+        assert syncer.schedule.next_due() == syncer.interval
+        assert syncer.vault_nodes == { 'v1': set(['n1']) }
+        assert syncer.address_nodes == { 'a1': set(['n1']) }
+        # Active peers are synced more often, idle peers less often
+        syncer._reschedule('n1', changed=True)
+        assert syncer.intervals['n1'] == syncer.interval // 2
+        for i in range(10):
+            syncer._reschedule('n1', changed=True)
+        assert syncer.intervals['n1'] == syncer.min_interval
+        for i in range(10):
+            syncer._reschedule('n1')
+        assert syncer.intervals['n1'] == syncer.max_interval
+        due = syncer.schedule.next_due() - time.time()
+        assert syncer.max_interval * (1 - syncer.jitter) - 1 <= due \
+                    <= syncer.max_interval * (1 + syncer.jitter)
+        # Failed peers are retried after their address backoff
+        syncer._update_backoff('a1', True)
+        syncer._reschedule('n1', failed=True)
+        assert syncer.schedule.next_due() >= syncer._retry_time('a1')
+        # A busy peer delays the address without counting as a failure
+        syncer._update_backoff('a1', False)
+        due = time.time() + 30
+        syncer._set_busy('a1', due)
+        assert syncer._retry_time('a1') == due
+        assert syncer.backoff['a1'][0] == 0
+        syncer._update_backoff('a1', False)
+        assert syncer._retry_time('a1') == 0
+        syncer._remove_neighbor(neighbor)
+        assert len(syncer.schedule) == 0
+        assert syncer.vault_nodes == {}
+        assert syncer.address_nodes == {}
+
+    def test_dependencies(self):
+        model = object(); locator = object(); pool = object()
+        syncer = Syncer(model=model, locator=locator, client_pool=pool)
+        assert syncer.model is model
+        assert syncer.locator is locator
+        assert syncer.client_pool is pool
@@ -77,3 +77,12 @@ class TestJSON(object):
         assert values == ('foo',)
         values = unpack(doc, '[s]')
         assert values == ('foo',)
+
+    def test_iterloads_maxline(self):
+        from io import BytesIO
+        data = b'{"foo": 1}\n' + b'[' + b'1,' * 100 + b'1]\n'
+        items = list(iterloads(BytesIO(data), bufsize=16))
+        assert len(items) == 2
+        items = iterloads(BytesIO(data), bufsize=16, maxline=100)
+        assert next(items) == {'foo': 1}
+        assert_raises(ValueError, next, items)
@@ -16,6 +16,7 @@ from subprocess import PIPE
 
 from ..unit import UnitTest
 from bluepass import crypto
+from bluepass.util import ssl
 from bluepass.util.ssl import SSLSocket
 
 
@@ -102,3 +103,15 @@ class TestSSL(UnitTest):
         assert len(cb) == 2
         assert len(cb[0]) in (12, 36)
         assert cb[0] == cb[1]
+
+    def test_ticket_key_rotation(self):
+        keys = ssl.session_ticket_keys()
+        assert len(keys) == 48
+        assert ssl.session_ticket_keys() is keys
+        old = str(buffer(keys))
+        ssl._rotate_ticket_keys()
+        # The old keys are wiped when they are replaced
+        assert str(buffer(keys)) == '\0' * 48
+        newkeys = ssl.session_ticket_keys()
+        assert newkeys is not keys
+        assert str(buffer(newkeys)) != old
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# This file is part of Bluepass. Bluepass is Copyright (c) 2012-2013
+# Geert Jansen.
+#
+# Bluepass is free software available under the GNU General Public License,
+# version 3. See the file LICENSE distributed with this file for the exact
+# licensing terms.
+#
+# This script benchmarks the crypto primitives in CryptoProvider, and the
+# item encryption and decryption pipelines in the Model. For each benchmark
+# it reports the number of operations per second and latency percentiles.
+#
+# The results can be written as JSON and compared against an earlier run
+# with --baseline. With --threshold, the script exits with a non-zero status
+# if any benchmark became slower than the baseline by more than the given
+# fraction.
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from bluepass.crypto import CryptoProvider, dhparams
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of the sorted list `values`."""
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def measure(func, mintime, miniter):
+    """Call `func` repeatedly for at least `mintime` seconds and at least
+    `miniter` times. Return a dictionary with the results."""
+    latencies = []
+    start = timer()
+    while True:
+        t1 = timer()
+        func()
+        t2 = timer()
+        latencies.append(t2 - t1)
+        if len(latencies) >= miniter and t2 - start >= mintime:
+            break
+    total = sum(latencies)
+    latencies.sort()
+    result = { 'iterations': len(latencies),
+               'ops_per_sec': len(latencies) / total,
+               'mean_ms': 1000.0 * total / len(latencies) }
+    for pct in (50, 90, 99):
+        result['p%d_ms' % pct] = 1000.0 * percentile(latencies, pct)
+    return result
+
+
+def crypto_benchmarks(cp):
+    """Yield (name, function) tuples for the crypto primitives."""
+    for bits in (2048, 3072):
+        private, public = cp.rsa_genkey(bits)
+        message = os.urandom(100)
+        sig = cp.rsa_sign(message, private)
+        symkey = os.urandom(16)
+        enckey = cp.rsa_encrypt(symkey, public)
+        yield 'rsa%d_sign' % bits, lambda: cp.rsa_sign(message, private)
+        yield 'rsa%d_verify' % bits, lambda: cp.rsa_verify(message, sig, public)
+        yield 'rsa%d_encrypt' % bits, lambda: cp.rsa_encrypt(symkey, public)
+        yield 'rsa%d_decrypt' % bits, lambda: cp.rsa_decrypt(enckey, private)
+    ecpriv, ecpub = cp.ec_genkey()
+    ecsig = cp.ec_sign(message, ecpriv)
+    yield 'ecdsa_p256_sign', lambda: cp.ec_sign(message, ecpriv)
+    yield 'ecdsa_p256_verify', lambda: cp.ec_verify(message, ecsig, ecpub)
+    params = dhparams['skip2048']
+    kp1 = cp.dh_genkey(params)
+    kp2 = cp.dh_genkey(params)
+    yield 'dh2048_compute', lambda: cp.dh_compute(params, kp1[0], kp2[1])
+    key = os.urandom(16)
+    for size in (64, 1024, 16384, 1048576):
+        plain = os.urandom(size)
+        iv = os.urandom(16)
+        cipher = cp.aes_encrypt(plain, key, iv)
+        yield 'aes_cbc_encrypt_%d' % size, \
+                lambda: cp.aes_encrypt(plain, key, iv)
+        yield 'aes_cbc_decrypt_%d' % size, \
+                lambda: cp.aes_decrypt(cipher, key, iv)
+        gcmiv = os.urandom(12)
+        gcmcipher = cp.aes_encrypt(plain, key, gcmiv, 'gcm')
+        yield 'aes_gcm_encrypt_%d' % size, \
+                lambda: cp.aes_encrypt(plain, key, gcmiv, 'gcm')
+        yield 'aes_gcm_decrypt_%d' % size, \
+                lambda: cp.aes_decrypt(gcmcipher, key, gcmiv, 'gcm')
+    yield 'pbkdf2_sha256_4096', \
+            lambda: cp.pbkdf2('password', 'salt', 4096, 16, 'hmac-sha256')
+    yield 'hkdf_sha256', lambda: cp.hkdf('password', 'salt', 'info', 32)
+    yield 'random_16', lambda: cp.random(16)
+    yield 'random_alphabet_20', lambda: cp.random(20, '0123456789abcdef')
+    yield 'randuuid', lambda: cp.randuuid()
+
+
+def pipeline_benchmarks(model):
+    """Yield (name, function) tuples for the item pipelines."""
+    vault = model.create_vault('Benchmark', 'Passw0rd', notify=False)
+    uuid = vault['id']
+    version = { 'id': model.crypto.randuuid(), 'name': 'example.com',
+                'password': 'Passw0rd', 'comment': 'x' * 200 }
+    def encrypt_and_sign():
+        item = model._new_version(uuid, **version)
+        model._encrypt_item(uuid, item)
+        model._add_origin(uuid, item)
+        model._sign_item(uuid, item)
+        return item
+    item = encrypt_and_sign()
+    def verify_and_decrypt():
+        copy = json.loads(json.dumps(item))
+        assert model._verify_item(uuid, copy)
+        assert model._decrypt_item(uuid, copy)
+    yield 'item_encrypt_sign', encrypt_and_sign
+    yield 'item_verify_decrypt', verify_and_decrypt
+
+
+def compare(results, baseline, threshold):
+    """Compare `results` against `baseline`. Return a list of regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['ops_per_sec']
+        new = results[name]['ops_per_sec']
+        change = (new - old) / old
+        print('%-28s %12.1f -> %12.1f ops/sec (%+.1f%%)'
+                    % (name, old, new, 100.0 * change))
+        if threshold is not None and change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Bluepass '
+                                     'crypto primitives and item pipelines.')
+    parser.add_argument('-f', '--filter', help='only run benchmarks whose '
+                        'name matches this regular expression')
+    parser.add_argument('-t', '--time', type=float, default=1.0,
+                        help='minimum time to run each benchmark (seconds)')
+    parser.add_argument('-n', '--iterations', type=int, default=10,
+                        help='minimum number of iterations per benchmark')
+    parser.add_argument('-o', '--output', help='write results as JSON here')
+    parser.add_argument('-b', '--baseline', help='compare against results '
+                        'from an earlier run')
+    parser.add_argument('--threshold', type=float, help='fail if a '
+                        'benchmark is slower than the baseline by more than '
+                        'this fraction (e.g. 0.1)')
+    parser.add_argument('--no-pipelines', action='store_true',
+                        help='do not benchmark the item pipelines')
+    args = parser.parse_args()
+    if args.threshold is not None and not args.baseline:
+        parser.error('--threshold requires --baseline')
+
+    logging.basicConfig(level=logging.WARNING)
+    regex = re.compile(args.filter) if args.filter else None
+    benchmarks = [crypto_benchmarks(CryptoProvider())]
+    tmpdir = None
+    if not args.no_pipelines:
+        from bluepass.database import Database
+        from bluepass.model import Model
+        tmpdir = tempfile.mkdtemp()
+        database = Database(os.path.join(tmpdir, 'bench.db'))
+        benchmarks.append(pipeline_benchmarks(Model(database)))
+
+    results = {}
+    try:
+        for generator in benchmarks:
+            for name, func in generator:
+                if regex and not regex.search(name):
+                    continue
+                result = measure(func, args.time, args.iterations)
+                results[name] = result
+                print('%-28s %12.1f ops/sec  p50 %8.3f ms  p99 %8.3f ms'
+                        % (name, result['ops_per_sec'], result['p50_ms'],
+                           result['p99_ms']))
+    finally:
+        if tmpdir is not None:
+            database.close()
+            shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\nregressions: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+#
+# This file is part of Bluepass. Bluepass is Copyright (c) 2012-2013
+# Geert Jansen.
+#
+# This script simulates a network of Bluepass nodes in a single process. Each
+# node has its own database, Model, SyncAPIServer on the loopback interface
+# and Syncer. The nodes find each other through a simulated location source,
+# so no Avahi or network is needed. The syncers run unmodified, with short
+# intervals, so the simulation covers their scheduling, notifications,
+# batching and reconciliation.
+#
+# The script runs a number of workloads and reports, for each of them, the
+# time until all nodes have converged, the number of sync and notify jobs,
+# and the number of bytes transferred, RSA operations and database commits
+# per item.
+#
+# The results can be written as JSON and compared against an earlier run
+# with --baseline. With --threshold, the script exits with a non-zero status
+# if the cost per item of any workload increased by more than the given
+# fraction.
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import gevent
+from gevent import socket
+from gevent.server import StreamServer
+
+from bluepass.crypto import CryptoProvider
+from bluepass.database import Database
+from bluepass.model import Model
+from bluepass.locator import Locator, LocationSource
+from bluepass.syncapi import SyncAPIApplication, SyncAPIServer, \
+        SyncAPIClientPool, _version_jobs
+from bluepass.syncer import Syncer
+
+# The metrics that are compared against a baseline. Lower is better.
+compared_metrics = ('seconds', 'bytes_per_item', 'rsa_per_item',
+                    'commits_per_item')
+
+
+class CountingCryptoProvider(CryptoProvider):
+    """A crypto provider that counts RSA operations."""
+
+    def __init__(self, stats):
+        super(CountingCryptoProvider, self).__init__()
+        self.stats = stats
+
+    def rsa_encrypt(self, *args, **kwargs):
+        self.stats['rsa'] += 1
+        return super(CountingCryptoProvider, self).rsa_encrypt(*args, **kwargs)
+
+    def rsa_decrypt(self, *args, **kwargs):
+        self.stats['rsa'] += 1
+        return super(CountingCryptoProvider, self).rsa_decrypt(*args, **kwargs)
+
+    def rsa_sign(self, *args, **kwargs):
+        self.stats['rsa'] += 1
+        return super(CountingCryptoProvider, self).rsa_sign(*args, **kwargs)
+
+    def rsa_verify(self, *args, **kwargs):
+        self.stats['rsa'] += 1
+        return super(CountingCryptoProvider, self).rsa_verify(*args, **kwargs)
+
+
+class CountingDatabase(Database):
+    """A database that counts commits."""
+
+    def __init__(self, fname, stats):
+        self.stats = stats
+        super(CountingDatabase, self).__init__(fname)
+
+    def _commit(self, cursor):
+        self.stats['commits'] += 1
+        super(CountingDatabase, self)._commit(cursor)
+
+
+class CountingProxy(StreamServer):
+    """A TCP proxy on the loopback interface that counts the bytes that are
+    transferred to and from `target`."""
+
+    def __init__(self, target, stats):
+        super(CountingProxy, self).__init__(('127.0.0.1', 0))
+        self.target = target
+        self.stats = stats
+
+    def _pump(self, source, dest):
+        try:
+            while True:
+                data = source.recv(16384)
+                if not data:
+                    break
+                self.stats['bytes'] += len(data)
+                dest.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            dest.close()
+
+    def handle(self, sock, address):
+        try:
+            upstream = socket.create_connection(self.target)
+        except socket.error:
+            sock.close()
+            return
+        pump = gevent.spawn(self._pump, upstream, sock)
+        self._pump(sock, upstream)
+        pump.join()
+
+
+class SimulatedNetwork(object):
+    """The shared state of the simulated location sources."""
+
+    def __init__(self):
+        self.sources = []
+        self.neighbors = {}
+        self.registered = {}
+
+    def broadcast(self, sender, event, neighbor):
+        for source in self.sources:
+            if source is not sender:
+                source.raise_event(event, neighbor)
+
+
+class SimulatedLocationSource(LocationSource):
+    """A location source that finds the nodes in a SimulatedNetwork."""
+
+    name = 'SIM'
+
+    def __init__(self, network):
+        self.network = network
+        self.callbacks = []
+        network.sources.append(self)
+
+    def isavailable(self):
+        return True
+
+    def raise_event(self, event, *args):
+        for callback in self.callbacks:
+            callback(event, *args)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+        for node, neighbor in self.network.neighbors.items():
+            if self.network.registered[node] is not self:
+                callback('NeighborDiscovered', neighbor)
+
+    def register(self, node, nodename, vault, vaultname, address,
+                 properties=None):
+        addr = { 'family': socket.AF_INET, 'host': address[0],
+                 'addr': address, 'id': '%s:%s:%s' % ((socket.AF_INET,)
+                                                      + tuple(address)) }
+        neighbor = { 'node': node, 'source': self.name, 'nodename': nodename,
+                     'vault': vault, 'vaultname': vaultname,
+                     'addresses': [addr], 'properties': properties or {} }
+        self.network.neighbors[node] = neighbor
+        self.network.registered[node] = self
+        self.network.broadcast(self, 'NeighborDiscovered', neighbor)
+
+    def set_property(self, node, name, value):
+        neighbor = self.network.neighbors[node]
+        neighbor['properties'][name] = value
+        self.network.broadcast(self, 'NeighborUpdated', neighbor)
+
+    def unregister(self, node):
+        neighbor = self.network.neighbors.pop(node)
+        del self.network.registered[node]
+        self.network.broadcast(self, 'NeighborDisappeared', neighbor)
+
+
+class SimulatedClientPool(SyncAPIClientPool):
+    """A client pool whose clients use a counting crypto provider."""
+
+    def __init__(self, crypto):
+        super(SimulatedClientPool, self).__init__()
+        self.crypto = crypto
+
+    def get(self, address):
+        client = super(SimulatedClientPool, self).get(address)
+        client.crypto = self.crypto
+        return client
+
+
+class SimulatedSyncer(Syncer):
+    """A syncer with short intervals that counts its jobs."""
+
+    interval = 1
+    min_interval = 0.5
+    max_interval = 2
+    backoff_min = 0.5
+    backoff_max = 2
+    timeout = 30
+
+    def __init__(self, stats, **kwargs):
+        super(SimulatedSyncer, self).__init__(**kwargs)
+        self.stats = stats
+
+    def _sync_address(self, *args):
+        self.stats['syncs'] += 1
+        super(SimulatedSyncer, self)._sync_address(*args)
+
+    def _notify_address(self, *args):
+        self.stats['notifies'] += 1
+        super(SimulatedSyncer, self)._notify_address(*args)
+
+    def _update_backoff(self, key, failed):
+        if failed:
+            self.stats['failures'] += 1
+        super(SimulatedSyncer, self)._update_backoff(key, failed)
+
+
+class SimulatedNode(object):
+    """A Bluepass backend in the simulation."""
+
+    def __init__(self, name, network, directory):
+        self.name = name
+        self.stats = dict.fromkeys(('rsa', 'commits', 'bytes', 'syncs',
+                                    'notifies', 'failures'), 0)
+        self.crypto = CountingCryptoProvider(self.stats)
+        fname = os.path.join(directory, '%s.db' % name)
+        self.database = CountingDatabase(fname, self.stats)
+        self.model = Model(self.database)
+        self.model.crypto = self.crypto
+        self.application = SyncAPIApplication(self.model)
+        self.application.crypto = self.crypto
+        self.pool = SimulatedClientPool(self.crypto)
+        self.locator = Locator()
+        self.locator.add_source(SimulatedLocationSource(network))
+        self.server = None
+        self.proxy = None
+        self.syncer = None
+
+    @property
+    def online(self):
+        return self.server is not None
+
+    def start(self):
+        """Start the syncapi and register our vaults."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(10)
+        self.server = SyncAPIServer(listener, self.application)
+        self.server.start()
+        self.proxy = CountingProxy(listener.getsockname(), self.stats)
+        self.proxy.start()
+        address = (self.proxy.server_host, self.proxy.server_port)
+        for vault in self.model.get_vaults():
+            self.locator.register(vault['node'], self.name, vault['id'],
+                                  vault['name'], address)
+        self.syncer = SimulatedSyncer(self.stats, model=self.model,
+                                      locator=self.locator,
+                                      application=self.application,
+                                      client_pool=self.pool)
+        self.syncer.start()
+
+    def stop(self):
+        """Stop the syncer, unregister our vaults and stop the syncapi."""
+        self.syncer.kill()
+        self.syncer = None
+        for vault in self.model.get_vaults():
+            self.locator.unregister(vault['node'])
+        self.proxy.stop()
+        self.server.stop()
+        self.server = self.proxy = None
+        self.pool.close()
+
+
+class Simulation(object):
+    """A network of simulated nodes that share a number of vaults."""
+
+    # Maximum time to wait for convergence, and how often to check for it.
+    max_seconds = 120
+    poll_interval = 0.1
+
+    def __init__(self, nnodes, nvaults, directory):
+        self.network = SimulatedNetwork()
+        self.nodes = [ SimulatedNode('node%d' % i, self.network, directory)
+                       for i in range(nnodes) ]
+        self.vaults = []
+        first = self.nodes[0].model
+        for i in range(nvaults):
+            vault = first.create_vault('Vault%d' % i, 'Passw0rd', notify=False)
+            self.vaults.append(vault['id'])
+            for node in self.nodes[1:]:
+                node.model.create_vault('Vault%d' % i, 'Passw0rd',
+                                        uuid=vault['id'], notify=False)
+        # Pair every node with every other node.
+        for vault in self.vaults:
+            for node in self.nodes:
+                for peer in self.nodes:
+                    if peer is node:
+                        continue
+                    certinfo = peer.model.get_certinfo(vault, peer.name)
+                    node.model.add_certificate(vault, certinfo)
+        for node in self.nodes:
+            node.start()
+
+    def close(self):
+        for node in self.nodes:
+            if node.online:
+                node.stop()
+            node.database.close()
+
+    def wait_for_jobs(self):
+        """Wait for the background version updates to finish."""
+        while _version_jobs:
+            gevent.joinall(list(_version_jobs.values()))
+
+    def run_for(self, seconds):
+        """Let the syncers run for `seconds` seconds."""
+        gevent.sleep(seconds)
+        self.wait_for_jobs()
+
+    def converged(self):
+        """Return whether all online nodes have the same items and
+        versions."""
+        nodes = [ node for node in self.nodes if node.online ]
+        for vault in self.vaults:
+            vectors = set()
+            versions = set()
+            for node in nodes:
+                vectors.add(tuple(sorted(node.model.get_vector(vault))))
+                version = tuple(sorted(((v['id'], v.get('value'))
+                                for v in node.model.get_versions(vault))))
+                versions.add(version)
+            if len(vectors) > 1 or len(versions) > 1:
+                return False
+        return True
+
+    def converge(self):
+        """Wait until the nodes have converged."""
+        start = timer()
+        while not self.converged():
+            if timer() - start > self.max_seconds:
+                raise RuntimeError('no convergence after %d seconds'
+                                   % self.max_seconds)
+            self.run_for(self.poll_interval)
+
+    def count_items(self):
+        """Return the number of items in the vaults of the first node."""
+        model = self.nodes[0].model
+        return sum((sum((seqnr + 1 for node, seqnr in model.get_vector(vault)))
+                    for vault in self.vaults))
+
+    def run(self, workload, *args):
+        """Run a workload and return its results."""
+        for node in self.nodes:
+            for key in node.stats:
+                node.stats[key] = 0
+        stats = {}
+        items = self.count_items()
+        start = timer()
+        workload(self, *args)
+        for node in self.nodes:
+            if not node.online:
+                node.start()
+        self.converge()
+        stats['seconds'] = timer() - start
+        stats['items'] = max(1, self.count_items() - items)
+        for key in ('syncs', 'notifies', 'failures'):
+            stats[key] = sum((node.stats[key] for node in self.nodes))
+        for key in ('rsa', 'commits', 'bytes'):
+            total = sum((node.stats[key] for node in self.nodes))
+            stats[key] = total
+            stats['%s_per_item' % key] = float(total) / stats['items']
+        return stats
+
+
+def bulk_import(sim, count):
+    """One node adds `count` versions to every vault."""
+    model = sim.nodes[0].model
+    for vault in sim.vaults:
+        for i in range(count):
+            model.add_version(vault, { 'name': 'item%d' % i, 'value': i })
+
+
+def concurrent_edits(sim, count):
+    """All nodes update the same versions before they sync, which results
+    in conflicts that must be resolved the same way everywhere."""
+    bulk_import(sim, count)
+    sim.converge()
+    for node in sim.nodes:
+        for vault in sim.vaults:
+            for version in node.model.get_versions(vault):
+                del version['_envelope']
+                version['value'] = '%s-%s' % (node.name, version['value'])
+                node.model.update_version(vault, version)
+
+
+def node_churn(sim, count, rounds=5, interval=1.0):
+    """Nodes go offline and come back, while the online nodes keep adding
+    versions. The last online node is never stopped."""
+    rnd = random.Random(0)
+    for i in range(rounds):
+        node = rnd.choice(sim.nodes)
+        online = [ node for node in sim.nodes if node.online ]
+        if not node.online:
+            node.start()
+        elif len(online) > 1:
+            node.stop()
+        online = [ node for node in sim.nodes if node.online ]
+        for vault in sim.vaults:
+            editor = rnd.choice(online)
+            for j in range(count // rounds):
+                editor.model.add_version(vault, { 'name': 'churn%d' % j,
+                                                  'value': i })
+        sim.run_for(interval)
+
+
+workloads = [('bulk_import', bulk_import), ('concurrent_edits', concurrent_edits),
+             ('node_churn', node_churn)]
+
+
+def compare(results, baseline, threshold):
+    """Compare `results` against `baseline`. Return a list of regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric in compared_metrics:
+            old = baseline[name][metric]
+            new = results[name][metric]
+            change = (new - old) / old if old else 0.0
+            print('%-18s %-18s %12.2f -> %12.2f (%+.1f%%)'
+                        % (name, metric, old, new, 100.0 * change))
+            if threshold is not None and change > threshold:
+                regressions.append('%s.%s' % (name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a network of '
+                                     'Bluepass nodes and measure sync '
+                                     'performance.')
+    parser.add_argument('-N', '--nodes', type=int, default=3,
+                        help='number of nodes')
+    parser.add_argument('-V', '--vaults', type=int, default=1,
+                        help='number of vaults shared by all nodes')
+    parser.add_argument('-n', '--items', type=int, default=100,
+                        help='number of versions per vault in a workload')
+    parser.add_argument('-w', '--workload', action='append',
+                        choices=[ name for name, func in workloads ],
+                        help='run only this workload (may be repeated)')
+    parser.add_argument('-o', '--output', help='write results as JSON here')
+    parser.add_argument('-b', '--baseline', help='compare against results '
+                        'from an earlier run')
+    parser.add_argument('--threshold', type=float, help='fail if a metric '
+                        'is worse than the baseline by more than this '
+                        'fraction (e.g. 0.1)')
+    args = parser.parse_args()
+    if args.threshold is not None and not args.baseline:
+        parser.error('--threshold requires --baseline')
+    if args.nodes < 2:
+        parser.error('--nodes must be at least 2')
+
+    logging.basicConfig(level=logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        start = timer()
+        sim = Simulation(args.nodes, args.vaults, tmpdir)
+        sim.converge()
+        print('set up %d nodes with %d vaults in %.1fs'
+                    % (args.nodes, args.vaults, timer() - start))
+        try:
+            for name, workload in workloads:
+                if args.workload and name not in args.workload:
+                    continue
+                result = sim.run(workload, args.items)
+                results[name] = result
+                print('%-18s %6d items %8.2fs %4d syncs %4d notifies '
+                      '%10.1f bytes/item %6.2f rsa/item %6.2f commits/item'
+                        % (name, result['items'], result['seconds'],
+                           result['syncs'], result['notifies'],
+                           result['bytes_per_item'], result['rsa_per_item'],
+                           result['commits_per_item']))
+        finally:
+            sim.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\nregressions: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())